@@ -10,7 +10,8 @@ fi
 if [[ "${1-}" =~ ^-*h(elp)?$ ]]; then
     echo 'Usage: ./backup-database.sh
 
-This script dumps the mataroa postgres database and uploads it into an S3-compatible server.'
+This script dumps the mataroa postgres database and uploads it, along with any
+images stored on the filesystem, into an S3-compatible server.'
     exit
 fi
 
@@ -26,6 +27,11 @@ main() {
 
     # upload using aws cli
     /usr/bin/rclone copy --progress /home/deploy/mataroa.dump scaleway:bucket/mataroa-backups/postgres-mataroa-"$(date --utc +%Y%m%d-%H%M%S)"/
+
+    # images stored on the filesystem are not in the dump
+    if [[ -d /var/www/mataroa/images ]]; then
+        /usr/bin/rclone copy --progress /var/www/mataroa/images scaleway:bucket/mataroa-images/
+    fi
 }
 
 main "$@"
@@ -0,0 +1,65 @@
+"""
+Throughput of zip exports of a 5,000 post account in each export format.
+
+Run with:
+
+    python manage.py test benchmarks.bench_export_formats --pattern="bench_*.py"
+"""
+
+import time
+
+from django.test import TestCase
+
+from main import exports, models, util
+
+POSTS = 5_000
+RUNS = 3
+BODY = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+
+
+def run_export(user, export_format):
+    export_name = exports.get_export_name(export_format)
+    files = exports.get_files(user, export_format, export_name)
+    return sum(len(chunk) for chunk in util.stream_zip(files))
+
+
+class ExportFormatsBenchmark(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        models.Post.objects.bulk_create(
+            (
+                models.Post(
+                    owner=self.user,
+                    title=f"Post {i}",
+                    slug=f"post-{i}",
+                    body=f"{i} {BODY}",
+                )
+                for i in range(POSTS)
+            ),
+            batch_size=1000,
+        )
+
+    def measure(self, export_format):
+        # best of a few runs, as the first also warms up the database
+        timings = []
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            size = run_export(self.user, export_format)
+            timings.append(time.perf_counter() - start)
+        return size, min(timings)
+
+    def test_throughput(self):
+        formats = [
+            ("markdown", exports.MARKDOWN),
+            ("hugo", exports.HUGO),
+            ("mail", exports.MAIL),
+        ]
+        results = [(label, *self.measure(fmt)) for label, fmt in formats]
+
+        print(f"\nZip export of {POSTS} posts, best of {RUNS} runs:")
+        print(f"  {'':<10} {'zip MiB':>8} {'seconds':>8} {'posts/s':>8} {'MiB/s':>7}")
+        for label, size, seconds in results:
+            print(
+                f"  {label:<10} {size / 2**20:>8.1f} {seconds:>8.2f} "
+                f"{POSTS / seconds:>8.0f} {size / 2**20 / seconds:>7.1f}"
+            )
@@ -0,0 +1,94 @@
+"""
+Peak memory of a markdown zip export of a 1k and a 10k post account.
+
+Run with:
+
+    python manage.py test benchmarks.bench_export_memory --pattern="bench_*.py"
+"""
+
+import io
+import resource
+import tracemalloc
+import uuid
+import zipfile
+
+from django.test import RequestFactory, TestCase
+
+from main import exports, models
+from main.views import export
+
+POSTS = [1_000, 10_000]
+BODY = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+
+
+def legacy_export(user):
+    """Markdown export as it was before streaming: BytesIO copies of it all."""
+    exported_posts = []
+    for p in models.Post.objects.filter(owner=user):
+        body = exports.post_with_frontmatter(p)
+        exported_posts.append((p.slug + ".md", io.BytesIO(body.encode())))
+
+    export_name = "export-markdown-" + str(uuid.uuid4())[:8]
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as archive:
+        for file_name, data in exported_posts:
+            archive.writestr(export_name + "/blog/" + file_name, data.getvalue())
+    return [zip_buffer.getvalue()]
+
+
+def streaming_export(user):
+    request = RequestFactory().post("/export/markdown/")
+    request.user = user
+    return export.export_markdown(request).streaming_content
+
+
+def max_rss_mib():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ExportMemoryBenchmark(TestCase):
+    def setUp(self):
+        self.users = []
+        for count in POSTS:
+            user = models.User.objects.create(username=f"user{count}")
+            models.Post.objects.bulk_create(
+                (
+                    models.Post(
+                        owner=user,
+                        title=f"Post {i}",
+                        slug=f"post-{i}",
+                        body=f"{i} {BODY}",
+                    )
+                    for i in range(count)
+                ),
+                batch_size=1000,
+            )
+            self.users.append(user)
+
+    def measure(self, run_export, user):
+        rss_before = max_rss_mib()
+        tracemalloc.start()
+        size = sum(len(chunk) for chunk in run_export(user))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return size, peak / 2**20, max_rss_mib() - rss_before
+
+    def test_peak_memory(self):
+        # the RSS high-water mark of a process cannot be reset, so streaming runs
+        # first and each later figure is how far that run raised the mark
+        results = [
+            (f"streaming, {count}", *self.measure(streaming_export, user))
+            for count, user in zip(POSTS, self.users, strict=True)
+        ]
+        results += [
+            (f"before, {count}", *self.measure(legacy_export, user))
+            for count, user in zip(POSTS, self.users, strict=True)
+        ]
+
+        print("\nMarkdown export by number of posts:")
+        print(f"  {'':<18} {'zip MiB':>8} {'py peak MiB':>12} {'max RSS +MiB':>13}")
+        for label, size, peak, rss in results:
+            print(f"  {label:<18} {size / 2**20:>8.1f} {peak:>12.1f} {rss:>13.1f}")
+
+        self.assertLess(results[1][2], results[3][2])
@@ -0,0 +1,66 @@
+"""
+Queries spent resolving the blog of a request's host, in host_middleware.
+
+Run with:
+
+    python manage.py test benchmarks --pattern="bench_*.py"
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from main import models
+from main.middleware import host_middleware
+
+REQUESTS = 100
+
+
+def legacy_resolve(request):
+    """Host resolution as it was before caching: exists() then get()."""
+    subdomain = request.get_host().split(".")[0]
+    if models.User.objects.filter(username=subdomain).exists():
+        request.blog_user = models.User.objects.get(username=subdomain)
+
+
+class HostResolutionBenchmark(TestCase):
+    def setUp(self):
+        cache.clear()
+        models.User.objects.create(username="alice")
+        models.User.objects.create(username="bob", custom_domain="example.com")
+        self.middleware = host_middleware(lambda request: HttpResponse())
+
+    def count_queries(self, host, resolve, clear_cache=False):
+        with CaptureQueriesContext(connection) as context:
+            for _ in range(REQUESTS):
+                if clear_cache:
+                    cache.clear()
+                request = RequestFactory().get("/", HTTP_HOST=host)
+                request.user = AnonymousUser()
+                resolve(request)
+        return len(context.captured_queries) / REQUESTS
+
+    def test_queries_per_request(self):
+        subdomain = f"alice.{settings.CANONICAL_HOST}"
+        results = [
+            ("before (exists + get)", self.count_queries(subdomain, legacy_resolve)),
+            (
+                "after, cold cache",
+                self.count_queries(subdomain, self.middleware, clear_cache=True),
+            ),
+            ("after, warm subdomain", self.count_queries(subdomain, self.middleware)),
+            (
+                "after, warm custom domain",
+                self.count_queries("example.com", self.middleware),
+            ),
+        ]
+
+        print(f"\nHost resolution queries per request ({REQUESTS} requests):")
+        for label, queries in results:
+            print(f"  {label:<28} {queries:.2f}")
+
+        self.assertEqual(results[2][1], 0)
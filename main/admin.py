@@ -138,6 +138,29 @@ class AnalyticPostAdmin(admin.ModelAdmin):
     ordering = ["-id"]
 
 
+@admin.register(models.AnalyticPageDaily)
+class AnalyticPageDailyAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "path",
+        "date",
+        "count",
+    )
+    ordering = ["-id"]
+
+
+@admin.register(models.AnalyticPostDaily)
+class AnalyticPostDailyAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "post",
+        "date",
+        "count",
+    )
+    ordering = ["-id"]
+
+
 @admin.register(models.Notification)
 class NotificationAdmin(admin.ModelAdmin):
     list_display = (
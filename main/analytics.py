@@ -0,0 +1,258 @@
+"""
+Buffered analytics ingestion.
+
+Views record hits with record_page() and record_post(), which only append to
+an in-process buffer, so that anonymous reads do not write to the database.
+The buffer is written out with bulk_create at the end of a request (on the
+request_finished signal, after the response has been sent) once it holds
+settings.ANALYTICS_FLUSH_SIZE hits or its oldest hit is older than
+settings.ANALYTICS_FLUSH_INTERVAL seconds, and on clean worker shutdown. A flush
+that fails, eg. while the database is unavailable, puts its hits back in the
+buffer for the next one, keeping at most settings.ANALYTICS_BUFFER_MAX hits of
+pages and as many of posts: older ones are dropped, and logged.
+
+Durability: while flushes succeed, the buffer is checked after every request
+and never carries ANALYTICS_FLUSH_SIZE hits past one, so a worker that dies
+without a clean shutdown (eg. SIGKILL, OOM) loses at most its last
+ANALYTICS_FLUSH_SIZE hits. While they fail, it can lose the whole buffer, up
+to ANALYTICS_BUFFER_MAX hits of each kind, and hits past that are dropped
+oldest first even if it lives. Time does not bound the loss: with no further
+requests, hits wait in the buffer until the next one. A graceful gunicorn
+shutdown or restart drains the buffer via atexit.
+
+Each flush also adds its hits to the per-day counts in AnalyticPageDaily and
+AnalyticPostDaily, in the same transaction as the raw rows, which is what the
+dashboards read. The rollupanalytics command recounts recent days from the raw
+rows and deletes raw rows older than settings.ANALYTICS_RETENTION_DAYS.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models import Count, F, Min
+from django.dispatch import receiver
+from django.utils import timezone
+
+from main import models
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending_pages = []
+_pending_posts = []
+_oldest_at = None
+_capture = threading.local()
+
+
+def _record(model, **fields):
+    global _oldest_at
+    hit = model(created_at=timezone.now(), **fields)
+    with _lock:
+        pending = _pending_pages if model is models.AnalyticPage else _pending_posts
+        pending.append(hit)
+        if _oldest_at is None:
+            _oldest_at = time.monotonic()
+    captured = getattr(_capture, "hits", None)
+    if captured is not None:
+        captured.append((model, fields))
+
+
+def record_page(user, path):
+    """Record a hit on a blog page, eg. index, rss, or a page slug."""
+    _record(models.AnalyticPage, user_id=user.id, path=path)
+
+
+def record_post(post):
+    """Record a hit on a blog post."""
+    _record(models.AnalyticPost, post_id=post.id)
+
+
+@contextmanager
+def capture():
+    """
+    Collect the hits recorded by this thread inside the block, so that they can
+    be recorded again with replay(), eg. when serving a cached response.
+    """
+    _capture.hits = []
+    try:
+        yield _capture.hits
+    finally:
+        _capture.hits = None
+
+
+def replay(hits):
+    """Record again hits collected by capture(), as of now."""
+    for model, fields in hits:
+        _record(model, **fields)
+
+
+def pending_count():
+    """Return number of hits recorded but not yet written."""
+    with _lock:
+        return len(_pending_pages) + len(_pending_posts)
+
+
+def is_flush_due():
+    with _lock:
+        if _oldest_at is None:
+            return False
+        if len(_pending_pages) + len(_pending_posts) >= settings.ANALYTICS_FLUSH_SIZE:
+            return True
+        return time.monotonic() - _oldest_at >= settings.ANALYTICS_FLUSH_INTERVAL
+
+
+# raw model -> (daily model, fields counted per day besides date)
+DAILY_MODELS = {
+    models.AnalyticPage: (models.AnalyticPageDaily, ["user_id", "path"]),
+    models.AnalyticPost: (models.AnalyticPostDaily, ["post_id"]),
+}
+
+
+def _write(model, hits):
+    """Write hits of given model and add them to its daily counts."""
+    daily_model, fields = DAILY_MODELS[model]
+    counts = Counter(
+        tuple(getattr(h, f) for f in fields) + (h.created_at.date(),) for h in hits
+    )
+    # same order in every worker, so concurrent flushes do not deadlock
+    keys = sorted(counts)
+    names = fields + ["date"]
+    with transaction.atomic():
+        model.objects.bulk_create(hits)
+        daily_model.objects.bulk_create(
+            [daily_model(**dict(zip(names, key, strict=True))) for key in keys],
+            ignore_conflicts=True,
+        )
+        for key in keys:
+            daily_model.objects.filter(**dict(zip(names, key, strict=True))).update(
+                count=F("count") + counts[key]
+            )
+
+
+def _bulk_create(model, hits, fk_name):
+    """
+    Write hits of given model. Hits of posts or users deleted since they were
+    recorded are dropped.
+    """
+    related_model = model._meta.get_field(fk_name).related_model
+    hit_ids = {getattr(h, f"{fk_name}_id") for h in hits}
+    existing_ids = set(
+        related_model.objects.filter(id__in=hit_ids).values_list("id", flat=True)
+    )
+    hits = [h for h in hits if getattr(h, f"{fk_name}_id") in existing_ids]
+    if hits:
+        _write(model, hits)
+
+
+def _restore(pages, posts, oldest_at):
+    """
+    Put hits that could not be written back in front of the buffer, dropping
+    the oldest past settings.ANALYTICS_BUFFER_MAX.
+    """
+    global _oldest_at
+    dropped = 0
+    with _lock:
+        for pending, hits in [(_pending_pages, pages), (_pending_posts, posts)]:
+            pending[:0] = hits
+            excess = len(pending) - settings.ANALYTICS_BUFFER_MAX
+            if excess > 0:
+                del pending[:excess]
+                dropped += excess
+        if oldest_at is not None:
+            _oldest_at = min(oldest_at, _oldest_at or oldest_at)
+    if dropped:
+        logger.warning("Dropped %d analytics hits over the buffer maximum.", dropped)
+
+
+def flush():
+    """
+    Write all buffered hits to the database. If writing fails, the hits not
+    written are put back in the buffer, to be written by the next flush.
+    """
+    global _pending_pages, _pending_posts, _oldest_at
+    with _lock:
+        pages, posts = _pending_pages, _pending_posts
+        oldest_at = _oldest_at
+        _pending_pages, _pending_posts = [], []
+        _oldest_at = None
+
+    try:
+        if pages:
+            _bulk_create(models.AnalyticPage, pages, "user")
+            pages = []
+        if posts:
+            _bulk_create(models.AnalyticPost, posts, "post")
+    except Exception:
+        _restore(pages, posts, oldest_at)
+        raise
+
+
+def rollup(start_date, end_date):
+    """
+    Recount daily counts of days from start_date up to (not including) end_date
+    from the raw rows, one day at a time. Days whose raw rows have been compacted
+    would be counted as empty, so the range must be within the retention period.
+    """
+    day = start_date
+    while day < end_date:
+        start = datetime.combine(day, datetime.min.time())
+        for model, (daily_model, fields) in DAILY_MODELS.items():
+            rows = (
+                model.objects.filter(
+                    created_at__gte=start, created_at__lt=start + timedelta(days=1)
+                )
+                .values(*fields)
+                .annotate(count=Count("id"))
+                .order_by()
+            )
+            with transaction.atomic():
+                daily_model.objects.filter(date=day).delete()
+                daily_model.objects.bulk_create(
+                    [daily_model(date=day, **row) for row in rows], batch_size=5000
+                )
+        day += timedelta(days=1)
+
+
+def compact(before_date):
+    """
+    Delete raw rows of days before before_date, one day at a time. Their counts
+    remain in the daily tables. Return number of rows deleted.
+    """
+    deleted = 0
+    for model in DAILY_MODELS:
+        oldest = model.objects.aggregate(Min("created_at"))["created_at__min"]
+        if oldest is None:
+            continue
+        day = oldest.date()
+        while day < before_date:
+            day += timedelta(days=1)
+            end = datetime.combine(min(day, before_date), datetime.min.time())
+            deleted += model.objects.filter(created_at__lt=end).delete()[0]
+    return deleted
+
+
+@receiver(request_finished)
+def flush_if_due(sender, **kwargs):
+    if not is_flush_due():
+        return
+    try:
+        flush()
+    except Exception:
+        # analytics should never break serving requests
+        logger.exception("Failed to flush analytics buffer.")
+
+
+@atexit.register
+def drain():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Failed to drain analytics buffer on shutdown.")
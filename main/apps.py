@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     name = "main"
+
+    def ready(self):
+        from main import analytics, exports, signals  # noqa: F401
@@ -0,0 +1,149 @@
+"""
+Zip archives of all of a user's posts, in one of three formats:
+
+* MARKDOWN, the export page's download: posts with YAML frontmatter.
+* HUGO: the same posts as the content of a Hugo site using a theme like
+  mataroa's. Its theme and config files are read from disk once, when this
+  module is imported on startup (see apps.py), and the config is filled in
+  for each user.
+* MAIL, the monthly emailed export: posts as plain markdown with their title
+  and publication date on top.
+
+get_files yields the (name, content) pairs of an export, reading posts in
+batches. Its archive can then be streamed in chunks with util.stream_zip, eg.
+as an HTTP response, or written to a file with write_zip, eg. to attach to an
+email.
+"""
+
+import itertools
+import uuid
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import frontmatter
+from django.conf import settings
+
+from main import models, util
+
+HUGO_DIR = settings.BASE_DIR / "export_base_hugo"
+
+# archive path under the theme directory, and source file
+HUGO_THEME_FILES = [
+    ("theme.toml", HUGO_DIR / "theme.toml"),
+    ("static/style.css", settings.BASE_DIR / "main/templates/assets/style.css"),
+    ("layouts/index.html", HUGO_DIR / "index.html"),
+    ("layouts/404.html", HUGO_DIR / "404.html"),
+    ("layouts/_default/single.html", HUGO_DIR / "single.html"),
+    ("layouts/_default/list.html", HUGO_DIR / "list.html"),
+    ("layouts/_default/baseof.html", HUGO_DIR / "baseof.html"),
+]
+
+
+def read_hugo_assets():
+    """Return the Hugo config template, and the theme files as (path, content)."""
+    config = (HUGO_DIR / "config.toml").read_text()
+    theme_files = [(path, source.read_text()) for path, source in HUGO_THEME_FILES]
+    return config, theme_files
+
+
+HUGO_CONFIG, HUGO_THEME = read_hugo_assets()
+
+
+def post_with_frontmatter(post: models.Post):
+    exported = frontmatter.Post(post.body)
+    title = util.escape_quotes(post.title)
+    pub_date = post.published_at or post.created_at.date()
+
+    exported["title"] = title
+    exported["slug"] = post.slug
+    exported["date"] = pub_date
+    exported["draft"] = post.is_draft
+
+    return frontmatter.dumps(exported)
+
+
+def post_as_markdown(post: models.Post):
+    pub_date = post.published_at or post.created_at
+    return (
+        f"# {post.title}\n\n"
+        f"> Published on {pub_date.strftime('%b %-d, %Y')}\n\n"
+        f"{post.body}\n"
+    )
+
+
+def get_hugo_site_files(user):
+    """Return the config, filled in for user, and theme files of a Hugo site."""
+    blog_title = user.blog_title or f"{user.username} blog"
+    blog_byline = user.blog_byline or ""
+    config = (
+        HUGO_CONFIG.replace("example.com", f"{user.username}.capivaras.dev")
+        .replace("Example blog title", blog_title)
+        .replace("Example blog description", "\\n".join(blog_byline.splitlines()))
+    )
+    theme_files = [(f"themes/mataroa/{path}", content) for path, content in HUGO_THEME]
+    return [("config.toml", config), *theme_files]
+
+
+@dataclass(frozen=True)
+class Format:
+    """
+    How an export lays out and writes posts, and what other files it has:
+    get_post_dir(user) is the directory of posts, render_post(post) the content
+    of a post's file, and get_site_files(user) the (path, content) of others.
+    """
+
+    name: str
+    get_post_dir: Callable[[models.User], str]
+    render_post: Callable[[models.Post], str]
+    get_site_files: Callable[[models.User], list] = lambda user: []
+
+
+MARKDOWN = Format(
+    name="markdown",
+    get_post_dir=lambda user: "blog",
+    render_post=post_with_frontmatter,
+)
+HUGO = Format(
+    name="hugo",
+    get_post_dir=lambda user: "content/blog",
+    render_post=post_with_frontmatter,
+    get_site_files=get_hugo_site_files,
+)
+MAIL = Format(
+    name="mail",
+    get_post_dir=lambda user: f"{user.username}-mataroa-blog",
+    render_post=post_as_markdown,
+)
+
+
+def get_export_name(export_format):
+    return f"export-{export_format.name}-{str(uuid.uuid4())[:8]}"
+
+
+def get_posts(user):
+    return (
+        models.Post.objects.filter(owner=user)
+        .only("title", "slug", "body", "published_at", "created_at")
+        .order_by("id")
+        .iterator(chunk_size=500)
+    )
+
+
+def get_files(user, export_format, export_name):
+    """Yield the (name, content) pairs of the export's archive."""
+    site_files = (
+        (f"{export_name}/{path}", content)
+        for path, content in export_format.get_site_files(user)
+    )
+    post_dir = f"{export_name}/{export_format.get_post_dir(user)}"
+    post_files = (
+        (f"{post_dir}/{post.slug}.md", export_format.render_post(post))
+        for post in get_posts(user)
+    )
+    return itertools.chain(site_files, post_files)
+
+
+def write_zip(files, file):
+    """Write a zip archive of (name, content) pairs to a file object."""
+    for chunk in util.stream_zip(files):
+        file.write(chunk)
@@ -3,28 +3,33 @@ from datetime import datetime
 from django.contrib.syndication.views import Feed
 from django.http import Http404
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.utils.feedgenerator import Atom1Feed
 
-from main import models
+from main import analytics, models
+from main.pagecache import cache_blog_page, record_page_hit
 
 MAX_ENTRIES = 15
 
+
 class RSSBlogFeed(Feed):
     title = ""
     link = ""
     description = ""
     subdomain = ""
+    analytic_path = "rss"
 
+    @method_decorator(cache_blog_page(record_hit=record_page_hit))
     def __call__(self, request, *args, **kwargs):
         if not hasattr(request, "subdomain"):
             raise Http404()
-        user = models.User.objects.get(username=request.subdomain)
+        user = request.blog_user
         self.title = user.blog_title
         self.description = user.blog_byline_as_text
         self.subdomain = request.subdomain
         self.link = user.blog_url
 
-        models.AnalyticPage.objects.create(user=user, path="rss")
+        analytics.record_page(user, self.analytic_path)
 
         return super().__call__(request, *args, **kwargs)
 
@@ -52,12 +57,4 @@ class RSSBlogFeed(Feed):
 class AtomBlogFeed(RSSBlogFeed):
     feed_type = Atom1Feed
     subtitle = RSSBlogFeed.description
-
-    def __call__(self, request, *args, **kwargs):
-        if not hasattr(request, "subdomain"):
-            raise Http404()
-
-        user = models.User.objects.get(username=request.subdomain)
-        models.AnalyticPage.objects.create(user=user, path="atom")
-
-        return super().__call__(request, *args, **kwargs)
+    analytic_path = "atom"
@@ -1,7 +1,10 @@
+from datetime import UTC
+
 from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import UserCreationForm as DjUserCreationForm
 from django.core import validators as dj_validators
+from django.utils import timezone
 
 from main import models
 
@@ -61,3 +64,68 @@ class APIPost(forms.Form):
     slug = forms.SlugField(max_length=300, required=False)
     body = forms.CharField(widget=forms.Textarea, required=False)
     published_at = forms.DateField(required=False)
+
+
+class APIBatchOperation(APIPost):
+    """
+    Operation in a batch request to the API: a post to create, or the post of
+    given slug to update or delete. Updates rename posts with new_slug.
+    """
+
+    op = forms.ChoiceField(
+        choices=[("create", "create"), ("update", "update"), ("delete", "delete")]
+    )
+    new_slug = forms.SlugField(max_length=300, required=False)
+
+    def clean(self):
+        op = self.cleaned_data.get("op")
+        if op == "create" and "title" not in self.data:
+            raise forms.ValidationError("Title field is required.")
+        if op in ["update", "delete"] and not self.cleaned_data.get("slug"):
+            raise forms.ValidationError("Slug field is required.")
+        return self.cleaned_data
+
+
+class APIPostList(forms.Form):
+    """Query parameters of the post list in the API."""
+
+    # fields of listed posts clients can ask for
+    FIELDS = ["title", "slug", "body", "published_at", "url"]
+
+    limit = forms.IntegerField(min_value=1, max_value=1000, required=False)
+    cursor = forms.IntegerField(min_value=0, required=False)
+    fields = forms.CharField(required=False)
+
+    def clean_fields(self):
+        fields = self.cleaned_data["fields"]
+        if not fields:
+            return self.FIELDS
+        fields = fields.split(",")
+        if not set(fields) <= set(self.FIELDS):
+            raise forms.ValidationError("Unknown fields.")
+        return fields
+
+
+class APIPostChanges(APIPostList):
+    """Query parameters of the post changes in the API."""
+
+    FIELDS = [*APIPostList.FIELDS, "updated_at"]
+
+    limit = None
+    cursor = None
+    since = forms.DateTimeField(required=False)
+
+    def clean_since(self):
+        # sync tokens are naive UTC, like all stored times
+        since = self.cleaned_data["since"]
+        if since is not None and timezone.is_aware(since):
+            return timezone.make_naive(since, UTC)
+        return since
+
+
+class ExportPrintForm(forms.Form):
+    """Query parameters of the print export: a page, and a publication range."""
+
+    page = forms.IntegerField(min_value=1, required=False)
+    since = forms.DateField(required=False)
+    until = forms.DateField(required=False)
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from main import models, util
+
+
+class Command(BaseCommand):
+    help = "Index which images each post and page uses, from their bodies."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of rows to load and update per query. Default: 500.",
+        )
+
+    def index_model(self, model, batch_size):
+        queryset = model.objects.only("id", "body").order_by("id")
+        count_refs = 0
+        batch = []
+        for obj in queryset.iterator(chunk_size=batch_size):
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                count_refs += util.set_image_refs(model, batch)
+                batch = []
+        if batch:
+            count_refs += util.set_image_refs(model, batch)
+        return count_refs
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Indexing images used by posts and pages."))
+
+        count_posts = self.index_model(models.Post, options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count_posts} post images."))
+
+        count_pages = self.index_model(models.Page, options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count_pages} page images."))
+
+        count_unused = models.Image.objects.unreferenced().count()
+        self.stdout.write(
+            self.style.NOTICE(
+                f"{count_unused} images are not used by any post or page."
+            )
+        )
@@ -1,6 +1,6 @@
-import io
-import uuid
-import zipfile
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
 from django.conf import settings
@@ -8,7 +8,7 @@ from django.core import mail
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
-from main import models, util
+from main import exports, models, util
 
 
 def get_mail_connection():
@@ -43,74 +43,142 @@ Stop receiving exports:
     return body
 
 
+def get_email(user, export_name, zip_data):
+    today = datetime.now().date().isoformat()
+    return mail.EmailMessage(
+        subject=f"Mataroa export {today} — {user.username}.{settings.CANONICAL_HOST}",
+        body=get_email_body(user),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email],
+        headers={
+            "X-PM-Message-Stream": "exports",  # postmark-specific header
+            "List-Unsubscribe": get_unsubscribe_url(user),
+            "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+        },
+        attachments=[(f"{export_name}.zip", zip_data, "application/zip")],
+    )
+
+
+class ExportMailer:
+    """
+    Emails zipped exports from worker threads, each sending over its own
+    connection, which stays open for all the exports the thread sends.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = get_mail_connection()
+            with self.lock:
+                self.connections.append(self.local.connection)
+        # reopens the connection if a failure closed it
+        self.local.connection.open()
+        return self.local.connection
+
+    def send(self, user, export_name, zip_file):
+        # the archive is only in memory as the attachment, while it is sent
+        with zip_file:
+            zip_file.seek(0)
+            email = get_email(user, export_name, zip_file.read())
+
+        connection = self.get_connection()
+        try:
+            connection.send_messages([email])
+        except Exception:
+            connection.close()
+            raise
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
 class Command(BaseCommand):
     help = "Generate zip account exports and email them to users."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Send this month's exports not sent yet, on any day of the month.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of exports to send at once. Default: 4.",
+        )
+
+    def get_users(self):
+        """Users with exports on that have not been sent one this month."""
+        month_start = timezone.now().replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        return (
+            models.User.objects.filter(mail_export_on=True)
+            .exclude(exportrecord__sent_at__gte=month_start)
+            .order_by("id")
+        )
+
+    def log_sent(self, future, user, export_name):
+        try:
+            future.result()
+        except Exception as ex:
+            msg = f"Failed to send export to {user.username}: {ex}"
+            self.stdout.write(self.style.ERROR(msg))
+            return
+        self.stdout.write(self.style.SUCCESS(f"Export sent to {user.username}."))
+
+        # log export record, so that it is not sent again this month
+        name = f"{export_name}.zip"
+        record = models.ExportRecord.objects.create(name=name, user=user)
+        self.stdout.write(
+            self.style.SUCCESS(f"Logging export record for '{record.name}'.")
+        )
+
     def handle(self, *args, **options):
-        if timezone.now().day != 1:
+        if timezone.now().day != 1 and not options["resume"]:
             msg = "No action. Not the first day of the month."
             self.stdout.write(self.style.NOTICE(msg))
             return
 
         self.stdout.write(self.style.NOTICE("Processing email exports."))
 
-        # gather all user posts for all users
-        users = models.User.objects.filter(mail_export_on=True)
-        for user in users:
-            self.stdout.write(self.style.NOTICE(f"Processing user {user.username}."))
-
-            user_posts = models.Post.objects.filter(owner=user)
-            export_posts = []
-            for p in user_posts:
-                pub_date = p.published_at or p.created_at
-                title = p.slug + ".md"
-                body = (
-                    f"# {p.title}\n\n"
-                    f"> Published on {pub_date.strftime('%b %-d, %Y')}\n\n"
-                    f"{p.body}\n"
-                )
-                export_posts.append((title, io.BytesIO(body.encode())))
-
-            # write zip archive in /tmp/
-            export_name = "export-markdown-" + str(uuid.uuid4())[:8]
-            container_dir = f"{user.username}-mataroa-blog"
-            zip_outfile = f"/tmp/{export_name}.zip"
-            with zipfile.ZipFile(
-                zip_outfile, "a", zipfile.ZIP_DEFLATED, False
-            ) as export_archive:
-                for file_name, data in export_posts:
-                    export_archive.writestr(
-                        export_name + f"/{container_dir}/" + file_name, data.getvalue()
-                    )
-
-            # reopen zipfile and load in memory
-            with open(zip_outfile, "rb") as f:
-                # create emails
-                today = datetime.now().date().isoformat()
-                email = mail.EmailMessage(
-                    subject=f"Mataroa export {today} — {user.username}.{settings.CANONICAL_HOST}",
-                    body=get_email_body(user),
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    to=[user.email],
-                    headers={
-                        "X-PM-Message-Stream": "exports",  # postmark-specific header
-                        "List-Unsubscribe": get_unsubscribe_url(user),
-                        "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
-                    },
-                    attachments=[(f"{export_name}.zip", f.read(), "application/zip")],
+        mailer = ExportMailer()
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for user in self.get_users():
+                self.stdout.write(
+                    self.style.NOTICE(f"Processing user {user.username}.")
                 )
 
-            # sent out messages
-            connection = get_mail_connection()
-            connection.send_messages([email])
-            self.stdout.write(self.style.SUCCESS(f"Export sent to {user.username}."))
-
-            # log export record
-            name = f"{export_name}.zip"
-            record = models.ExportRecord.objects.create(name=name, user=user)
-            self.stdout.write(
-                self.style.SUCCESS(f"Logging export record for '{record.name}'.")
-            )
+                # at most one export per worker is waiting to be sent
+                if len(in_flight) >= options["workers"]:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.log_sent(future, *in_flight.pop(future))
+
+                # zipped here, as database connections stay on this thread, to
+                # a file so that posts are never all in memory. mailer.send
+                # closes it
+                export_name = exports.get_export_name(exports.MAIL)
+                zip_file = tempfile.TemporaryFile()  # noqa: SIM115
+                try:
+                    files = exports.get_files(user, exports.MAIL, export_name)
+                    exports.write_zip(files, zip_file)
+                except Exception:
+                    zip_file.close()
+                    raise
+                future = executor.submit(mailer.send, user, export_name, zip_file)
+                in_flight[future] = (user, export_name)
+
+            for future, (user, export_name) in in_flight.items():
+                self.log_sent(future, user, export_name)
+        mailer.close()
 
         # log all users mailing is complete
         self.stdout.write(self.style.SUCCESS("Emailing all exports complete."))
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main import models, variants
+
+
+class Command(BaseCommand):
+    help = "Make smaller variants of images that do not have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Remake the variants of all images, eg. after changing widths.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Number of images to load per query. Default: 50.",
+        )
+
+    def make_batch(self, images):
+        count_made = 0
+        made_ids = []
+        for image in images:
+            try:
+                count_made += variants.make(image)
+            except FileNotFoundError:
+                self.stderr.write(f"Missing file of image {image.slug}, skipping.")
+            except variants.RESIZE_ERRORS as ex:
+                self.stderr.write(f"Failed to resize image {image.slug}: {ex}")
+            else:
+                made_ids.append(image.id)
+        # failed images are retried on the next run
+        models.Image.objects.filter(id__in=made_ids).update(
+            variants_made_at=timezone.now()
+        )
+        return count_made
+
+    def handle(self, *args, **options):
+        queryset = models.Image.objects.with_data().filter(
+            extension__in=variants.SOURCE_EXTENSIONS
+        )
+        if not options["all"]:
+            queryset = queryset.filter(variants_made_at__isnull=True)
+
+        count_images = 0
+        count_made = 0
+        last_id = 0
+        while True:
+            images = list(
+                queryset.filter(id__gt=last_id).order_by("id")[: options["batch_size"]]
+            )
+            if not images:
+                break
+            count_made += self.make_batch(images)
+            count_images += len(images)
+            last_id = images[-1].id
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Made {count_made} variants of {count_images} images.")
+        )
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+
+from main import models, storage
+
+
+class Command(BaseCommand):
+    help = "Move image data between the database and the filesystem, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--to",
+            choices=[storage.FILESYSTEM, storage.DATABASE],
+            default=storage.FILESYSTEM,
+            help="Storage to move images to. Default: filesystem.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of images to load and update per query. Default: 100.",
+        )
+
+    def move_batch(self, images, target):
+        moved = []
+        for image in images:
+            try:
+                data = storage.read(image)
+            except FileNotFoundError:
+                self.stderr.write(f"Missing file of image {image.slug}, skipping.")
+                continue
+            previous_path = storage.get_path(image)
+            previous_storage = image.storage
+            storage.store(image, data, target)
+            moved.append((image, previous_storage, previous_path))
+
+        # files are written before rows point at them, and deleted after rows
+        # stop pointing at them, so an interrupted run can just be run again
+        models.Image.objects.bulk_update([m[0] for m in moved], ["data", "storage"])
+        for image, previous_storage, previous_path in moved:
+            # only clears this process' cache: others find the image moved when
+            # serving it, see main.views.general.serve_image
+            storage.forget_info(image.slug)
+            if previous_storage == storage.FILESYSTEM:
+                previous_path.unlink(missing_ok=True)
+        return len(moved)
+
+    def handle(self, *args, **options):
+        target = options["to"]
+        self.stdout.write(self.style.NOTICE(f"Moving images to {target}."))
+
+        count_moved = 0
+        last_id = 0
+        while True:
+            images = list(
+                models.Image.objects.with_data()
+                .filter(id__gt=last_id)
+                .exclude(storage=target)
+                .order_by("id")[: options["batch_size"]]
+            )
+            if not images:
+                break
+            count_moved += self.move_batch(images, target)
+            last_id = images[-1].id
+            self.stdout.write(self.style.NOTICE(f"Moved {count_moved} images."))
+
+        self.stdout.write(self.style.SUCCESS(f"Moved {count_moved} images."))
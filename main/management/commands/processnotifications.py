@@ -1,9 +1,15 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 
 from django.conf import settings
 from django.core import mail
 from django.core.management.base import BaseCommand
 from django.utils import timezone
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
 
 from main import models, util
 
@@ -19,10 +25,9 @@ def get_mail_connection():
     )
 
 
-def get_email_body(post, notification):
+def get_email_body(post, unsubscribe_url):
     """Returns the email body (which contains the post body) along with titles and links."""
     post_url = util.get_protocol() + post.get_proper_url()
-    unsubscribe_url = util.get_protocol() + notification.get_unsubscribe_url()
     blog_title = post.owner.blog_title or post.owner.username
 
     body = f"""{blog_title} has published:
@@ -46,28 +51,108 @@ Unsubscribe:
     return body
 
 
-def get_email(post, notification):
-    """Returns the email object, containing all info needed to be sent."""
-
-    blog_title = post.owner.username
-    # email sender name cannot contain commas
-    if post.owner.blog_title and "," not in post.owner.blog_title:
-        blog_title = post.owner.blog_title
-
-    unsubscribe_url = util.get_protocol() + notification.get_unsubscribe_url()
-    body = get_email_body(post, notification)
-    email = mail.EmailMessage(
-        subject=post.title,
-        body=body,
-        from_email=f"{blog_title} <{post.owner.username}@{settings.EMAIL_FROM_HOST}>",
-        to=[notification.email],
-        headers={
-            "X-PM-Message-Stream": "newsletters",
-            "List-Unsubscribe": unsubscribe_url,
-            "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
-        },
+def get_email_html(post, unsubscribe_url):
+    """Returns the HTML version of the email body, from the post's stored HTML."""
+    post_url = util.get_protocol() + post.get_proper_url()
+    blog_title = post.owner.blog_title or post.owner.username
+    return format_html(
+        """<p>{} has published:</p>
+<h1><a href="{}">{}</a></h1>
+{}
+<hr>
+<p><a href="{}">Unsubscribe</a></p>
+""",
+        blog_title,
+        post_url,
+        post.title,
+        mark_safe(post.body_as_html),
+        unsubscribe_url,
     )
-    return email
+
+
+class PostEmail:
+    """
+    The newsletter email of a post. Everything but the unsubscribe URL is the
+    same for all subscribers, so it is rendered once, and get_email only puts
+    each subscriber's URL in.
+    """
+
+    def __init__(self, post, html=False):
+        # stands in for the unsubscribe URL in the rendered bodies
+        marker = f"unsubscribe-{uuid.uuid4().hex}"
+        self.body_parts = get_email_body(post, marker).split(marker)
+        self.html_parts = get_email_html(post, marker).split(marker) if html else None
+
+        blog_title = post.owner.username
+        # email sender name cannot contain commas
+        if post.owner.blog_title and "," not in post.owner.blog_title:
+            blog_title = post.owner.blog_title
+        self.from_email = (
+            f"{blog_title} <{post.owner.username}@{settings.EMAIL_FROM_HOST}>"
+        )
+        self.subject = post.title
+
+    def get_email(self, notification):
+        """Returns the email object, containing all info needed to be sent."""
+        unsubscribe_url = util.get_protocol() + notification.get_unsubscribe_url()
+        email = mail.EmailMultiAlternatives(
+            subject=self.subject,
+            body=unsubscribe_url.join(self.body_parts),
+            from_email=self.from_email,
+            to=[notification.email],
+            headers={
+                "X-PM-Message-Stream": "newsletters",
+                "List-Unsubscribe": unsubscribe_url,
+                "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+            },
+        )
+        if self.html_parts:
+            html = escape(unsubscribe_url).join(self.html_parts)
+            email.attach_alternative(html, "text/html")
+        return email
+
+
+class RateLimiter:
+    """Let through at most rate calls of wait() per second, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_at, now)
+            self.next_at = wait_until + self.interval
+        time.sleep(wait_until - now)
+
+
+def send_batch(emails, rate_limiter):
+    """
+    Send (record id, email) pairs over one connection, in a worker thread.
+    Return the ids of records sent, and (record id, exception) of failures.
+    """
+    sent_ids = []
+    failures = []
+    connection = get_mail_connection()
+    try:
+        for record_id, email in emails:
+            rate_limiter.wait()
+            try:
+                # reopens the connection if a failure closed it
+                connection.open()
+                connection.send_messages([email])
+            except Exception as ex:
+                failures.append((record_id, ex))
+                connection.close()
+            else:
+                sent_ids.append(record_id)
+    finally:
+        connection.close()
+    return sent_ids, failures
 
 
 class Command(BaseCommand):
@@ -81,81 +166,168 @@ class Command(BaseCommand):
             help="No dry run. Send actual emails.",
         )
         parser.set_defaults(dryrun=True)
+        parser.add_argument(
+            "--html",
+            action="store_true",
+            help="Also send posts as HTML, from their stored rendered body.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of threads sending emails, each over its own connection. "
+            "Default: 4.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of emails a thread sends over one connection. Default: 100.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=20,
+            help="Most emails to send per second, 0 for no limit. Default: 20.",
+        )
+
+    def get_posts(self):
+        """
+        Posts published yesterday, and earlier posts whose broadcast has pending
+        records, left by a run that failed to send some or crashed.
+        """
+        yesterday = timezone.now().date() - timedelta(days=1)
+        pending_post_ids = models.NotificationRecord.objects.filter(
+            sent_at__isnull=True
+        ).values("post_id")
+        # a union rather than an OR, so that each side can use its index
+        post_ids = (
+            models.Post.objects.filter(
+                broadcasted_at__isnull=True, published_at=yesterday
+            )
+            .values("id")
+            .union(
+                models.Post.objects.filter(
+                    broadcasted_at__isnull=True, id__in=pending_post_ids
+                ).values("id")
+            )
+        )
+        return (
+            models.Post.objects.filter(id__in=post_ids, owner__notifications_on=True)
+            .select_related("owner")
+            .order_by("id")
+        )
+
+    def get_subscribers(self, blog_user):
+        notifications = list(
+            models.Notification.objects.filter(blog_user=blog_user, is_active=True)
+        )
+        for notification in notifications:
+            notification.blog_user = blog_user
+        return notifications
+
+    def get_pending_records(self, post, notifications):
+        """
+        Create a pending record for each subscriber not sent the post yet, and
+        return all pending records of the post.
+        """
+        models.NotificationRecord.objects.bulk_create(
+            [
+                models.NotificationRecord(
+                    notification=notification, post=post, sent_at=None
+                )
+                for notification in notifications
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        # unsubscribed since they were created
+        models.NotificationRecord.objects.filter(
+            post=post, sent_at__isnull=True
+        ).exclude(
+            notification__blog_user=post.owner, notification__is_active=True
+        ).delete()
+
+        # subscribers can come back since notifications were fetched, so they
+        # are fetched again along with the records
+        records = (
+            models.NotificationRecord.objects.filter(post=post, sent_at__isnull=True)
+            .select_related("notification")
+            .order_by("id")
+        )
+        for record in records:
+            record.notification.blog_user = post.owner
+        return records
+
+    def broadcast(self, executor, post, records, options):
+        """Send post to the subscribers of pending records. Return count sent."""
+        post_email = PostEmail(post, html=options["html"])
+        emails = [
+            (record.id, post_email.get_email(record.notification)) for record in records
+        ]
+        batch_size = options["batch_size"]
+        futures = [
+            executor.submit(send_batch, emails[i : i + batch_size], self.rate_limiter)
+            for i in range(0, len(emails), batch_size)
+        ]
+
+        records_by_id = {record.id: record for record in records}
+        count_sent = 0
+        count_failed = 0
+        for future in as_completed(futures):
+            sent_ids, failures = future.result()
+            models.NotificationRecord.objects.filter(id__in=sent_ids).update(
+                sent_at=timezone.now()
+            )
+            count_sent += len(sent_ids)
+            for record_id in sent_ids:
+                email = records_by_id[record_id].notification.email
+                msg = f"Email sent for '{post.title}' to '{email}'."
+                self.stdout.write(self.style.SUCCESS(msg))
+            count_failed += len(failures)
+            for record_id, ex in failures:
+                email = records_by_id[record_id].notification.email
+                msg = f"Failed to send '{post.title}' to {email}."
+                self.stdout.write(self.style.ERROR(msg))
+                self.stdout.write(self.style.ERROR(str(ex)))
+
+        # failed records stay pending, and are retried on the next run
+        if not count_failed:
+            models.Post.objects.filter(id=post.id).update(broadcasted_at=timezone.now())
+        return count_sent
 
     def handle(self, *args, **options):
         self.stdout.write(self.style.NOTICE("Processing notifications."))
 
-        yesterday = timezone.now().date() - timedelta(days=1)
-        post_list = models.Post.objects.filter(
-            owner__notifications_on=True,
-            broadcasted_at__isnull=True,
-            published_at=yesterday,
-        )
+        post_list = list(self.get_posts())
         self.stdout.write(self.style.NOTICE(f"Post count to process: {len(post_list)}"))
 
+        self.rate_limiter = RateLimiter(options["rate"])
+        subscribers = {}
         count_sent = 0
-        connection = get_mail_connection()
-
-        # for all posts that were published yesterday
-        for post in post_list:
-            # assume no notification will fail
-            no_send_failures = True
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for post in post_list:
+                if post.owner_id not in subscribers:
+                    subscribers[post.owner_id] = self.get_subscribers(post.owner)
+                notification_list = subscribers[post.owner_id]
+                msg = (
+                    f"Subscriber count for: '{post.title}' "
+                    f"(author: {post.owner.username}) is {len(notification_list)}."
+                )
+                self.stdout.write(self.style.NOTICE(msg))
 
-            notification_list = models.Notification.objects.filter(
-                blog_user=post.owner,
-                is_active=True,
-            )
-            msg = (
-                f"Subscriber count for: '{post.title}' (author: {post.owner.username})"
-                f" is {len(notification_list)}."
-            )
-            self.stdout.write(self.style.NOTICE(msg))
-            # for every email address subcribed to the post's blog owner
-            for notification in notification_list:
                 # don't send if dry run mode
                 if options["dryrun"]:
-                    msg = f"Would otherwise sent: '{post.title}' for '{notification.email}'."
-                    self.stdout.write(self.style.NOTICE(msg))
+                    for notification in notification_list:
+                        msg = (
+                            f"Would otherwise sent: '{post.title}' "
+                            f"for '{notification.email}'."
+                        )
+                        self.stdout.write(self.style.NOTICE(msg))
                     continue
 
-                # log record
-                record, created = models.NotificationRecord.objects.get_or_create(
-                    notification=notification,
-                    post=post,
-                )
-                # check if this post id has already been sent to this email
-                # could be because the published_at date has been changed
-                if created:
-                    # keep count of all emails of this run
-                    count_sent += 1
-
-                    # sent out email
-                    email = get_email(post, notification)
-                    try:
-                        connection.send_messages([email])
-                    except Exception as ex:
-                        no_send_failures = False
-                        msg = f"Failed to send '{post.title}' to {notification.email}."
-                        self.stdout.write(self.style.ERROR(msg))
-                        record.delete()
-                        self.stdout.write(self.style.ERROR(ex))
-
-                    msg = f"Email sent for '{post.title}' to '{notification.email}'."
-                    self.stdout.write(self.style.SUCCESS(msg))
-                else:
-                    msg = (
-                        f"No email sent for '{post.title}' to '{notification.email}'. "
-                        f"Email was sent {record.sent_at}"
-                    )
-                    self.stdout.write(self.style.NOTICE(msg))
-
-            # broadcast for this post done
-            if not options["dryrun"] and no_send_failures:
-                post.broadcasted_at = timezone.now()
-                post.save()
-
-        # broadcast for all posts done
-        connection.close()
+                records = self.get_pending_records(post, notification_list)
+                count_sent += self.broadcast(executor, post, records, options)
 
         # return if send mode is off
         if options["dryrun"]:
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the slugs of posts deleted longer ago than the API changes "
+        "accept sync tokens from."
+    )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=settings.POST_TOMBSTONE_RETENTION_DAYS)
+        count, _ = models.PostTombstone.objects.filter(deleted_at__lt=before).delete()
+        self.stdout.write(
+            self.style.SUCCESS(f"Deleted {count} post tombstones from before {before}.")
+        )
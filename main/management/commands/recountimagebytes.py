@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Recount the total size of each user's images, for the upload quota."
+
+    def handle(self, *args, **options):
+        image_bytes = (
+            models.Image.objects.filter(owner=OuterRef("id"))
+            .order_by()
+            .values("owner")
+            .annotate(total=Sum("size_bytes"))
+            .values("total")
+        )
+        count = (
+            models.User.objects.annotate(
+                counted=Coalesce(Subquery(image_bytes), Value(0))
+            )
+            .exclude(image_bytes=F("counted"))
+            .update(image_bytes=F("counted"))
+        )
+        self.stdout.write(self.style.SUCCESS(f"Image bytes recounted: {count} fixed."))
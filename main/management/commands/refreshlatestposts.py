@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Update the latest post of every author, for the landing page."
+
+    def handle(self, *args, **options):
+        # saving and deleting posts keeps these up to date, except for posts
+        # scheduled for a later day, which are only published when the day comes
+        models.LatestPost.objects.refresh()
+        count = models.LatestPost.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Latest posts of {count} authors."))
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Render and store the HTML of all post and page bodies that are stale."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-render all bodies, even those that are up to date.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of rows to load and update per query. Default: 500.",
+        )
+
+    def render_model(self, model, fields, force, batch_size):
+        queryset = model.objects.only("id", "body", "body_render_key").order_by("id")
+        count_rendered = 0
+        batch = []
+        for obj in queryset.iterator(chunk_size=batch_size):
+            if force:
+                obj.body_render_key = None
+            if obj.render_body():
+                batch.append(obj)
+            if len(batch) >= batch_size:
+                model.objects.bulk_update(batch, fields)
+                count_rendered += len(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, fields)
+            count_rendered += len(batch)
+        return count_rendered
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Rendering post and page bodies."))
+
+        count_posts = self.render_model(
+            models.Post,
+            ["body_html", "body_text", "body_render_key"],
+            options["force"],
+            options["batch_size"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Rendered {count_posts} posts."))
+
+        count_pages = self.render_model(
+            models.Page,
+            ["body_html", "body_render_key"],
+            options["force"],
+            options["batch_size"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Rendered {count_pages} pages."))
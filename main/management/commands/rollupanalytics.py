@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from main import analytics, models
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount daily analytics of past days from raw hits and delete raw hits "
+        "older than the retention period."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=2,
+            help="Number of past days to recount. Default: 2.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recount all past days that still have raw hits.",
+        )
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=settings.ANALYTICS_RETENTION_DAYS,
+            help="Delete raw hits older than this many days. "
+            f"Default: {settings.ANALYTICS_RETENTION_DAYS}.",
+        )
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        if options["retention_days"] <= options["days"]:
+            raise CommandError("--retention-days must be greater than --days.")
+
+        start_date = today - timedelta(days=options["days"])
+        if options["all"]:
+            oldest_dates = [
+                model.objects.aggregate(Min("created_at"))["created_at__min"]
+                for model in [models.AnalyticPage, models.AnalyticPost]
+            ]
+            oldest_dates = [d.date() for d in oldest_dates if d is not None]
+            if oldest_dates:
+                start_date = min(start_date, *oldest_dates)
+
+        self.stdout.write(
+            self.style.NOTICE(f"Recounting daily analytics since {start_date}.")
+        )
+        # today is kept up to date by each analytics flush
+        analytics.rollup(start_date, today)
+
+        before_date = today - timedelta(days=options["retention_days"])
+        count_deleted = analytics.compact(before_date)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {count_deleted} raw hits from before {before_date}."
+            )
+        )
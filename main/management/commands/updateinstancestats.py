@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Count instance statistics for the transparency page."
+
+    def handle(self, *args, **options):
+        stats = models.InstanceStats.objects.take()
+        # the page only shows the latest
+        models.InstanceStats.objects.exclude(id=stats.id).delete()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Instance stats updated: {stats.users} users, {stats.posts} posts."
+            )
+        )
@@ -1,12 +1,64 @@
+import hashlib
 from timeit import default_timer as timer
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404, HttpResponseBadRequest
-from django.shortcuts import redirect
+from django.shortcuts import get_object_or_404, redirect
+from django.utils.functional import SimpleLazyObject
 
 from main import denylist, models, util
 
 
+def get_host_cache_key(field, value):
+    """Return cache key for the blog user lookup of given field and value."""
+    digest = hashlib.sha256(value.encode()).hexdigest()
+    return f"host:{field}:{digest}"
+
+
+def get_blog_host(field, value):
+    """
+    Return the id, username, custom_domain and redirect_domain of the blog user
+    whose username or custom_domain (given as field) is value, or None. Misses
+    are cached as well as hits, and both are dropped when a user saves (see
+    main.signals) or after settings.HOST_CACHE_TIMEOUT.
+
+    Only these are cached: the cache is per worker, and other workers do not
+    see the saves that invalidate it, so the user itself is always read from
+    the database, see get_blog_user.
+    """
+    cache_key = get_host_cache_key(field, value)
+    blog_host = cache.get(cache_key, default=False)
+    if blog_host is not False:
+        return blog_host
+
+    blog_host = (
+        models.User.objects.filter(**{field: value})
+        .values("id", "username", "custom_domain", "redirect_domain")
+        .first()
+    )
+    cache.set(cache_key, blog_host, timeout=settings.HOST_CACHE_TIMEOUT)
+    return blog_host
+
+
+def get_blog_user(blog_host):
+    """
+    Return the blog user of a host, read from the database when first used.
+    A user deleted since the host was cached is a 404.
+    """
+    return SimpleLazyObject(lambda: get_object_or_404(models.User, id=blog_host["id"]))
+
+
+def invalidate_blog_user(*, username=None, custom_domain=None):
+    """Drop cached blog user lookups for given username and custom_domain."""
+    cache_keys = []
+    if username:
+        cache_keys.append(get_host_cache_key("username", username))
+    if custom_domain:
+        cache_keys.append(get_host_cache_key("custom_domain", custom_domain))
+    cache.delete_many(cache_keys)
+
+
 def host_middleware(get_response):
     def middleware(request):
         host = request.META.get("HTTP_HOST")
@@ -34,9 +86,12 @@ def host_middleware(get_response):
             # check if subdomain is disallowed
             if request.subdomain in denylist.DISALLOWED_USERNAMES:
                 return redirect(f"{util.get_protocol()}//{settings.CANONICAL_HOST}")
+
             # check if subdomain exists as blog
-            elif models.User.objects.filter(username=request.subdomain).exists():
-                request.blog_user = models.User.objects.get(username=request.subdomain)
+            blog_host = get_blog_host("username", request.subdomain)
+            if blog_host:
+                request.blog_user_id = blog_host["id"]
+                request.blog_user = get_blog_user(blog_host)
 
                 # redirect to custom and/or retired urls for cases:
                 # * logged out / anon users
@@ -46,15 +101,13 @@ def host_middleware(get_response):
                     and request.user.username != request.subdomain
                 ):
                     redir_domain = ""
-                    if request.blog_user.custom_domain:  # user has set custom domain
-                        redir_domain = (
-                            request.blog_user.custom_domain + request.path_info
-                        )
+                    if blog_host["custom_domain"]:  # user has set custom domain
+                        redir_domain = blog_host["custom_domain"] + request.path_info
 
                     # user has retired their mataroa blog, redirect to new domain
-                    if request.blog_user.redirect_domain:
+                    if blog_host["redirect_domain"]:
                         redir_domain = (
-                            request.blog_user.redirect_domain + request.path_info[5:]
+                            blog_host["redirect_domain"] + request.path_info[5:]
                         )
 
                     # if there is no protocol prefix,
@@ -66,15 +119,16 @@ def host_middleware(get_response):
                         return redirect(redir_domain)
             else:
                 raise Http404()
-        elif models.User.objects.filter(custom_domain=host).exists():
+        elif blog_host := get_blog_host("custom_domain", host):
             # custom domain case
-            request.blog_user = models.User.objects.get(custom_domain=host)
-            request.subdomain = request.blog_user.username
+            request.blog_user_id = blog_host["id"]
+            request.blog_user = get_blog_user(blog_host)
+            request.subdomain = blog_host["username"]
 
             # if user has retired their mataroa blog (and keeps the custom domain)
             # redirect to new domain
-            if request.blog_user.redirect_domain:
-                redir_domain = request.blog_user.redirect_domain + request.path_info[5:]
+            if blog_host["redirect_domain"]:
+                redir_domain = blog_host["redirect_domain"] + request.path_info[5:]
 
                 # if there is no protocol prefix,
                 # prepend double slashes to indicate other domain
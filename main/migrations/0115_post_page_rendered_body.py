@@ -0,0 +1,41 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0114_remove_analyticpage_referer_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="body_html",
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="page",
+            name="body_render_key",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="body_html",
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="body_render_key",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="body_text",
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0115_post_page_rendered_body"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="analyticpage",
+            name="created_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+        migrations.AlterField(
+            model_name="analyticpost",
+            name="created_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
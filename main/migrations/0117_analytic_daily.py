@@ -0,0 +1,92 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0116_analytic_created_at_default"),
+    ]
+
+    def backfill_daily(apps, schema_editor):
+        for raw_name, daily_name, fields in [
+            ("AnalyticPage", "AnalyticPageDaily", ["user_id", "path"]),
+            ("AnalyticPost", "AnalyticPostDaily", ["post_id"]),
+        ]:
+            Raw = apps.get_model("main", raw_name)
+            Daily = apps.get_model("main", daily_name)
+            rows = (
+                Raw.objects.annotate(date=TruncDate("created_at"))
+                .values(*fields, "date")
+                .annotate(count=Count("id"))
+                .order_by()
+            )
+            batch = []
+            for row in rows.iterator(chunk_size=5000):
+                batch.append(Daily(**row))
+                if len(batch) >= 5000:
+                    Daily.objects.bulk_create(batch)
+                    batch = []
+            Daily.objects.bulk_create(batch)
+
+    operations = [
+        migrations.CreateModel(
+            name="AnalyticPageDaily",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=300)),
+                ("date", models.DateField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-date"],
+                "unique_together": {("user", "path", "date")},
+            },
+        ),
+        migrations.CreateModel(
+            name="AnalyticPostDaily",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="main.post"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-date"],
+                "unique_together": {("post", "date")},
+            },
+        ),
+        migrations.RunPython(backfill_daily, reverse_code=migrations.RunPython.noop),
+    ]
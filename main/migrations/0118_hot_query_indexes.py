@@ -0,0 +1,59 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # build indexes without locking writes on large tables
+    atomic = False
+
+    dependencies = [
+        ("main", "0117_analytic_daily"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="analyticpage",
+            index=models.Index(fields=["created_at"], name="analyticpage_created_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="analyticpost",
+            index=models.Index(fields=["created_at"], name="analyticpost_created_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="notification",
+            index=models.Index(
+                condition=models.Q(("is_active", True)),
+                fields=["blog_user"],
+                name="notification_active_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="post",
+            index=models.Index(
+                fields=["owner", "-published_at", "-created_at"],
+                name="post_owner_published_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="post",
+            index=models.Index(
+                condition=models.Q(("broadcasted_at__isnull", True)),
+                fields=["published_at"],
+                name="post_unbroadcasted_idx",
+            ),
+        ),
+        # drop the owner index only once post_owner_published_idx replaces it
+        migrations.AlterField(
+            model_name="post",
+            name="owner",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0119_user_blog_modified_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="storage",
+            field=models.CharField(
+                choices=[("database", "Database"), ("filesystem", "Filesystem")],
+                default="database",
+                max_length=20,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="data",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0120_image_storage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="data_hash",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True
+            ),
+        ),
+    ]
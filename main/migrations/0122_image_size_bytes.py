@@ -0,0 +1,49 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:00
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Length
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0121_image_data_hash"),
+    ]
+
+    def backfill_sizes(apps, schema_editor):
+        Image = apps.get_model("main", "Image")
+        User = apps.get_model("main", "User")
+
+        Image.objects.filter(storage="database").update(size_bytes=Length("data"))
+        files = Image.objects.filter(storage="filesystem").only("slug", "extension")
+        for image in files.iterator(chunk_size=1000):
+            path = os.path.join(settings.IMAGE_ROOT, f"{image.slug}.{image.extension}")
+            if os.path.exists(path):
+                image.size_bytes = os.path.getsize(path)
+                image.save(update_fields=["size_bytes"])
+
+        image_bytes = (
+            Image.objects.filter(owner=OuterRef("id"))
+            .order_by()
+            .values("owner")
+            .annotate(total=Sum("size_bytes"))
+            .values("total")
+        )
+        User.objects.update(image_bytes=Coalesce(Subquery(image_bytes), 0))
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="size_bytes",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="image_bytes",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_sizes, migrations.RunPython.noop),
+    ]
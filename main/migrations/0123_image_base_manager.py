@@ -0,0 +1,16 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0122_image_size_bytes"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="image",
+            options={"base_manager_name": "objects", "ordering": ["-uploaded_at"]},
+        ),
+    ]
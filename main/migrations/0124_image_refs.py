@@ -0,0 +1,22 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0123_image_base_manager"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="images",
+            field=models.ManyToManyField(blank=True, editable=False, to="main.image"),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="images",
+            field=models.ManyToManyField(blank=True, editable=False, to="main.image"),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0124_image_refs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="variants_made_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
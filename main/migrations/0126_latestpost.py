@@ -0,0 +1,68 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0125_image_variants"),
+    ]
+
+    def fill_latest_posts(apps, schema_editor):
+        Post = apps.get_model("main", "Post")
+        LatestPost = apps.get_model("main", "LatestPost")
+
+        latest = (
+            Post.objects.filter(
+                published_at__isnull=False, published_at__lte=timezone.now().date()
+            )
+            .order_by("owner_id", "-published_at", "-id")
+            .distinct("owner_id")
+            .values_list("owner_id", "id", "published_at")
+        )
+        LatestPost.objects.bulk_create(
+            [
+                LatestPost(user_id=owner_id, post_id=post_id, published_at=date)
+                for owner_id, post_id, date in latest
+            ],
+            batch_size=1000,
+        )
+
+    operations = [
+        migrations.CreateModel(
+            name="LatestPost",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("published_at", models.DateField()),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="main.post",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-published_at", "-post_id"],
+                "indexes": [
+                    models.Index(
+                        fields=["-published_at", "-post_id"],
+                        name="latestpost_published_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill_latest_posts, migrations.RunPython.noop),
+    ]
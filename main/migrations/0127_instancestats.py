@@ -0,0 +1,43 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0126_latestpost"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InstanceStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("users", models.PositiveIntegerField()),
+                ("premium_users", models.PositiveIntegerField()),
+                ("posts", models.PositiveIntegerField()),
+                ("published_posts", models.PositiveIntegerField()),
+                ("pages", models.PositiveIntegerField()),
+                ("zero_users", models.PositiveIntegerField()),
+                ("one_users", models.PositiveIntegerField()),
+                ("twoplus_users", models.PositiveIntegerField()),
+                ("active_users", models.PositiveIntegerField()),
+                ("active_nonnew_users", models.PositiveIntegerField()),
+                ("new_users_per_day", models.JSONField(default=list)),
+            ],
+            options={
+                "verbose_name_plural": "instance stats",
+                "ordering": ["-created_at"],
+                "get_latest_by": "created_at",
+            },
+        ),
+    ]
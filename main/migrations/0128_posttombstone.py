@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0127_instancestats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PostTombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("slug", models.CharField(max_length=300)),
+                ("deleted_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["deleted_at"],
+                "indexes": [
+                    models.Index(
+                        fields=["owner", "deleted_at"], name="posttombstone_owner_idx"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -2,15 +2,17 @@ import base64
 import binascii
 import os
 import uuid
+from datetime import timedelta
 
 import bleach
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import TruncDay
 from django.urls import reverse
 from django.utils import timezone
 
-from main import util, validators
+from main import storage, util, validators
 
 
 def _generate_key():
@@ -120,6 +122,12 @@ class User(AbstractUser):
     # moderation
     is_approved = models.BooleanField(default=False)
 
+    # last change to anything the blog shows, see main.pagecache
+    blog_modified_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    # total size of uploaded images, kept up to date by main.signals
+    image_bytes = models.PositiveBigIntegerField(default=0, editable=False)
+
     class Meta:
         ordering = ["-id"]
 
@@ -168,6 +176,24 @@ class User(AbstractUser):
             return "💠"
         return "∅"
 
+    def save(self, *args, **kwargs):
+        # image_bytes is only changed by F() updates (see main.signals), so a
+        # full save of an instance loaded earlier must not write it back
+        if (
+            not self._state.adding
+            and not kwargs.get("force_insert")
+            and kwargs.get("update_fields") is None
+        ):
+            deferred_fields = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name != "image_bytes"
+                and field.attname not in deferred_fields
+            ]
+        super().save(*args, **kwargs)
+
     def get_export_unsubscribe_url(self):
         domain = self.custom_domain or f"{self.username}.{settings.CANONICAL_HOST}"
         path = reverse("export_unsubscribe_key", args={self.export_unsubscribe_key})
@@ -185,7 +211,13 @@ class Post(models.Model):
     title = models.CharField(max_length=300)
     slug = models.CharField(max_length=300)
     body = models.TextField(blank=True, null=True)
-    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    body_html = models.TextField(blank=True, null=True, editable=False)
+    body_text = models.TextField(blank=True, null=True, editable=False)
+    body_render_key = models.CharField(
+        max_length=64, blank=True, null=True, editable=False
+    )
+    # indexed first in post_owner_published_idx
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     published_at = models.DateField(
@@ -195,19 +227,35 @@ class Post(models.Model):
         help_text="Leave blank to keep as draft/unpublished. Use a future date for auto-posting.",
     )
     broadcasted_at = models.DateTimeField(blank=True, null=True, default=None)
+    # images whose raw URL is in body, see update_image_refs
+    images = models.ManyToManyField("Image", blank=True, editable=False)
 
     class Meta:
         ordering = ["-published_at", "-created_at"]
         unique_together = [["slug", "owner"]]
+        indexes = [
+            # blog index, feeds, and sitemap: a blog's posts, newest first
+            models.Index(
+                fields=["owner", "-published_at", "-created_at"],
+                name="post_owner_published_idx",
+            ),
+            # processnotifications: posts published on a day not yet broadcast
+            models.Index(
+                fields=["published_at"],
+                condition=models.Q(broadcasted_at__isnull=True),
+                name="post_unbroadcasted_idx",
+            ),
+        ]
 
     @property
     def body_as_html(self):
-        return util.md_to_html(self.body)
+        self.render_body()
+        return self.body_html
 
     @property
     def body_as_text(self):
-        as_html = util.md_to_html(self.body)
-        return bleach.clean(as_html, strip=True, tags=[])
+        self.render_body()
+        return self.body_text
 
     @property
     def is_draft(self):
@@ -223,6 +271,41 @@ class Post(models.Model):
             return False
         return True
 
+    def render_body(self):
+        """
+        Store rendered HTML and text of body, unless they are up to date.
+        Returns true if they were re-rendered.
+        """
+        render_key = util.get_render_key(self.body)
+        if self.body_render_key == render_key:
+            return False
+        self.body_html = util.render_markdown(self.body)
+        self.body_text = util.html_to_text(self.body_html)
+        self.body_render_key = render_key
+        return True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        # the body changed if it had to be rendered again
+        body_changed = False
+        if update_fields is None:
+            body_changed = self.render_body()
+        elif "body" in update_fields and self.render_body():
+            body_changed = True
+            kwargs["update_fields"] = [
+                *update_fields,
+                "body_html",
+                "body_text",
+                "body_render_key",
+            ]
+        super().save(*args, **kwargs)
+        if body_changed:
+            self.update_image_refs()
+
+    def update_image_refs(self):
+        refs = util.get_image_refs(self.body)
+        self.images.set(Image.objects.referenced_by(refs).values_list("id", flat=True))
+
     def get_absolute_url(self):
         path = reverse("post_detail", kwargs={"slug": self.slug})
         return f"//{self.owner.username}.{settings.CANONICAL_HOST}{path}"
@@ -239,16 +322,144 @@ class Post(models.Model):
         return self.title
 
 
+class PostTombstone(models.Model):
+    """
+    The slug of a deleted post, or the previous slug of a renamed one, so that
+    API clients mirroring a blog see it is gone. See main.signals and
+    api_changes. Deleted after POST_TOMBSTONE_RETENTION_DAYS by the
+    prunetombstones command.
+    """
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    slug = models.CharField(max_length=300)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["deleted_at"]
+        indexes = [
+            models.Index(
+                fields=["owner", "deleted_at"], name="posttombstone_owner_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.owner_id}: {self.slug}"
+
+
+class LatestPostManager(models.Manager):
+    def refresh(self, owner_ids=None):
+        """
+        Point the rows of given owners, or of all if None, at their most recently
+        published post, and drop those of owners who have none.
+        """
+        posts = Post.objects.filter(
+            published_at__isnull=False, published_at__lte=timezone.now().date()
+        )
+        rows = self.all()
+        if owner_ids is not None:
+            posts = posts.filter(owner_id__in=owner_ids)
+            rows = rows.filter(user_id__in=owner_ids)
+        latest = (
+            posts.order_by("owner_id", "-published_at", "-id")
+            .distinct("owner_id")
+            .values_list("owner_id", "id", "published_at")
+        )
+        with transaction.atomic():
+            rows.exclude(user_id__in=posts.values("owner_id")).delete()
+            self.bulk_create(
+                [
+                    LatestPost(user_id=owner_id, post_id=post_id, published_at=date)
+                    for owner_id, post_id, date in latest
+                ],
+                batch_size=1000,
+                update_conflicts=True,
+                unique_fields=["user"],
+                update_fields=["post", "published_at"],
+            )
+
+
+class LatestPost(models.Model):
+    """
+    Each author's most recently published post, for the landing page. Kept up
+    to date when posts are saved or deleted (see main.signals), and daily by the
+    refreshlatestposts command for posts scheduled for that day.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="+")
+    published_at = models.DateField()
+
+    objects = LatestPostManager()
+
+    class Meta:
+        ordering = ["-published_at", "-post_id"]
+        indexes = [
+            models.Index(
+                fields=["-published_at", "-post_id"], name="latestpost_published_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.post.title}"
+
+
+class ImageQuerySet(models.QuerySet):
+    def with_data(self):
+        """Also load the data column, which is deferred by default."""
+        return self.defer(None)
+
+    def referenced_by(self, refs):
+        """
+        Images of given slug and extension pairs, see util.get_image_refs. An
+        extension of None matches images of any extension.
+        """
+        if not refs:
+            return self.none()
+        condition = models.Q()
+        for slug, extension in refs:
+            if extension is None:
+                condition |= models.Q(slug=slug)
+            else:
+                condition |= models.Q(slug=slug, extension=extension)
+        return self.filter(condition)
+
+    def unreferenced(self):
+        """Images not used by any post or page."""
+        return self.filter(post__isnull=True, page__isnull=True)
+
+
+class ImageManager(models.Manager.from_queryset(ImageQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().defer("data")
+
+
 class Image(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=300)  # original filename
     slug = models.CharField(max_length=300, unique=True)
-    data = models.BinaryField()
+    data = models.BinaryField(blank=True, null=True)
+    storage = models.CharField(
+        max_length=20,
+        choices=[
+            (storage.DATABASE, "Database"),
+            (storage.FILESYSTEM, "Filesystem"),
+        ],
+        default=storage.DATABASE,
+    )
+    # sha256 of data, the ETag of the image
+    data_hash = models.CharField(max_length=64, blank=True, null=True, editable=False)
+    size_bytes = models.PositiveIntegerField(default=0, editable=False)
+    # when variants were last made, see main.variants
+    variants_made_at = models.DateTimeField(blank=True, null=True, editable=False)
     extension = models.CharField(max_length=10)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ImageManager()
+
     class Meta:
         ordering = ["-uploaded_at"]
+        # also defer data when deleting images along with their owner
+        base_manager_name = "objects"
 
     @property
     def filename(self):
@@ -256,12 +467,12 @@ class Image(models.Model):
 
     @property
     def data_as_base64(self):
-        return base64.b64encode(self.data).decode("utf-8")
+        return base64.b64encode(storage.read(self)).decode("utf-8")
 
     @property
     def data_size(self):
         """Get image size in MB."""
-        return round(len(self.data) / (1024 * 1024), 2)
+        return round(self.size_bytes / (1024 * 1024), 2)
 
     @property
     def raw_url_absolute(self):
@@ -286,6 +497,10 @@ class Page(models.Model):
         help_text="Lowercase letters, numbers, and - (hyphen) allowed.",
     )
     body = models.TextField(blank=True, null=True)
+    body_html = models.TextField(blank=True, null=True, editable=False)
+    body_render_key = models.CharField(
+        max_length=64, blank=True, null=True, editable=False
+    )
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -293,6 +508,8 @@ class Page(models.Model):
         default=False,
         help_text="If checked, page link will not appear on the blog header.",
     )
+    # images whose raw URL is in body, see update_image_refs
+    images = models.ManyToManyField("Image", blank=True, editable=False)
 
     class Meta:
         ordering = ["slug"]
@@ -300,7 +517,37 @@ class Page(models.Model):
 
     @property
     def body_as_html(self):
-        return util.md_to_html(self.body)
+        self.render_body()
+        return self.body_html
+
+    def render_body(self):
+        """
+        Store rendered HTML of body, unless it is up to date.
+        Returns true if it was re-rendered.
+        """
+        render_key = util.get_render_key(self.body)
+        if self.body_render_key == render_key:
+            return False
+        self.body_html = util.render_markdown(self.body)
+        self.body_render_key = render_key
+        return True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        # the body changed if it had to be rendered again
+        body_changed = False
+        if update_fields is None:
+            body_changed = self.render_body()
+        elif "body" in update_fields and self.render_body():
+            body_changed = True
+            kwargs["update_fields"] = [*update_fields, "body_html", "body_render_key"]
+        super().save(*args, **kwargs)
+        if body_changed:
+            self.update_image_refs()
+
+    def update_image_refs(self):
+        refs = util.get_image_refs(self.body)
+        self.images.set(Image.objects.referenced_by(refs).values_list("id", flat=True))
 
     def get_absolute_url(self):
         path = reverse("page_detail", kwargs={"slug": self.slug})
@@ -313,10 +560,14 @@ class Page(models.Model):
 class AnalyticPage(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     path = models.CharField(max_length=300)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # rollupanalytics: raw hits of a day, and raw hits past retention
+            models.Index(fields=["created_at"], name="analyticpage_created_idx"),
+        ]
 
     def __str__(self):
         return self.created_at.strftime("%c") + ": " + self.user.username
@@ -324,15 +575,50 @@ class AnalyticPage(models.Model):
 
 class AnalyticPost(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # rollupanalytics: raw hits of a day, and raw hits past retention
+            models.Index(fields=["created_at"], name="analyticpost_created_idx"),
+        ]
 
     def __str__(self):
         return self.created_at.strftime("%c") + ": " + self.post.title
 
 
+class AnalyticPageDaily(models.Model):
+    """Count of AnalyticPage hits per user, path, and day."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    path = models.CharField(max_length=300)
+    date = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["user", "path", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.user.username} /{self.path}"
+
+
+class AnalyticPostDaily(models.Model):
+    """Count of AnalyticPost hits per post and day."""
+
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    date = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["post", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.post.title}"
+
+
 class Notification(models.Model):
     blog_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     email = models.EmailField()
@@ -342,6 +628,13 @@ class Notification(models.Model):
     class Meta:
         ordering = ["email"]
         unique_together = [["email", "blog_user"]]
+        indexes = [
+            models.Index(
+                fields=["blog_user"],
+                condition=models.Q(is_active=True),
+                name="notification_active_idx",
+            ),
+        ]
 
     def get_unsubscribe_url(self):
         domain = (
@@ -405,3 +698,82 @@ class Snapshot(models.Model):
 
     def __str__(self):
         return self.title
+
+
+class InstanceStatsManager(models.Manager):
+    def take(self):
+        """Count everything the transparency page shows, and save it as the latest."""
+        one_month_ago = timezone.now() - timedelta(days=30)
+        stats = InstanceStats(
+            **User.objects.aggregate(
+                users=models.Count("id"),
+                premium_users=models.Count("id", filter=models.Q(is_premium=True)),
+            ),
+            **Post.objects.aggregate(
+                posts=models.Count("id"),
+                published_posts=models.Count(
+                    "id", filter=models.Q(published_at__isnull=False)
+                ),
+            ),
+            pages=Page.objects.count(),
+            **User.objects.annotate(post_count=models.Count("post")).aggregate(
+                zero_users=models.Count("id", filter=models.Q(post_count=0)),
+                one_users=models.Count("id", filter=models.Q(post_count=1)),
+                twoplus_users=models.Count("id", filter=models.Q(post_count__gt=1)),
+            ),
+            **Post.objects.filter(updated_at__gt=one_month_ago).aggregate(
+                active_users=models.Count("owner", distinct=True),
+                active_nonnew_users=models.Count(
+                    "owner",
+                    distinct=True,
+                    filter=models.Q(owner__date_joined__lt=one_month_ago),
+                ),
+            ),
+        )
+        new_users_per_day = (
+            User.objects.annotate(date=TruncDay("date_joined"))
+            .values("date")
+            .annotate(count=models.Count("id"))
+            .order_by("-date")[:25]
+        )
+        stats.new_users_per_day = [
+            {"date": row["date"].date().isoformat(), "count": row["count"]}
+            for row in new_users_per_day
+        ]
+        stats.save()
+        return stats
+
+
+class InstanceStats(models.Model):
+    """
+    Snapshot of instance-wide counts for the transparency page, taken hourly
+    by the updateinstancestats command so that the page does not count them.
+    """
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    users = models.PositiveIntegerField()
+    premium_users = models.PositiveIntegerField()
+    posts = models.PositiveIntegerField()
+    published_posts = models.PositiveIntegerField()
+    pages = models.PositiveIntegerField()
+    zero_users = models.PositiveIntegerField()
+    one_users = models.PositiveIntegerField()
+    twoplus_users = models.PositiveIntegerField()
+    active_users = models.PositiveIntegerField()
+    active_nonnew_users = models.PositiveIntegerField()
+    # newest first, as {"date": "2024-01-31", "count": 3}
+    new_users_per_day = models.JSONField(default=list)
+
+    objects = InstanceStatsManager()
+
+    class Meta:
+        ordering = ["-created_at"]
+        get_latest_by = "created_at"
+        verbose_name_plural = "instance stats"
+
+    @property
+    def monthly_revenue(self):
+        return self.premium_users * 9 / 12
+
+    def __str__(self):
+        return self.created_at.strftime("%c")
@@ -0,0 +1,174 @@
+"""
+Whole response cache and conditional GET for anonymous reads of blogs.
+
+Anonymous blog responses get an ETag and a Last-Modified derived from the
+owner's blog_modified_at and the date of their latest published post. Saving or
+deleting a post, page, or the user bumps blog_modified_at (see main.signals),
+and a scheduled post changes the latest published date on its publication day.
+Both are read from the database with one query per request, along with the
+rest of the user, so they are the same in every worker.
+
+Responses are also cached per blog under a key made of the request host and
+path, the ETag, and today's date, so edits and scheduled posts show up
+immediately everywhere.
+
+Requests whose If-None-Match or If-Modified-Since match get a 304 before
+anything is rendered or read from the cache. Analytics hits recorded while
+rendering a response are stored along with it and recorded again every time it
+is served from the cache. A 304 records its hit itself, with the record_hit
+function the view is decorated with, eg. record_page_hit.
+"""
+
+import calendar
+import hashlib
+from datetime import datetime
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, Q
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from main import analytics, models
+
+
+def get_blog_validators(blog_user_id):
+    """
+    Return the blog user read from the database, with the ETag and
+    Last-Modified of their blog, or None if they are gone.
+    """
+    today = timezone.now().date()
+    blog_user = (
+        models.User.objects.filter(id=blog_user_id)
+        .annotate(
+            latest_published_at=Max(
+                "post__published_at", filter=Q(post__published_at__lte=today)
+            )
+        )
+        .first()
+    )
+    if blog_user is None:
+        return None
+    blog_modified_at = blog_user.blog_modified_at
+    published_at = blog_user.latest_published_at
+
+    last_modified = blog_modified_at
+    if published_at is not None:
+        last_modified = max(
+            last_modified, datetime.combine(published_at, datetime.min.time())
+        )
+    version = f"{blog_modified_at.isoformat()}:{published_at}"
+    etag = f'"{hashlib.sha256(version.encode()).hexdigest()[:32]}"'
+    return blog_user, etag, calendar.timegm(last_modified.utctimetuple())
+
+
+def get_cache_key(request, etag):
+    url = f"{request.get_host()}{request.get_full_path()}"
+    return ":".join(
+        [
+            "page",
+            hashlib.sha256(url.encode()).hexdigest(),
+            etag.strip('"'),
+            timezone.now().date().isoformat(),
+        ]
+    )
+
+
+def is_anonymous_read(request):
+    """Only anonymous reads of blogs without any messages to show qualify."""
+    return (
+        request.method in ("GET", "HEAD")
+        and hasattr(request, "blog_user")
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and "messages" not in request.COOKIES
+        and not request.user.is_authenticated
+    )
+
+
+def set_validators(response, etag, last_modified):
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+
+
+def record_page_hit(request):
+    """Record the hit of a 304 on a blog page: index, rss, atom or a page."""
+    analytics.record_page(request.blog_user, request.path.strip("/") or "index")
+
+
+def record_post_hit(request):
+    """Record the hit of a 304 on a blog post."""
+    post = (
+        models.Post.objects.filter(
+            owner=request.blog_user, slug=request.resolver_match.kwargs["slug"]
+        )
+        .only("id")
+        .first()
+    )
+    if post is not None:
+        analytics.record_post(post)
+
+
+def cache_blog_page(view_func=None, *, record_hit=None):
+    """
+    Serve anonymous reads of a blog view conditionally and from the cache.
+    record_hit(request) records the analytics hit of a 304, if any.
+    """
+    if view_func is None:
+        return partial(cache_blog_page, record_hit=record_hit)
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not is_anonymous_read(request):
+            return view_func(request, *args, **kwargs)
+
+        validators = get_blog_validators(request.blog_user_id)
+        if validators is None:
+            return view_func(request, *args, **kwargs)
+        # the user read along with the validators is the one views see
+        request.blog_user, etag, last_modified = validators
+
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if not_modified is not None:
+            if record_hit is not None:
+                record_hit(request)
+            set_validators(not_modified, etag, last_modified)
+            return not_modified
+
+        key = get_cache_key(request, etag)
+        cached = cache.get(key) if settings.PAGE_CACHE_TIMEOUT > 0 else None
+        if cached is not None:
+            analytics.replay(cached["hits"])
+            response = HttpResponse(cached["content"], status=cached["status"])
+            for header, value in cached["headers"]:
+                response.headers[header] = value
+            return response
+
+        with analytics.capture() as hits:
+            response = view_func(request, *args, **kwargs)
+            if hasattr(response, "render") and not response.is_rendered:
+                response.render()
+        if response.status_code != 200:
+            return response
+        set_validators(response, etag, last_modified)
+
+        if (
+            settings.PAGE_CACHE_TIMEOUT > 0
+            and not response.streaming
+            and not response.cookies
+            and not request.META.get("CSRF_COOKIE_NEEDS_UPDATE")
+        ):
+            cached = {
+                "content": response.content,
+                "status": response.status_code,
+                "headers": list(response.headers.items()),
+                "hits": hits,
+            }
+            cache.set(key, cached, settings.PAGE_CACHE_TIMEOUT)
+        return response
+
+    return wrapper
@@ -0,0 +1,154 @@
+import threading
+from contextlib import contextmanager
+
+from django.db.models import F, QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from main import middleware, models, storage, variants
+
+_bulk = threading.local()
+
+
+def is_user_deletion(origin):
+    """Whether a post_delete is of something deleted along with its user."""
+    if isinstance(origin, QuerySet):
+        return origin.model is models.User
+    return isinstance(origin, models.User)
+
+
+@contextmanager
+def bulk_post_deletion():
+    """
+    Skip the per-post receivers below for posts this thread deletes inside the
+    block, eg. in api.Batch, which does their work once for all posts.
+    """
+    _bulk.deleting_posts = True
+    try:
+        yield
+    finally:
+        _bulk.deleting_posts = False
+
+
+def is_bulk_post_deletion():
+    return getattr(_bulk, "deleting_posts", False)
+
+
+@receiver(pre_save, sender=models.User)
+def remember_user_hosts(sender, instance, update_fields=None, **kwargs):
+    """Keep the stored username and custom domain, in case they are changing."""
+    instance._previous_hosts = None
+    if instance.pk is None:
+        return
+    if update_fields is not None and not {"username", "custom_domain"} & set(
+        update_fields
+    ):
+        return
+    instance._previous_hosts = (
+        models.User.objects.filter(pk=instance.pk)
+        .values("username", "custom_domain")
+        .first()
+    )
+
+
+@receiver(post_save, sender=models.User)
+@receiver(post_delete, sender=models.User)
+def invalidate_user_hosts(sender, instance, **kwargs):
+    """Drop cached host lookups for both the current and previous hosts."""
+    middleware.invalidate_blog_user(
+        username=instance.username, custom_domain=instance.custom_domain
+    )
+    previous_hosts = getattr(instance, "_previous_hosts", None)
+    if previous_hosts:
+        middleware.invalidate_blog_user(**previous_hosts)
+
+
+def touch_blog(user_id):
+    """Mark a blog as modified, which invalidates its cached pages."""
+    models.User.objects.filter(id=user_id).update(blog_modified_at=timezone.now())
+
+
+@receiver(post_save, sender=models.Post)
+@receiver(post_delete, sender=models.Post)
+@receiver(post_save, sender=models.Page)
+@receiver(post_delete, sender=models.Page)
+def touch_owner_blog(sender, instance, origin=None, **kwargs):
+    # deleting a user deletes their posts and pages along with the blog
+    if is_user_deletion(origin) or is_bulk_post_deletion():
+        return
+    touch_blog(instance.owner_id)
+
+
+@receiver(post_save, sender=models.Post)
+@receiver(post_delete, sender=models.Post)
+def refresh_latest_post(sender, instance, origin=None, update_fields=None, **kwargs):
+    # deleting a user deletes their latest post row along with them
+    if is_user_deletion(origin) or is_bulk_post_deletion():
+        return
+    if update_fields is not None and "published_at" not in update_fields:
+        return
+    models.LatestPost.objects.refresh([instance.owner_id])
+
+
+@receiver(pre_save, sender=models.Post)
+def remember_post_slug(sender, instance, update_fields=None, **kwargs):
+    """Keep the stored slug, in case it is changing."""
+    instance._previous_slug = None
+    if instance.pk is None:
+        return
+    if update_fields is not None and "slug" not in update_fields:
+        return
+    instance._previous_slug = (
+        models.Post.objects.filter(pk=instance.pk)
+        .values_list("slug", flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=models.Post)
+def bury_previous_slug(sender, instance, **kwargs):
+    previous_slug = getattr(instance, "_previous_slug", None)
+    if previous_slug and previous_slug != instance.slug:
+        models.PostTombstone.objects.create(
+            owner_id=instance.owner_id, slug=previous_slug
+        )
+
+
+@receiver(post_delete, sender=models.Post)
+def bury_post(sender, instance, origin=None, **kwargs):
+    # deleting a user deletes the whole blog, tombstones included
+    if is_user_deletion(origin) or is_bulk_post_deletion():
+        return
+    models.PostTombstone.objects.create(owner_id=instance.owner_id, slug=instance.slug)
+
+
+@receiver(post_save, sender=models.User)
+def touch_user_blog(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    touch_blog(instance.id)
+
+
+@receiver(post_save, sender=models.Image)
+def count_image_bytes(sender, instance, created, **kwargs):
+    if created:
+        models.User.objects.filter(id=instance.owner_id).update(
+            image_bytes=F("image_bytes") + instance.size_bytes
+        )
+
+
+@receiver(post_delete, sender=models.Image)
+def uncount_image_bytes(sender, instance, origin=None, **kwargs):
+    if is_user_deletion(origin):
+        return
+    models.User.objects.filter(id=instance.owner_id).update(
+        image_bytes=F("image_bytes") - instance.size_bytes
+    )
+
+
+@receiver(post_delete, sender=models.Image)
+def delete_image_file(sender, instance, **kwargs):
+    storage.delete(instance)
+    variants.delete(instance)
+    storage.forget_info(instance.slug)
@@ -0,0 +1,91 @@
+"""
+Storage of uploaded image data.
+
+Each image records where its data lives in Image.storage:
+
+* "database": in the Image.data column, as mataroa always stored images.
+* "filesystem": in a file named after Image.filename under settings.IMAGE_ROOT,
+  which Caddy serves directly and the app otherwise serves with FileResponse.
+
+Image data never changes once uploaded, so it is served with long lived
+immutable cache headers and its sha256, Image.data_hash, as the ETag.
+
+New uploads go to settings.IMAGE_STORAGE. Both kinds can coexist, so the
+moveimages command can move existing images over in batches, in either
+direction.
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+DATABASE = "database"
+FILESYSTEM = "filesystem"
+
+
+def get_info_cache_key(slug):
+    """Cache key of what image_raw needs to know of an image besides its data."""
+    return f"image:{slug}"
+
+
+def forget_info(slug):
+    cache.delete(get_info_cache_key(slug))
+
+
+def get_path(image):
+    return Path(settings.IMAGE_ROOT) / image.filename
+
+
+def write_file(path, data):
+    """Write data to path atomically, so that readers never see partial files."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def store(image, data, storage=None):
+    """Set the data of an unsaved or saved image in given or default storage."""
+    storage = storage or settings.IMAGE_STORAGE
+    image.data_hash = hashlib.sha256(data).hexdigest()
+    image.size_bytes = len(data)
+    if storage == FILESYSTEM:
+        write_file(get_path(image), data)
+        image.data = None
+    else:
+        image.data = data
+    image.storage = storage
+
+
+def open_file(image):
+    """Return a binary file object of a filesystem image's data."""
+    return open(get_path(image), "rb")
+
+
+def read(image):
+    """Return the data of an image, wherever it is stored."""
+    if image.storage == FILESYSTEM:
+        with open_file(image) as image_file:
+            return image_file.read()
+    return bytes(image.data)
+
+
+def delete(image):
+    """Delete the file of a filesystem image once the deletion is committed."""
+    if image.storage != FILESYSTEM:
+        return
+    path = get_path(image)
+    transaction.on_commit(lambda: path.unlink(missing_ok=True))
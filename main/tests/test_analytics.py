@@ -1,8 +1,15 @@
+from datetime import date, datetime
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from main import models
+from main import analytics, models
+from main.views import general
 
 
 class PostAnalyticAnonTestCase(TestCase):
@@ -26,6 +33,7 @@ class PostAnalyticAnonTestCase(TestCase):
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
         self.assertEqual(response.status_code, 200)
+        analytics.flush()
         self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 1)
 
 
@@ -73,6 +81,7 @@ class PageAnalyticAnonTestCase(TestCase):
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
         self.assertEqual(response.status_code, 200)
+        analytics.flush()
         self.assertEqual(
             models.AnalyticPage.objects.filter(path=self.page.slug).count(), 1
         )
@@ -117,6 +126,7 @@ class PageAnalyticIndexTestCase(TestCase):
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
         self.assertEqual(response.status_code, 200)
+        analytics.flush()
         self.assertEqual(models.AnalyticPage.objects.filter(path="index").count(), 1)
 
 
@@ -133,8 +143,12 @@ class PageAnalyticFeedTestCase(TestCase):
                 HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
             )
             self.assertEqual(response.status_code, 200)
+            analytics.flush()
             self.assertEqual(models.AnalyticPage.objects.filter(path=feed).count(), 1)
 
+        # atom hits are not counted as rss too
+        self.assertEqual(models.AnalyticPage.objects.filter(path="rss").count(), 1)
+
 
 class AnalyticListTestCase(TestCase):
     def setUp(self):
@@ -179,6 +193,7 @@ class PostAnalyticDetailTestCase(TestCase):
             reverse("post_detail", args=(self.post.slug,)),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
+        analytics.flush()
 
         # need to login again to access analytic post detail dashboard page
         self.client.force_login(self.user)
@@ -216,6 +231,7 @@ class PageAnalyticDetailTestCase(TestCase):
             reverse("page_detail", args=(self.page.slug,)),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
+        analytics.flush()
 
         # need to login again to access analytic page detail dashboard page
         self.client.force_login(self.user)
@@ -248,6 +264,7 @@ class PageAnalyticDetailIndexTestCase(TestCase):
             reverse("index"),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
+        analytics.flush()
 
         # login again to access analytic page detail dashboard page
         self.client.force_login(self.user)
@@ -280,6 +297,7 @@ class PageAnalyticDetailFeedTestCase(TestCase):
             reverse(feed),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
         )
+        analytics.flush()
 
         # login again to access analytic page detail dashboard page
         self.client.force_login(self.user)
@@ -311,3 +329,195 @@ class PageAnalyticDetailFeedTestCase(TestCase):
             '<svg version="1.1" viewBox="0 0 500 192" xmlns="http://www.w3.org/2000/svg">',
         )
         self.assertContains(response, "1 hits")
+
+
+@override_settings(ANALYTICS_FLUSH_SIZE=3, ANALYTICS_FLUSH_INTERVAL=3600)
+class AnalyticBufferTestCase(TestCase):
+    """Test analytics hits are buffered and written in bulk."""
+
+    def setUp(self):
+        analytics.flush()
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post"
+        )
+
+    def test_view_does_not_write(self):
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        request.subdomain = self.user.username
+        request.blog_user_id = self.user.id
+        request.blog_user = self.user
+        response = general.index(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+        self.assertEqual(analytics.pending_count(), 1)
+
+        analytics.flush()
+        self.assertEqual(analytics.pending_count(), 0)
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="index").count(), 1
+        )
+
+    def test_flush_due_on_size(self):
+        analytics.record_page(self.user, "index")
+        analytics.record_post(self.post)
+        self.assertFalse(analytics.is_flush_due())
+        analytics.record_post(self.post)
+        self.assertTrue(analytics.is_flush_due())
+
+        analytics.flush()
+        self.assertFalse(analytics.is_flush_due())
+        self.assertEqual(models.AnalyticPage.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    @override_settings(ANALYTICS_FLUSH_INTERVAL=0)
+    def test_flush_due_on_interval(self):
+        self.assertFalse(analytics.is_flush_due())
+        analytics.record_page(self.user, "index")
+        self.assertTrue(analytics.is_flush_due())
+        analytics.flush()
+
+    def test_hit_time_kept(self):
+        with patch.object(timezone, "now", return_value=datetime(2020, 1, 1, 12, 00)):
+            analytics.record_post(self.post)
+        analytics.flush()
+        recorded_at = models.AnalyticPost.objects.get(post=self.post).created_at
+        self.assertEqual(recorded_at, datetime(2020, 1, 1, 12, 00))
+
+    def test_failed_flush_kept(self):
+        analytics.record_page(self.user, "index")
+        analytics.record_post(self.post)
+        with (
+            patch.object(analytics, "_write", side_effect=RuntimeError),
+            self.assertRaises(RuntimeError),
+        ):
+            analytics.flush()
+        self.assertEqual(analytics.pending_count(), 2)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+
+        analytics.flush()
+        self.assertEqual(analytics.pending_count(), 0)
+        self.assertEqual(models.AnalyticPage.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 1)
+
+    @override_settings(ANALYTICS_BUFFER_MAX=2)
+    def test_failed_flush_capped(self):
+        for path in ["one", "two", "three"]:
+            analytics.record_page(self.user, path)
+        with (
+            patch.object(analytics, "_write", side_effect=RuntimeError),
+            self.assertRaises(RuntimeError),
+            self.assertLogs("main.analytics", "WARNING"),
+        ):
+            analytics.flush()
+        self.assertEqual(analytics.pending_count(), 2)
+
+        analytics.flush()
+        self.assertEqual(
+            sorted(models.AnalyticPage.objects.values_list("path", flat=True)),
+            ["three", "two"],
+        )
+
+    def test_request_flushes_only_when_due(self):
+        self.client.get(reverse("index"), HTTP_HOST=f"alice.{settings.CANONICAL_HOST}")
+        self.assertEqual(analytics.pending_count(), 1)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+
+    def test_deleted_post_dropped(self):
+        other_post = models.Post.objects.create(
+            owner=self.user, title="Other post", slug="other-post"
+        )
+        analytics.record_post(self.post)
+        analytics.record_post(other_post)
+        other_post.delete()
+
+        # check foreign keys at insert, as they are outside of tests
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        analytics.flush()
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 1)
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+        self.assertEqual(models.AnalyticPostDaily.objects.get().count, 1)
+
+
+class AnalyticDailyTestCase(TestCase):
+    """Test daily analytics counts are kept up to date and read by dashboards."""
+
+    def setUp(self):
+        analytics.flush()
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post"
+        )
+
+    def record_post_at(self, when):
+        with patch.object(timezone, "now", return_value=when):
+            analytics.record_post(self.post)
+
+    def test_flush_increments(self):
+        self.record_post_at(datetime(2020, 1, 1, 12, 00))
+        self.record_post_at(datetime(2020, 1, 1, 23, 59))
+        self.record_post_at(datetime(2020, 1, 2, 0, 1))
+        analytics.flush()
+        self.record_post_at(datetime(2020, 1, 2, 8, 00))
+        analytics.record_page(self.user, "index")
+        analytics.flush()
+
+        self.assertEqual(
+            dict(
+                models.AnalyticPostDaily.objects.filter(post=self.post).values_list(
+                    "date", "count"
+                )
+            ),
+            {date(2020, 1, 1): 2, date(2020, 1, 2): 2},
+        )
+        page_daily = models.AnalyticPageDaily.objects.get()
+        self.assertEqual(page_daily.user, self.user)
+        self.assertEqual(page_daily.path, "index")
+        self.assertEqual(page_daily.date, timezone.now().date())
+        self.assertEqual(page_daily.count, 1)
+
+    def test_rollup(self):
+        self.record_post_at(datetime(2020, 1, 1, 12, 00))
+        self.record_post_at(datetime(2020, 1, 2, 12, 00))
+        analytics.flush()
+        models.AnalyticPostDaily.objects.update(count=10)
+        models.AnalyticPageDaily.objects.create(
+            user=self.user, path="index", date=date(2020, 1, 1), count=10
+        )
+
+        analytics.rollup(date(2020, 1, 1), date(2020, 1, 2))
+        self.assertEqual(
+            dict(models.AnalyticPostDaily.objects.values_list("date", "count")),
+            {date(2020, 1, 1): 1, date(2020, 1, 2): 10},
+        )
+        self.assertFalse(models.AnalyticPageDaily.objects.exists())
+
+    def test_compact(self):
+        self.record_post_at(datetime(2020, 1, 1, 12, 00))
+        self.record_post_at(datetime(2020, 1, 3, 12, 00))
+        self.record_post_at(datetime(2020, 1, 5, 12, 00))
+        analytics.flush()
+
+        self.assertEqual(analytics.compact(date(2020, 1, 5)), 2)
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+        self.assertEqual(models.AnalyticPostDaily.objects.count(), 3)
+
+    def test_dashboard_reads_daily(self):
+        self.client.force_login(self.user)
+        analytics.record_post(self.post)
+        analytics.record_page(self.user, "index")
+        analytics.flush()
+        models.AnalyticPost.objects.all().delete()
+        models.AnalyticPage.objects.all().delete()
+
+        response = self.client.get(
+            reverse("analytic_post_detail", args=(self.post.slug,))
+        )
+        self.assertContains(response, "1 hits")
+        response = self.client.get(reverse("analytic_page_detail", args=("index",)))
+        self.assertContains(response, "1 hits")
+        response = self.client.get(reverse("analytic_list"))
+        self.assertEqual(list(response.context["top_posts"]), [self.post])
+        self.assertEqual(response.context["top_posts"][0].num_views, 1)
@@ -1,10 +1,16 @@
-from datetime import date
+import json
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest.mock import patch
 
 from django.conf import settings
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
 from main import models, util
+from main.views import api
 
 
 class APIDocsAnonTestCase(TestCase):
@@ -666,8 +672,9 @@ class APIListGetTestCase(TestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(models.Post.objects.all().count(), 2)
-        self.assertTrue(response.json()["ok"])
-        post_list = response.json()["post_list"]
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertTrue(data["ok"])
+        post_list = data["post_list"]
         self.assertEqual(len(post_list), 2)
         self.assertIn(
             {
@@ -690,6 +697,383 @@ class APIListGetTestCase(TestCase):
             post_list,
         )
 
+    def test_posts_get_order(self):
+        # newest first without pages, as before they were added
+        response = self.client.get(
+            reverse("api_posts"),
+            {"fields": "slug"},
+            HTTP_AUTHORIZATION=f"Bearer {self.user.api_key}",
+        )
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(
+            data["post_list"], [{"slug": "bye-world"}, {"slug": "hello-world"}]
+        )
+
+
+class APIListPaginationTestCase(TestCase):
+    """Test GET /api/posts/ pages, field selection and streaming."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.posts = [
+            models.Post.objects.create(
+                owner=self.user, title=f"Post {i}", slug=f"post-{i}", body="Body."
+            )
+            for i in range(5)
+        ]
+        models.Post.objects.create(
+            owner=models.User.objects.create(username="bob"), title="Bob", slug="bob"
+        )
+
+    def get(self, **params):
+        response = self.client.get(
+            reverse("api_posts"),
+            params,
+            HTTP_AUTHORIZATION=f"Bearer {self.user.api_key}",
+        )
+        if response.status_code != 200:
+            return response.status_code, response.json()
+        self.assertTrue(response.streaming)
+        return response.status_code, json.loads(b"".join(response.streaming_content))
+
+    def test_pages(self):
+        slugs = []
+        cursor = None
+        with patch.object(api, "POST_LIST_CHUNK_SIZE", 2):
+            while True:
+                params = {"limit": 2, "fields": "slug"}
+                if cursor is not None:
+                    params["cursor"] = cursor
+                _, data = self.get(**params)
+                slugs += [post["slug"] for post in data["post_list"]]
+                cursor = data["next_cursor"]
+                if cursor is None:
+                    break
+        self.assertEqual(slugs, [f"post-{i}" for i in range(5)])
+
+    def test_last_page_full(self):
+        _, data = self.get(limit=5)
+        self.assertEqual(len(data["post_list"]), 5)
+        self.assertIsNone(data["next_cursor"])
+
+        _, data = self.get(limit=4, fields="slug")
+        self.assertEqual(data["post_list"], [{"slug": f"post-{i}"} for i in range(4)])
+        self.assertEqual(data["next_cursor"], self.posts[3].id)
+
+    def test_fields(self):
+        _, data = self.get(fields="title,url", limit=1)
+        self.assertEqual(
+            data["post_list"][0],
+            {
+                "title": "Post 0",
+                "url": f"{util.get_protocol()}//alice.{settings.CANONICAL_HOST}"
+                "/blog/post-0/",
+            },
+        )
+
+    def test_queries(self):
+        # authentication, and the posts
+        with self.assertNumQueries(2):
+            _, data = self.get()
+        self.assertEqual(len(data["post_list"]), 5)
+
+    def test_invalid(self):
+        for params in [{"limit": 0}, {"limit": 1001}, {"fields": "title,owner"}]:
+            status_code, data = self.get(**params)
+            self.assertEqual(status_code, 400)
+            self.assertFalse(data["ok"])
+
+
+@override_settings(API_SYNC_WINDOW=0)
+class APIChangesTestCase(TestCase):
+    """Test GET /api/changes/ gives posts changed and deleted since a token."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post_a = models.Post.objects.create(
+            owner=self.user, title="A", slug="a", body="Body A."
+        )
+        self.post_b = models.Post.objects.create(
+            owner=self.user, title="B", slug="b", body="Body B."
+        )
+        models.Post.objects.create(
+            owner=models.User.objects.create(username="bob"), title="Bob", slug="bob"
+        )
+
+    def get(self, status_code=200, **params):
+        response = self.client.get(
+            reverse("api_changes"),
+            params,
+            HTTP_AUTHORIZATION=f"Bearer {self.user.api_key}",
+            headers={"if-none-match": params.pop("etag", "")},
+        )
+        self.assertEqual(response.status_code, status_code)
+        if status_code != 200:
+            return response, None
+        return response, json.loads(b"".join(response.streaming_content))
+
+    def test_changes(self):
+        _, data = self.get(fields="slug")
+        self.assertEqual(data["post_list"], [{"slug": "a"}, {"slug": "b"}])
+        self.assertEqual(data["deleted"], [])
+        token = data["sync_token"]
+
+        _, data = self.get(since=token)
+        self.assertEqual(
+            data, {"ok": True, "post_list": [], "deleted": [], "sync_token": token}
+        )
+
+        self.post_a.body = "Edited."
+        self.post_a.save()
+        self.post_b.delete()
+        _, data = self.get(since=token, fields="slug,body")
+        self.assertEqual(data["post_list"], [{"slug": "a", "body": "Edited."}])
+        self.assertEqual(data["deleted"], ["b"])
+        self.assertGreater(data["sync_token"], token)
+
+    def test_renamed(self):
+        _, data = self.get()
+        self.post_a.slug = "a-renamed"
+        self.post_a.save()
+        _, data = self.get(since=data["sync_token"], fields="slug")
+        self.assertEqual(data["post_list"], [{"slug": "a-renamed"}])
+        self.assertEqual(data["deleted"], ["a"])
+
+    def test_user_deleted(self):
+        self.user.delete()
+        self.assertFalse(models.PostTombstone.objects.exists())
+
+    def test_queryset_delete(self):
+        published = models.Post.objects.create(
+            owner=self.user, title="P", slug="p", published_at=date(2020, 1, 1)
+        )
+        models.Post.objects.create(
+            owner=self.user, title="Q", slug="q", published_at=date(2020, 1, 2)
+        )
+        self.user.refresh_from_db()
+        blog_modified_at = self.user.blog_modified_at
+
+        # eg. the admin's delete selected action
+        models.Post.objects.filter(slug__in=["a", "b", "q"]).delete()
+        self.assertEqual(
+            sorted(models.PostTombstone.objects.values_list("slug", flat=True)),
+            ["a", "b", "q"],
+        )
+        self.user.refresh_from_db()
+        self.assertGreater(self.user.blog_modified_at, blog_modified_at)
+        self.assertEqual(
+            models.LatestPost.objects.get(user=self.user).post_id, published.id
+        )
+
+    def test_not_modified(self):
+        _, data = self.get()
+        token = data["sync_token"]
+        response, _ = self.get(since=token)
+        etag = response["ETag"]
+        # authentication, and the two latest changes
+        with self.assertNumQueries(3):
+            response, _ = self.get(304, since=token, etag=etag)
+        self.assertEqual(response["ETag"], etag)
+
+        self.post_b.delete()
+        response, data = self.get(since=token, etag=etag)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(data["deleted"], ["b"])
+
+    def test_invalid(self):
+        self.get(400, since="yesterday")
+        self.get(400, fields="owner")
+
+    def test_since_with_offset(self):
+        _, data = self.get(fields="slug")
+        token = data["sync_token"]
+        for since in [f"{token}Z", f"{token}+00:00"]:
+            _, data = self.get(since=since)
+            self.assertEqual(data["post_list"], [])
+            self.assertEqual(data["sync_token"], token)
+        # the same time, two hours ahead of UTC
+        since = (datetime.fromisoformat(token) + timedelta(hours=2)).isoformat()
+        _, data = self.get(since=f"{since}+02:00")
+        self.assertEqual(data["post_list"], [])
+
+    @override_settings(API_SYNC_WINDOW=60)
+    def test_saved_in_window(self):
+        _, data = self.get(fields="slug")
+        token = data["sync_token"]
+        self.assertLess(token, self.post_a.updated_at.isoformat())
+
+        # saved before post_b, but seen only now, as if committed after it
+        post_c = models.Post.objects.create(owner=self.user, title="C", slug="c")
+        models.Post.objects.filter(id=post_c.id).update(
+            updated_at=self.post_b.updated_at - timedelta(seconds=1)
+        )
+        _, data = self.get(since=token, fields="slug")
+        self.assertIn({"slug": "c"}, data["post_list"])
+
+    def test_expired(self):
+        since = timezone.now() - timedelta(
+            days=settings.POST_TOMBSTONE_RETENTION_DAYS + 1
+        )
+        self.get(410, since=since.isoformat())
+
+    def test_prune(self):
+        self.post_a.delete()
+        self.post_b.delete()
+        models.PostTombstone.objects.filter(slug="a").update(
+            deleted_at=timezone.now()
+            - timedelta(days=settings.POST_TOMBSTONE_RETENTION_DAYS + 1)
+        )
+        call_command("prunetombstones", stdout=StringIO())
+        self.assertEqual(
+            list(models.PostTombstone.objects.values_list("slug", flat=True)), ["b"]
+        )
+
+
+class APIBatchTestCase(TestCase):
+    """Test POST /api/batch/ creates, updates and deletes posts in bulk."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post_a = models.Post.objects.create(
+            owner=self.user, title="A", slug="a", body="Body A."
+        )
+        self.post_b = models.Post.objects.create(
+            owner=self.user, title="B", slug="b", body="Body B."
+        )
+        self.image = models.Image.objects.create(
+            owner=self.user, name="pic", data=b"x", extension="png", slug="pic"
+        )
+
+    def post(self, operations, status_code=200):
+        response = self.client.post(
+            reverse("api_batch"),
+            {"operations": operations},
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {self.user.api_key}",
+        )
+        self.assertEqual(response.status_code, status_code)
+        return response.json()
+
+    def test_batch(self):
+        data = self.post(
+            [
+                {"op": "create", "title": "A", "body": "![pic](/images/pic.png)"},
+                {"op": "create", "title": "New", "published_at": "2020-01-01"},
+                {"op": "create", "title": "New"},
+                {"op": "update", "slug": "a", "body": "**Edited.**"},
+                {"op": "update", "slug": "b", "new_slug": "b-renamed"},
+                {"op": "delete", "slug": "new"},
+            ]
+        )
+        results = data["results"]
+        self.assertTrue(data["ok"])
+        self.assertTrue(all(result["ok"] for result in results))
+        self.assertTrue(results[0]["slug"].startswith("a-"))
+        self.assertEqual(results[1]["slug"], "new")
+        self.assertTrue(results[2]["slug"].startswith("new-"))
+        self.assertEqual(results[3]["slug"], "a")
+        self.assertEqual(results[4]["slug"], "b-renamed")
+        self.assertEqual(
+            results[4]["url"],
+            f"{util.get_protocol()}//alice.{settings.CANONICAL_HOST}/blog/b-renamed/",
+        )
+        self.assertEqual(results[5], {"ok": True})
+
+        self.assertEqual(
+            set(models.Post.objects.values_list("slug", flat=True)),
+            {"a", results[0]["slug"], results[2]["slug"], "b-renamed"},
+        )
+        created = models.Post.objects.get(slug=results[0]["slug"])
+        self.assertEqual(created.owner, self.user)
+        self.assertIn("<img", created.body_html)
+        self.assertEqual(list(created.images.all()), [self.image])
+        self.post_a.refresh_from_db()
+        self.assertEqual(self.post_a.body_html, "<p><strong>Edited.</strong></p>\n")
+        self.assertEqual(
+            list(models.PostTombstone.objects.values_list("slug", flat=True)), ["b"]
+        )
+
+    def test_delete(self):
+        data = self.post(
+            [
+                {"op": "delete", "slug": "a"},
+                {"op": "update", "slug": "b", "new_slug": "a"},
+            ]
+        )
+        self.assertEqual(data["results"][1]["slug"], "a")
+        self.assertEqual(
+            set(models.PostTombstone.objects.values_list("slug", flat=True)),
+            {"a", "b"},
+        )
+        self.assertEqual(models.Post.objects.get().id, self.post_b.id)
+
+    def test_item_errors(self):
+        data = self.post(
+            [
+                {"op": "create"},
+                {"op": "update", "title": "No slug"},
+                {"op": "update", "slug": "missing", "title": "Missing"},
+                {"op": "rename", "slug": "a"},
+                "create",
+                {"op": "update", "slug": "a", "title": "Edited"},
+            ]
+        )
+        self.assertEqual(
+            data["results"],
+            [
+                {"ok": False, "message": "Title field is required."},
+                {"ok": False, "message": "Slug field is required."},
+                {"ok": False, "error": "Not found."},
+                {"ok": False, "message": "Input data invalid."},
+                {"ok": False, "message": "Input data invalid."},
+                {
+                    "ok": True,
+                    "slug": "a",
+                    "url": f"{util.get_protocol()}//alice.{settings.CANONICAL_HOST}/blog/a/",
+                },
+            ],
+        )
+        self.post_a.refresh_from_db()
+        self.assertEqual(self.post_a.title, "Edited")
+
+    def test_constant_queries(self):
+        # the same queries however many posts the batch has
+        operations = [{"op": "create", "title": f"Post {i}"} for i in range(50)]
+        operations += [{"op": "update", "slug": "a", "body": "Edited."}]
+        operations += [{"op": "delete", "slug": "b"}]
+        with self.assertNumQueries(24):
+            self.post(operations)
+        self.assertEqual(models.Post.objects.count(), 51)
+        self.assertEqual(
+            list(models.PostTombstone.objects.values_list("slug", flat=True)), ["b"]
+        )
+
+        # a batch of only deletes, however many
+        operations = [{"op": "delete", "slug": f"post-{i}"} for i in range(20)]
+        with self.assertNumQueries(20):
+            self.post(operations)
+        self.assertEqual(models.Post.objects.count(), 31)
+        self.assertEqual(models.PostTombstone.objects.count(), 21)
+
+    def test_nothing_changed(self):
+        self.user.refresh_from_db()
+        blog_modified_at = self.user.blog_modified_at
+        # authentication, and looking up the posts
+        with self.assertNumQueries(2):
+            data = self.post([{"op": "create"}, {"op": "delete", "slug": "missing"}])
+        self.assertFalse(any(result["ok"] for result in data["results"]))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.blog_modified_at, blog_modified_at)
+
+    def test_invalid(self):
+        self.post([], status_code=400)
+        self.post({"op": "create"}, status_code=400)
+        self.post([{"op": "create"}] * 501, status_code=400)
+        response = self.client.post(
+            reverse("api_batch"), {"operations": []}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 403)
+
 
 class APISingleGetTestCase(TestCase):
     """Test posts with the same slug return across different users."""
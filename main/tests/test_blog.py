@@ -1,8 +1,18 @@
+import io
+import zipfile
+from datetime import date, timedelta
+from pathlib import Path
+from unittest.mock import patch
+
 from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import slugify
 
-from main import models
+from main import exports, models, util
+from main.views import export, general
 
 
 class IndexTestCase(TestCase):
@@ -15,6 +25,74 @@ class IndexTestCase(TestCase):
         self.assertContains(response, settings.INSTANCE_DESCRIPTION)
 
 
+class LandingLatestPostsTestCase(TestCase):
+    """Test the landing page lists each author's latest published post."""
+
+    def setUp(self):
+        self.alice = models.User.objects.create(username="alice", blog_title="Alice")
+        self.bob = models.User.objects.create(username="bob", blog_title="Bob")
+        self.today = timezone.now().date()
+
+    def create_post(self, owner, title, published_at):
+        return models.Post.objects.create(
+            owner=owner, title=title, slug=slugify(title), published_at=published_at
+        )
+
+    def get_latest(self):
+        return dict(models.LatestPost.objects.values_list("user_id", "post__title"))
+
+    def test_maintained(self):
+        first = self.create_post(self.alice, "First", self.today - timedelta(days=2))
+        self.create_post(self.alice, "Draft", None)
+        self.create_post(self.alice, "Scheduled", self.today + timedelta(days=1))
+        self.assertEqual(self.get_latest(), {self.alice.id: "First"})
+
+        second = self.create_post(self.alice, "Second", self.today - timedelta(days=1))
+        self.create_post(self.bob, "Bob post", self.today)
+        self.assertEqual(
+            self.get_latest(), {self.alice.id: "Second", self.bob.id: "Bob post"}
+        )
+
+        # unpublished, then deleted
+        second.published_at = None
+        second.save()
+        self.assertEqual(self.get_latest()[self.alice.id], "First")
+        first.delete()
+        self.assertEqual(self.get_latest(), {self.bob.id: "Bob post"})
+
+        self.bob.delete()
+        self.assertEqual(self.get_latest(), {})
+
+    def test_scheduled(self):
+        self.create_post(self.alice, "First", self.today - timedelta(days=1))
+        self.create_post(self.alice, "Scheduled", self.today + timedelta(days=1))
+        tomorrow = timezone.now() + timedelta(days=1)
+        with patch.object(timezone, "now", return_value=tomorrow):
+            call_command("refreshlatestposts", stdout=io.StringIO())
+        self.assertEqual(self.get_latest(), {self.alice.id: "Scheduled"})
+
+    def test_landing(self):
+        self.create_post(self.alice, "Old", self.today - timedelta(days=1))
+        self.create_post(self.alice, "Alice post", self.today)
+        self.create_post(self.bob, "Bob post", self.today - timedelta(days=3))
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("index"))
+        self.assertContains(response, "Alice post")
+        self.assertContains(response, "Bob post")
+        self.assertNotContains(response, "Old")
+        content = response.content.decode()
+        self.assertLess(content.index("Alice post"), content.index("Bob post"))
+
+    def test_landing_pages(self):
+        self.create_post(self.alice, "Alice post", self.today)
+        self.create_post(self.bob, "Bob post", self.today - timedelta(days=3))
+        with patch.object(general, "LANDING_PAGE_SIZE", 1):
+            response = self.client.get(reverse("index"), {"page": 2})
+        self.assertContains(response, "Bob post")
+        self.assertNotContains(response, "Alice post")
+        self.assertContains(response, '<a href="?page=1">Newer</a>')
+
+
 class BlogIndexTestCase(TestCase):
     """Test blog index works for logged in."""
 
@@ -172,8 +250,9 @@ class BlogExportMarkdownTestCase(TestCase):
         response = self.client.post(reverse("export_markdown"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-markdown")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"export-markdown", content)
+        self.assertIn(self.data["slug"].encode("utf-8"), content)
 
 
 class BlogExportPrintTestCase(TestCase):
@@ -193,10 +272,71 @@ class BlogExportPrintTestCase(TestCase):
     def test_blog_export(self):
         response = self.client.post(reverse("export_print"))
         self.assertEqual(response.status_code, 200)
-        self.assertContains(response, self.user.blog_title)
-        self.assertContains(response, self.user.blog_byline)
-        self.assertContains(response, self.user.username)
-        self.assertContains(response, self.data["title"].encode("utf-8"))
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn(self.user.blog_title, content)
+        self.assertIn(self.user.blog_byline, content)
+        self.assertIn(self.user.username, content)
+        self.assertIn(self.data["title"], content)
+
+    def test_streamed(self):
+        response = self.client.get(reverse("export_print"))
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.count("<html>"), 1)
+        self.assertIn("<p>Content sentence.</p>", content)
+        self.assertLess(
+            content.index("Welcome post"), content.index("About the Author")
+        )
+
+    def test_stored_html(self):
+        with patch.object(util, "render_markdown") as render_markdown:
+            response = self.client.get(reverse("export_print"))
+            b"".join(response.streaming_content)
+        render_markdown.assert_not_called()
+
+    def test_pages(self):
+        models.Post.objects.bulk_create(
+            models.Post(
+                owner=self.user,
+                title=f"Older post {i}",
+                slug=f"older-post-{i}",
+                body="Older.",
+                published_at=date(2020, 1, 1) + timedelta(days=i),
+            )
+            for i in range(150)
+        )
+        with patch.object(export, "EXPORT_PRINT_BATCH_SIZE", 30):
+            response = self.client.get(reverse("export_print"), {"page": 1})
+            content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.count("<article>"), 101)  # and About the Author
+        self.assertIn("Welcome post", content)
+        self.assertIn("Older post 51<", content)
+        self.assertNotIn("Older post 50<", content)
+        self.assertIn('<a href="?page=2">Next page</a>', content)
+
+        response = self.client.get(reverse("export_print"), {"page": 2})
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.count("<article>"), 52)
+        self.assertIn("Older post 0<", content)
+        self.assertNotIn("Next page", content)
+
+    def test_range(self):
+        models.Post.objects.create(
+            owner=self.user,
+            title="Old post",
+            slug="old-post",
+            body="Old.",
+            published_at=date(2020, 1, 1),
+        )
+        response = self.client.get(
+            reverse("export_print"), {"since": "2019-12-01", "until": "2020-01-31"}
+        )
+        self.assertContains(response, "Old post")
+        self.assertNotContains(response, self.data["title"])
+
+    def test_invalid(self):
+        response = self.client.get(reverse("export_print"), {"page": "0"})
+        self.assertEqual(response.status_code, 400)
 
 
 class BlogExportHugoTestCase(TestCase):
@@ -214,8 +354,88 @@ class BlogExportHugoTestCase(TestCase):
         response = self.client.post(reverse("export_hugo"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-hugo")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"export-hugo", content)
+        self.assertIn(self.data["slug"].encode("utf-8"), content)
+
+    def test_blog_export_archive(self):
+        response = self.client.post(reverse("export_hugo"))
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        names = archive.namelist()
+        export_name = names[0].split("/")[0]
+        self.assertIn(f"{export_name}/config.toml", names)
+        self.assertIn(f"{export_name}/themes/mataroa/layouts/index.html", names)
+        post = archive.read(f"{export_name}/content/blog/welcome-post.md").decode()
+        self.assertIn("title: Welcome post", post)
+        self.assertIn("Content sentence.", post)
+
+    def test_assets_read_once(self):
+        with patch.object(Path, "read_text") as read_text:
+            response = self.client.post(reverse("export_hugo"))
+            b"".join(response.streaming_content)
+        read_text.assert_not_called()
+
+
+class ExportFormatsTestCase(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(
+            username="alice", blog_title="Wonderland", blog_byline="Down\nthe hole"
+        )
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Welcome post",
+            slug="welcome-post",
+            body="Content sentence.",
+            published_at=date(2020, 1, 2),
+        )
+
+    def get_files(self, export_format):
+        return dict(exports.get_files(self.user, export_format, "export"))
+
+    def test_markdown(self):
+        files = self.get_files(exports.MARKDOWN)
+        self.assertEqual(list(files), ["export/blog/welcome-post.md"])
+        self.assertEqual(
+            files["export/blog/welcome-post.md"],
+            "---\ndate: 2020-01-02\ndraft: false\nslug: welcome-post\n"
+            "title: Welcome post\n---\n\nContent sentence.",
+        )
+
+    def test_hugo(self):
+        files = self.get_files(exports.HUGO)
+        self.assertEqual(len(files), 9)
+        self.assertIn("export/themes/mataroa/static/style.css", files)
+        config = files["export/config.toml"]
+        self.assertIn("alice.capivaras.dev", config)
+        self.assertIn("Wonderland", config)
+        self.assertIn("Down\\nthe hole", config)
+        self.assertEqual(
+            files["export/content/blog/welcome-post.md"],
+            exports.post_with_frontmatter(self.post),
+        )
+
+    def test_mail(self):
+        files = self.get_files(exports.MAIL)
+        self.assertEqual(
+            files,
+            {
+                "export/alice-mataroa-blog/welcome-post.md": (
+                    "# Welcome post\n\n"
+                    "> Published on Jan 2, 2020\n\n"
+                    "Content sentence.\n"
+                )
+            },
+        )
+
+    def test_write_zip(self):
+        zip_file = io.BytesIO()
+        exports.write_zip(exports.get_files(self.user, exports.MAIL, "e"), zip_file)
+        with zipfile.ZipFile(zip_file) as archive:
+            self.assertEqual(
+                archive.namelist(), ["e/alice-mataroa-blog/welcome-post.md"]
+            )
 
 
 class BlogNotificationListTestCase(TestCase):
@@ -1,7 +1,17 @@
-from django.test import TestCase
+import hashlib
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from main import models
+from main import models, storage, variants
 
 
 class ImageCreateTestCase(TestCase):
@@ -96,6 +106,75 @@ class ImageDetailUsedByTestCase(TestCase):
         self.assertContains(response, "New post")
 
 
+class ImageReferencesTestCase(TestCase):
+    """Test posts and pages keep track of the images their bodies use."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.image = models.Image.objects.create(
+            owner=self.user, name="vulf", slug="vulf", extension="jpeg"
+        )
+        self.other = models.Image.objects.create(
+            owner=self.user, name="other", slug="other", extension="png"
+        )
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="New post",
+            slug="new-post",
+            body="![vulf](https://mataroa.blog/images/vulf.jpeg)",
+        )
+
+    def test_post(self):
+        self.assertEqual(list(self.post.images.all()), [self.image])
+        self.post.body = "![other](/images/other.png) ![vulf](/images/vulf.png)"
+        self.post.save()
+        self.assertEqual(list(self.post.images.all()), [self.other])
+        self.post.body = "No images."
+        self.post.save(update_fields=["body"])
+        self.assertFalse(self.post.images.exists())
+
+    def test_variant(self):
+        self.post.body = (
+            '<img src="/images/vulf.jpeg" srcset="/images/vulf.webp?w=480">'
+        )
+        self.post.save()
+        self.assertEqual(list(self.post.images.all()), [self.image])
+        self.post.body = "![vulf](/images/vulf.webp?w=960)"
+        self.post.save()
+        self.assertEqual(list(self.post.images.all()), [self.image])
+        self.assertEqual(list(models.Image.objects.unreferenced()), [self.other])
+
+    def test_body_unchanged(self):
+        self.post.title = "Renamed post"
+        with patch.object(models.Post, "update_image_refs") as update_image_refs:
+            self.post.save(update_fields=["title"])
+            self.post.save(update_fields=["title", "body"])
+            self.post.save()
+        update_image_refs.assert_not_called()
+        self.assertEqual(list(self.post.images.all()), [self.image])
+
+    def test_page(self):
+        page = models.Page.objects.create(
+            owner=self.user, title="About", slug="about", body="/images/other.png"
+        )
+        self.assertEqual(list(page.images.all()), [self.other])
+
+    def test_unreferenced(self):
+        self.assertEqual(list(models.Image.objects.unreferenced()), [self.other])
+
+    def test_image_detail_queries(self):
+        self.client.force_login(self.user)
+        for i in range(5):
+            models.Post.objects.create(
+                owner=self.user, title=f"Post {i}", slug=f"post-{i}", body="Text."
+            )
+        # the used by posts are one query, however many posts there are
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse("image_detail", args=("vulf",)))
+        self.assertContains(response, "New post")
+        self.assertNotContains(response, "Post 1")
+
+
 class ImageRawTestCase(TestCase):
     def setUp(self):
         self.user = models.User.objects.create(username="alice", is_approved=True)
@@ -251,3 +330,327 @@ class ImageDeleteNotOwnTestCase(TestCase):
         self.assertTrue(
             models.Image.objects.filter(name="vulf", owner=self.victim).exists()
         )
+
+
+class ImageFilesystemStorageTestCase(TestCase):
+    """Test images are stored as files when IMAGE_STORAGE is filesystem."""
+
+    def setUp(self):
+        image_root = tempfile.TemporaryDirectory()
+        self.addCleanup(image_root.cleanup)
+        self.image_root = Path(image_root.name)
+        settings_override = override_settings(
+            IMAGE_STORAGE=storage.FILESYSTEM, IMAGE_ROOT=image_root.name
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice", is_approved=True)
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+        self.path = self.image_root / self.image.filename
+
+    def test_image_upload(self):
+        self.assertEqual(self.image.storage, storage.FILESYSTEM)
+        self.assertIsNone(self.image.data)
+        self.assertEqual(self.path.read_bytes(), self.data)
+        self.assertEqual(self.image.data_size, round(len(self.data) / 1024**2, 2))
+
+    def test_image_raw(self):
+        response = self.client.get(
+            reverse("image_raw", args=(self.image.slug, self.image.extension)),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    def test_image_raw_missing_file(self):
+        self.path.unlink()
+        response = self.client.get(
+            reverse("image_raw", args=(self.image.slug, self.image.extension)),
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_image_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        self.assertFalse(models.Image.objects.filter(id=self.image.id).exists())
+        self.assertFalse(self.path.exists())
+
+    def test_user_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertFalse(self.path.exists())
+
+    def test_database_images_still_served(self):
+        image = models.Image.objects.create(
+            owner=self.user, name="old", slug="old", extension="png", data=b"png"
+        )
+        response = self.client.get(reverse("image_raw", args=(image.slug, "png")))
+        self.assertEqual(response.content, b"png")
+
+
+class ImageQuotaTestCase(TestCase):
+    """Test the image quota is counted without loading image data."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice", is_approved=True)
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.size = len(fp.read())
+            for _ in range(2):
+                fp.seek(0)
+                self.client.post(reverse("image_list"), {"file": fp})
+
+    def test_sizes(self):
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.image_bytes, 2 * self.size)
+        self.assertEqual(
+            list(models.Image.objects.values_list("size_bytes", flat=True)),
+            [self.size, self.size],
+        )
+
+    def test_image_list(self):
+        response = self.client.get(reverse("image_list"))
+        self.assertEqual(
+            response.context["total_quota"], round(2 * self.size / 1024**2, 2)
+        )
+        self.assertContains(response, "2 out of 1000 images")
+        self.assertNotIn("data", response.context["images"][0].__dict__)
+
+    def test_delete(self):
+        image = models.Image.objects.first()
+        self.client.post(reverse("image_delete", args=(image.slug,)))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.image_bytes, self.size)
+
+    def test_stale_user_save(self):
+        # self.user was loaded before the uploads counted their sizes
+        self.user.blog_title = "Alice writes"
+        self.user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.blog_title, "Alice writes")
+        self.assertEqual(self.user.image_bytes, 2 * self.size)
+
+    def test_recount(self):
+        models.User.objects.filter(id=self.user.id).update(image_bytes=1)
+        other_user = models.User.objects.create(username="bob", image_bytes=5)
+        output = StringIO()
+        call_command("recountimagebytes", stdout=output)
+        self.assertIn("2 fixed", output.getvalue())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.image_bytes, 2 * self.size)
+        other_user.refresh_from_db()
+        self.assertEqual(other_user.image_bytes, 0)
+
+
+class ImageDataDeferredTestCase(TestCase):
+    """Test views that do not show image data do not select it."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(
+            username="alice", is_approved=True, is_staff=True, is_superuser=True
+        )
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+
+    def assertDataNotSelected(self, method, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400)
+        for query in queries:
+            self.assertNotIn('"main_image"."data"', query["sql"])
+
+    def test_views(self):
+        slug = self.image.slug
+        self.assertDataNotSelected("get", reverse("image_list"))
+        self.assertDataNotSelected("get", reverse("image_detail", args=(slug,)))
+        self.assertDataNotSelected("get", reverse("image_update", args=(slug,)))
+        self.assertDataNotSelected(
+            "post", reverse("image_update", args=(slug,)), {"name": "vulf2"}
+        )
+        self.assertDataNotSelected("get", reverse("image_delete", args=(slug,)))
+        self.assertDataNotSelected("post", reverse("image_delete", args=(slug,)))
+
+    def test_admin(self):
+        self.assertDataNotSelected("get", reverse("admin:main_image_changelist"))
+        self.assertDataNotSelected(
+            "get", reverse("admin:main_image_change", args=(self.image.id,))
+        )
+
+    def test_user_delete(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.user.delete()
+        for query in queries:
+            self.assertNotIn('"main_image"."data"', query["sql"])
+
+    def test_with_data(self):
+        image = models.Image.objects.with_data().get(id=self.image.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(image.data)
+
+
+class ImageRawHTTPCacheTestCase(TestCase):
+    """Test images are served with cache headers, conditionally and by range."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create(username="alice", is_approved=True)
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+        self.url = reverse("image_raw", args=(self.image.slug, self.image.extension))
+
+    def test_headers(self):
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response.headers["Cache-Control"], "public, max-age=31536000, immutable"
+        )
+        self.assertEqual(
+            response.headers["ETag"], f'"{hashlib.sha256(self.data).hexdigest()}"'
+        )
+        self.assertIn("Last-Modified", response.headers)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+    def test_not_modified_without_queries(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                self.url, headers={"if-none-match": response.headers["ETag"]}
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+        response = self.client.get(
+            self.url,
+            headers={"if-modified-since": response.headers["Last-Modified"]},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_deleted(self):
+        etag = self.client.get(self.url).headers["ETag"]
+        self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        response = self.client.get(self.url, headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 404)
+
+    def test_range(self):
+        response = self.client.get(self.url, headers={"range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.data[10:20])
+        self.assertEqual(
+            response.headers["Content-Range"], f"bytes 10-19/{len(self.data)}"
+        )
+
+        response = self.client.get(self.url, headers={"range": "bytes=-10"})
+        self.assertEqual(response.content, self.data[-10:])
+
+    def test_range_not_satisfiable(self):
+        response = self.client.get(
+            self.url, headers={"range": f"bytes={len(self.data)}-"}
+        )
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["Content-Range"], f"bytes */{len(self.data)}")
+
+    def test_range_if_range_mismatch(self):
+        response = self.client.get(
+            self.url, headers={"range": "bytes=0-9", "if-range": '"other"'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.data)
+
+    def test_hash_of_earlier_upload(self):
+        models.Image.objects.filter(id=self.image.id).update(data_hash=None)
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response.headers["ETag"], f'"{hashlib.sha256(self.data).hexdigest()}"'
+        )
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.data_hash, hashlib.sha256(self.data).hexdigest())
+
+    @override_settings(IMAGE_STORAGE=storage.FILESYSTEM)
+    def test_filesystem_range(self):
+        with (
+            tempfile.TemporaryDirectory() as image_root,
+            override_settings(IMAGE_ROOT=image_root),
+        ):
+            with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+                self.client.post(reverse("image_list"), {"file": fp})
+            image = models.Image.objects.get(name="vulf", storage=storage.FILESYSTEM)
+            response = self.client.get(
+                reverse("image_raw", args=(image.slug, image.extension)),
+                headers={"range": "bytes=5-"},
+            )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.data[5:])
+
+
+@override_settings(IMAGE_VARIANT_WIDTHS=[480, 960], IMAGE_VARIANT_WEBP=True)
+class ImageVariantsTestCase(TestCase):
+    """Test image_raw serves variants for ?w= and the original until they exist."""
+
+    def setUp(self):
+        cache.clear()
+        image_root = tempfile.TemporaryDirectory()
+        self.addCleanup(image_root.cleanup)
+        settings_override = override_settings(IMAGE_ROOT=image_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice", is_approved=True)
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+        for extension in ["jpeg", "webp"]:
+            path = variants.get_path(self.image.slug, 480, extension)
+            storage.write_file(path, extension.encode())
+
+    def get(self, extension, width=None):
+        url = reverse("image_raw", args=(self.image.slug, extension))
+        return self.client.get(url, {"w": width} if width else {})
+
+    def test_variant(self):
+        response = self.get("jpeg", 480)
+        self.assertEqual(b"".join(response.streaming_content), b"jpeg")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(
+            response.headers["Cache-Control"], "public, max-age=31536000, immutable"
+        )
+        self.assertNotEqual(response.headers["ETag"], self.get("jpeg").headers["ETag"])
+
+        response = self.get("webp", 480)
+        self.assertEqual(b"".join(response.streaming_content), b"webp")
+        self.assertEqual(response["Content-Type"], "image/webp")
+
+    def test_variant_not_made(self):
+        for extension in ["jpeg", "webp"]:
+            response = self.get(extension, 960)
+            self.assertEqual(response.content, self.data)
+            self.assertEqual(response["Content-Type"], "image/jpeg")
+            self.assertEqual(response.headers["Cache-Control"], "public, max-age=600")
+
+    def test_not_a_variant_width(self):
+        response = self.get("jpeg", 100)
+        self.assertEqual(response.content, self.data)
+        self.assertEqual(
+            response.headers["Cache-Control"], "public, max-age=31536000, immutable"
+        )
+        self.assertEqual(self.get("webp", 100).status_code, 404)
+        self.assertEqual(self.get("webp").status_code, 404)
+
+    def test_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        self.assertFalse(variants.get_path(self.image.slug, 480, "jpeg").exists())
+        self.assertFalse(variants.get_path(self.image.slug, 480, "webp").exists())
@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from main import analytics, models
+from main.feeds import RSSBlogFeed
+from main.management.commands import processnotifications
+from main.sitemaps import PostSitemap
+
+
+class IndexUsageTestCase(TestCase):
+    """Test the planner uses the indexes meant for hot queries."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post"
+        )
+        models.Notification.objects.create(
+            blog_user=self.user, email="reader@example.com"
+        )
+        with connection.cursor() as cursor:
+            # tables are tiny in tests, make sure the planner considers indexes
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def explain(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            return "\n".join(row[0] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index_name):
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn(index_name, self.explain(sql, params))
+
+    def assertQueryUsesIndex(self, queries, table, index_name):
+        queries = [q["sql"] for q in queries if f'FROM "{table}"' in q["sql"]]
+        self.assertTrue(queries, f"no query on {table}")
+        for sql in queries:
+            self.assertIn(index_name, self.explain(sql))
+
+    def test_blog_index(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(
+                reverse("index"),
+                HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            )
+        self.assertQueryUsesIndex(
+            context.captured_queries, "main_post", "post_owner_published_idx"
+        )
+
+    def test_rss_items(self):
+        feed = RSSBlogFeed()
+        feed.subdomain = self.user.username
+        self.assertUsesIndex(feed.items(), "post_owner_published_idx")
+
+    def test_sitemap_items(self):
+        sitemap = PostSitemap(self.user.username)
+        self.assertUsesIndex(sitemap.items(), "post_owner_published_idx")
+
+    def test_processnotifications(self):
+        command = processnotifications.Command()
+        self.assertUsesIndex(command.get_posts(), "post_unbroadcasted_idx")
+        with CaptureQueriesContext(connection) as context:
+            command.get_subscribers(self.user)
+        self.assertQueryUsesIndex(
+            context.captured_queries, "main_notification", "notification_active_idx"
+        )
+
+    def test_analytic_views(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse("analytic_post_detail", args=(self.post.slug,)))
+            self.client.get(reverse("analytic_page_detail", args=("index",)))
+        self.assertQueryUsesIndex(
+            context.captured_queries,
+            "main_analyticpostdaily",
+            "main_analyticpostdaily_post_id_date",
+        )
+        self.assertQueryUsesIndex(
+            context.captured_queries,
+            "main_analyticpagedaily",
+            "main_analyticpagedaily_user_id_path_date",
+        )
+
+    def test_rollupanalytics(self):
+        today = timezone.now().date()
+        with CaptureQueriesContext(connection) as context:
+            analytics.rollup(today - timedelta(days=1), today)
+        self.assertQueryUsesIndex(
+            context.captured_queries, "main_analyticpost", "analyticpost_created_idx"
+        )
+        self.assertQueryUsesIndex(
+            context.captured_queries, "main_analyticpage", "analyticpage_created_idx"
+        )
+
+    def test_landing(self):
+        self.assertUsesIndex(
+            models.LatestPost.objects.all()[:100], "latestpost_published_idx"
+        )
@@ -1,14 +1,22 @@
-from datetime import datetime
+import io
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta
 from io import StringIO
+from pathlib import Path
 from unittest.mock import patch
 
+import PIL.Image
 from django.conf import settings
 from django.core import mail
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
 from django.utils import timezone
 
-from main import models
+from main import models, storage, util, variants
 from main.management.commands import mailexports, processnotifications
 
 
@@ -49,16 +57,17 @@ class ProcessNotificationsTest(TestCase):
     def test_command(self):
         output = StringIO()
 
-        with patch.object(
-            timezone, "now", return_value=datetime(2020, 1, 2, 13, 00)
-        ), patch.object(
-            # Django default test runner overrides SMTP EmailBackend with locmem,
-            # but because we re-import the SMTP backend in
-            # processnotifications.get_mail_connection, we need to mock it here too.
-            processnotifications,
-            "get_mail_connection",
-            return_value=mail.get_connection(
-                "django.core.mail.backends.locmem.EmailBackend"
+        with (
+            patch.object(timezone, "now", return_value=datetime(2020, 1, 2, 13, 00)),
+            patch.object(
+                # Django default test runner overrides SMTP EmailBackend with locmem,
+                # but because we re-import the SMTP backend in
+                # processnotifications.get_mail_connection, we need to mock it here too.
+                processnotifications,
+                "get_mail_connection",
+                return_value=mail.get_connection(
+                    "django.core.mail.backends.locmem.EmailBackend"
+                ),
             ),
         ):
             call_command("processnotifications", "--no-dryrun", stdout=output)
@@ -109,6 +118,168 @@ class ProcessNotificationsTest(TestCase):
         models.Post.objects.all().delete()
 
 
+class ProcessNotificationsDeliveryTest(TestCase):
+    """Test processnotifications sends in batches, and resumes unsent records."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice", notifications_on=True)
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Yesterday post",
+            slug="yesterday-post",
+            body="Content sentence.",
+            published_at=datetime(2020, 1, 1),
+        )
+        self.notifications = models.Notification.objects.bulk_create(
+            models.Notification(blog_user=self.user, email=f"reader{i}@example.com")
+            for i in range(25)
+        )
+        self.connection = mail.get_connection(
+            "django.core.mail.backends.locmem.EmailBackend"
+        )
+
+    def run_command(self, *args, now=datetime(2020, 1, 2, 13, 00)):
+        output = StringIO()
+        with (
+            patch.object(timezone, "now", return_value=now),
+            patch.object(
+                processnotifications,
+                "get_mail_connection",
+                return_value=self.connection,
+            ),
+        ):
+            call_command(
+                "processnotifications",
+                "--no-dryrun",
+                "--batch-size=10",
+                "--rate=0",
+                *args,
+                stdout=output,
+            )
+        return output.getvalue()
+
+    def test_batches(self):
+        output = self.run_command()
+        self.assertEqual(len(mail.outbox), 25)
+        self.assertEqual(
+            sorted(email.to[0] for email in mail.outbox),
+            sorted(n.email for n in self.notifications),
+        )
+        self.assertFalse(
+            models.NotificationRecord.objects.filter(sent_at__isnull=True).exists()
+        )
+        self.post.refresh_from_db()
+        self.assertIsNotNone(self.post.broadcasted_at)
+        self.assertIn("Broadcast sent. Total 25 emails.", output)
+
+    def test_queries_per_batch(self):
+        # one query per batch of 10 emails
+        with self.assertNumQueries(9):
+            self.run_command()
+        models.Notification.objects.bulk_create(
+            models.Notification(blog_user=self.user, email=f"late{i}@example.com")
+            for i in range(10)
+        )
+        models.Post.objects.update(broadcasted_at=None)
+        models.NotificationRecord.objects.all().delete()
+        with self.assertNumQueries(10):
+            self.run_command()
+
+    def test_failures_retried(self):
+        send_messages = self.connection.send_messages
+
+        def fail_some(messages):
+            if messages[0].to[0].startswith("reader1"):
+                raise ConnectionError("Connection lost.")
+            return send_messages(messages)
+
+        with patch.object(self.connection, "send_messages", side_effect=fail_some):
+            output = self.run_command()
+        # reader1 and reader10 to reader19
+        self.assertEqual(len(mail.outbox), 14)
+        self.assertIn("Failed to send 'Yesterday post' to reader1@example.com.", output)
+        self.post.refresh_from_db()
+        self.assertIsNone(self.post.broadcasted_at)
+
+        # the next day, only the failed emails are sent
+        mail.outbox = []
+        output = self.run_command(now=datetime(2020, 1, 3, 13, 00))
+        self.assertEqual(len(mail.outbox), 11)
+        self.assertIn("Broadcast sent. Total 11 emails.", output)
+        self.post.refresh_from_db()
+        self.assertIsNotNone(self.post.broadcasted_at)
+
+    def test_resume_after_crash(self):
+        # a run that crashed after sending to the first ten subscribers
+        models.NotificationRecord.objects.bulk_create(
+            models.NotificationRecord(
+                notification=notification,
+                post=self.post,
+                sent_at=datetime(2020, 1, 2, 13, 00) if i < 10 else None,
+            )
+            for i, notification in enumerate(self.notifications)
+        )
+        self.notifications[24].is_active = False
+        self.notifications[24].save()
+
+        self.run_command()
+        self.assertEqual(len(mail.outbox), 14)
+        self.assertNotIn(
+            self.notifications[24].email, [email.to[0] for email in mail.outbox]
+        )
+        self.assertEqual(models.NotificationRecord.objects.count(), 24)
+
+    def test_resubscribed_during_run(self):
+        # reader0 has a pending record, and was unsubscribed when subscribers
+        # were fetched, but subscribed again before records were
+        models.NotificationRecord.objects.create(
+            notification=self.notifications[0], post=self.post, sent_at=None
+        )
+        get_subscribers = processnotifications.Command.get_subscribers
+        with patch.object(
+            processnotifications.Command,
+            "get_subscribers",
+            lambda command, blog_user: get_subscribers(command, blog_user)[1:],
+        ):
+            self.run_command()
+        self.assertEqual(len(mail.outbox), 25)
+        self.assertIn(
+            self.notifications[0].email, [email.to[0] for email in mail.outbox]
+        )
+
+    def test_rendered_once(self):
+        with patch.object(
+            models.Post, "get_proper_url", autospec=True, return_value="//post"
+        ) as get_proper_url:
+            self.run_command()
+        self.assertEqual(get_proper_url.call_count, 1)
+        for email in mail.outbox:
+            key = models.Notification.objects.get(email=email.to[0]).unsubscribe_key
+            self.assertIn(f"/newsletter/unsubscribe/{key}/", email.body)
+            self.assertEqual(email.body.count(str(key)), 1)
+            self.assertIn(str(key), email.extra_headers["List-Unsubscribe"])
+            self.assertEqual(email.alternatives, [])
+
+    def test_html(self):
+        self.post.body = "Content *sentence* & more."
+        self.post.save()
+        self.run_command("--html")
+        email = mail.outbox[0]
+        key = models.Notification.objects.get(email=email.to[0]).unsubscribe_key
+        html, mimetype = email.alternatives[0]
+        self.assertEqual(mimetype, "text/html")
+        self.assertIn("<p>Content <em>sentence</em> &amp; more.</p>", html)
+        self.assertIn(f"/newsletter/unsubscribe/{key}/", html)
+        self.assertIn("Content *sentence* & more.", email.body)
+
+    def test_rate_limiter(self):
+        rate_limiter = processnotifications.RateLimiter(100)
+        with patch.object(time, "sleep") as sleep:
+            for _ in range(3):
+                rate_limiter.wait()
+        self.assertAlmostEqual(sleep.call_args_list[2].args[0], 0.02, places=2)
+
+
 class MailExportsTest(TestCase):
     """
     Test mail_export sends emails to users with `mail_export_on` enabled.
@@ -142,16 +313,17 @@ class MailExportsTest(TestCase):
     def test_command(self):
         output = StringIO()
 
-        with patch.object(
-            timezone, "now", return_value=datetime(2020, 1, 1, 00, 00)
-        ), patch.object(
-            # Django default test runner overrides SMTP EmailBackend with locmem,
-            # but because we re-import the SMTP backend in
-            # processnotifications.get_mail_connection, we need to mock it here too.
-            mailexports,
-            "get_mail_connection",
-            return_value=mail.get_connection(
-                "django.core.mail.backends.locmem.EmailBackend"
+        with (
+            patch.object(timezone, "now", return_value=datetime(2020, 1, 1, 00, 00)),
+            patch.object(
+                # Django default test runner overrides SMTP EmailBackend with locmem,
+                # but because we re-import the SMTP backend in
+                # processnotifications.get_mail_connection, we need to mock it here too.
+                mailexports,
+                "get_mail_connection",
+                return_value=mail.get_connection(
+                    "django.core.mail.backends.locmem.EmailBackend"
+                ),
             ),
         ):
             call_command("mailexports", stdout=output)
@@ -160,7 +332,7 @@ class MailExportsTest(TestCase):
         records = models.ExportRecord.objects.all()
         self.assertEqual(len(records), 1)
         self.assertEqual(records[0].user, self.user)
-        self.assertIn("export-markdown-", records[0].name)
+        self.assertIn("export-mail-", records[0].name)
 
         # logging
         self.assertIn("Processing email exports.", output.getvalue())
@@ -196,3 +368,366 @@ class MailExportsTest(TestCase):
     def tearDown(self):
         models.User.objects.all().delete()
         models.Post.objects.all().delete()
+
+
+class MailExportsResumeTest(TestCase):
+    """Test mailexports sends each export once a month, and resumes after crashes."""
+
+    def setUp(self):
+        self.users = [
+            models.User.objects.create(
+                username=f"user{i}", email=f"user{i}@example.com", mail_export_on=True
+            )
+            for i in range(5)
+        ]
+        for user in self.users:
+            models.Post.objects.create(
+                owner=user, title="A post", slug="a-post", body="Content sentence."
+            )
+        self.connection = mail.get_connection(
+            "django.core.mail.backends.locmem.EmailBackend"
+        )
+
+    def run_command(self, *args, now=datetime(2020, 2, 1, 6, 00)):
+        output = StringIO()
+        with (
+            patch.object(timezone, "now", return_value=now),
+            patch.object(
+                mailexports, "get_mail_connection", return_value=self.connection
+            ),
+        ):
+            call_command("mailexports", "--workers=2", *args, stdout=output)
+        return output.getvalue()
+
+    def test_archives(self):
+        self.run_command()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(models.ExportRecord.objects.count(), 5)
+        for email in mail.outbox:
+            name, data, mimetype = email.attachments[0]
+            self.assertEqual(mimetype, "application/zip")
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                username = email.to[0].split("@")[0]
+                self.assertEqual(
+                    archive.namelist(),
+                    [f"{name[:-4]}/{username}-mataroa-blog/a-post.md"],
+                )
+                content = archive.read(archive.namelist()[0]).decode()
+                self.assertIn("# A post", content)
+
+    def test_resume(self):
+        send_messages = self.connection.send_messages
+
+        def fail_some(messages):
+            if messages[0].to[0] in ["user1@example.com", "user3@example.com"]:
+                raise ConnectionError("Connection lost.")
+            return send_messages(messages)
+
+        with patch.object(self.connection, "send_messages", side_effect=fail_some):
+            output = self.run_command()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn("Failed to send export to user1: Connection lost.", output)
+
+        # not the first of the month any more
+        now = datetime(2020, 2, 2, 6, 00)
+        output = self.run_command(now=now)
+        self.assertIn("No action. Not the first day of the month.", output)
+
+        self.run_command("--resume", now=now)
+        self.assertEqual(
+            sorted(email.to[0] for email in mail.outbox[3:]),
+            ["user1@example.com", "user3@example.com"],
+        )
+        self.run_command("--resume", now=now)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_next_month(self):
+        self.run_command()
+        self.run_command(now=datetime(2020, 3, 1, 6, 00))
+        self.assertEqual(len(mail.outbox), 10)
+
+
+class RenderBodiesTest(TestCase):
+    """Test renderbodies stores renders of posts and pages that are stale."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="A post", slug="a-post", body="Post *body*."
+        )
+        self.page = models.Page.objects.create(
+            owner=self.user, title="A page", slug="a-page", body="Page *body*."
+        )
+        # simulate rows that existed before renders were stored
+        models.Post.objects.update(body_html=None, body_text=None, body_render_key=None)
+        models.Page.objects.update(body_html=None, body_render_key=None)
+
+    def test_command(self):
+        output = StringIO()
+        call_command("renderbodies", stdout=output)
+
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_html, "<p>Post <em>body</em>.</p>\n")
+        self.assertEqual(post.body_text, "Post body.\n")
+        self.assertEqual(post.body_render_key, util.get_render_key(post.body))
+        page = models.Page.objects.get(id=self.page.id)
+        self.assertEqual(page.body_html, "<p>Page <em>body</em>.</p>\n")
+
+        self.assertIn("Rendered 1 posts.", output.getvalue())
+        self.assertIn("Rendered 1 pages.", output.getvalue())
+
+    def test_command_up_to_date(self):
+        call_command("renderbodies", stdout=StringIO())
+        output = StringIO()
+        call_command("renderbodies", stdout=output)
+        self.assertIn("Rendered 0 posts.", output.getvalue())
+        self.assertIn("Rendered 0 pages.", output.getvalue())
+
+    def test_command_force(self):
+        call_command("renderbodies", stdout=StringIO())
+        output = StringIO()
+        call_command("renderbodies", "--force", stdout=output)
+        self.assertIn("Rendered 1 posts.", output.getvalue())
+        self.assertIn("Rendered 1 pages.", output.getvalue())
+
+
+class RollupAnalyticsTest(TestCase):
+    """Test rollupanalytics recounts past days and deletes old raw hits."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="A post", slug="a-post"
+        )
+        now = timezone.now()
+        for days_ago in [0, 1, 5, 100]:
+            models.AnalyticPost.objects.create(
+                post=self.post, created_at=now - timedelta(days=days_ago)
+            )
+        self.today = now.date()
+
+    def get_daily_counts(self):
+        return dict(models.AnalyticPostDaily.objects.values_list("date", "count"))
+
+    def test_command(self):
+        output = StringIO()
+        call_command("rollupanalytics", stdout=output)
+
+        # only past days are recounted, today is kept up to date on flush
+        self.assertEqual(self.get_daily_counts(), {self.today - timedelta(days=1): 1})
+        self.assertEqual(models.AnalyticPost.objects.count(), 3)
+        self.assertIn("Deleted 1 raw hits", output.getvalue())
+
+    def test_command_all(self):
+        call_command("rollupanalytics", "--all", stdout=StringIO())
+        self.assertEqual(
+            self.get_daily_counts(),
+            {
+                self.today - timedelta(days=1): 1,
+                self.today - timedelta(days=5): 1,
+                self.today - timedelta(days=100): 1,
+            },
+        )
+        self.assertEqual(models.AnalyticPost.objects.count(), 3)
+
+    def test_command_retention_days(self):
+        with self.assertRaises(CommandError):
+            call_command("rollupanalytics", "--retention-days", "2", stdout=StringIO())
+        call_command(
+            "rollupanalytics", "--all", "--retention-days", "3", stdout=StringIO()
+        )
+        self.assertEqual(models.AnalyticPost.objects.count(), 2)
+        self.assertEqual(len(self.get_daily_counts()), 3)
+
+
+class IndexImagesTest(TestCase):
+    """Test indeximages records which images posts and pages use."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.image = models.Image.objects.create(
+            owner=self.user, name="vulf", slug="vulf", extension="jpeg"
+        )
+        models.Image.objects.create(
+            owner=self.user, name="unused", slug="unused", extension="png"
+        )
+        self.post = models.Post.objects.create(
+            owner=self.user, title="A post", slug="a-post", body="/images/vulf.jpeg"
+        )
+        self.page = models.Page.objects.create(
+            owner=self.user, title="A page", slug="a-page", body="/images/vulf.jpeg"
+        )
+        # simulate rows that existed before references were stored
+        models.Post.images.through.objects.all().delete()
+        models.Page.images.through.objects.all().delete()
+
+    def test_command(self):
+        output = StringIO()
+        call_command("indeximages", "--batch-size", "1", stdout=output)
+
+        self.assertEqual(list(self.post.images.all()), [self.image])
+        self.assertEqual(list(self.page.images.all()), [self.image])
+        self.assertIn("Indexed 1 post images.", output.getvalue())
+        self.assertIn("Indexed 1 page images.", output.getvalue())
+        self.assertIn("1 images are not used", output.getvalue())
+
+    def test_command_again(self):
+        call_command("indeximages", stdout=StringIO())
+        call_command("indeximages", stdout=StringIO())
+        self.assertEqual(self.image.post_set.count(), 1)
+
+
+def fake_resize(source_path, width, output_path):
+    output_path.write_bytes(b"v" * width)
+
+
+@override_settings(IMAGE_VARIANT_WIDTHS=[100, 2000], IMAGE_VARIANT_WEBP=True)
+class MakeImageVariantsTest(TestCase):
+    """Test makeimagevariants keeps variants smaller than the original."""
+
+    def setUp(self):
+        image_root = tempfile.TemporaryDirectory()
+        self.addCleanup(image_root.cleanup)
+        settings_override = override_settings(IMAGE_ROOT=image_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice")
+        self.images = []
+        for i, image_storage in enumerate([storage.DATABASE, storage.FILESYSTEM]):
+            image = models.Image(
+                owner=self.user, name=f"image{i}", slug=f"image{i}", extension="png"
+            )
+            storage.store(image, b"x" * 1000, image_storage)
+            image.save()
+            self.images.append(image)
+        models.Image.objects.create(
+            owner=self.user, name="anim", slug="anim", extension="gif", data=b"gif"
+        )
+
+    @patch.object(variants, "resize", side_effect=fake_resize)
+    def test_command(self, resize):
+        output = StringIO()
+        call_command("makeimagevariants", "--batch-size", "1", stdout=output)
+
+        self.assertIn("Made 4 variants of 2 images.", output.getvalue())
+        for image in self.images:
+            for extension in ["png", "webp"]:
+                path = variants.get_path(image.slug, 100, extension)
+                self.assertEqual(path.read_bytes(), b"v" * 100)
+                path = variants.get_path(image.slug, 2000, extension)
+                self.assertFalse(path.exists())
+        self.assertFalse(
+            models.Image.objects.filter(
+                extension="png", variants_made_at__isnull=True
+            ).exists()
+        )
+
+        output = StringIO()
+        call_command("makeimagevariants", stdout=output)
+        self.assertIn("Made 0 variants of 0 images.", output.getvalue())
+        call_command("makeimagevariants", "--all", stdout=output)
+        self.assertIn("Made 4 variants of 2 images.", output.getvalue())
+
+    @patch.object(variants, "resize", side_effect=OSError("bad"))
+    def test_command_failure(self, resize):
+        error = StringIO()
+        call_command("makeimagevariants", stdout=StringIO(), stderr=error)
+        self.assertIn("Failed to resize image image0: bad", error.getvalue())
+        self.assertIn("Failed to resize image image1: bad", error.getvalue())
+        # tried again on the next run
+        self.assertEqual(
+            models.Image.objects.filter(
+                extension="png", variants_made_at__isnull=True
+            ).count(),
+            2,
+        )
+
+    def test_corrupt_image(self):
+        output = StringIO()
+        error = StringIO()
+        call_command("makeimagevariants", stdout=output, stderr=error)
+        self.assertIn("Made 0 variants of 2 images.", output.getvalue())
+        self.assertIn("Failed to resize image image0", error.getvalue())
+
+    def test_resize(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for extension in ["jpeg", "webp"]:
+                output_path = Path(tmp_dir) / f"vulf.{extension}"
+                variants.resize("main/tests/testdata/vulf.jpeg", 100, output_path)
+                with PIL.Image.open(output_path) as image:
+                    self.assertEqual(image.format, extension.upper())
+                    self.assertEqual(image.width, 100)
+
+            # never wider than the original
+            output_path = Path(tmp_dir) / "vulf-large.jpeg"
+            variants.resize("main/tests/testdata/vulf.jpeg", 100000, output_path)
+            with (
+                PIL.Image.open(output_path) as image,
+                PIL.Image.open("main/tests/testdata/vulf.jpeg") as original,
+            ):
+                self.assertEqual(image.size, original.size)
+
+
+class MoveImagesTest(TestCase):
+    """Test moveimages moves image data to the filesystem and back."""
+
+    def setUp(self):
+        image_root = tempfile.TemporaryDirectory()
+        self.addCleanup(image_root.cleanup)
+        self.image_root = Path(image_root.name)
+        settings_override = override_settings(IMAGE_ROOT=image_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice")
+        for i in range(3):
+            models.Image.objects.create(
+                owner=self.user,
+                name=f"image{i}",
+                slug=f"image{i}",
+                extension="png",
+                data=f"data{i}".encode(),
+            )
+
+    def test_command(self):
+        output = StringIO()
+        call_command("moveimages", "--batch-size", "2", stdout=output)
+        self.assertIn("Moved 3 images.", output.getvalue())
+        for image in models.Image.objects.all():
+            self.assertEqual(image.storage, storage.FILESYSTEM)
+            self.assertIsNone(image.data)
+            self.assertEqual(
+                (self.image_root / image.filename).read_bytes(),
+                f"data{image.name[-1]}".encode(),
+            )
+
+        output = StringIO()
+        call_command("moveimages", "--to", "database", stdout=output)
+        self.assertIn("Moved 3 images.", output.getvalue())
+        for image in models.Image.objects.all():
+            self.assertEqual(image.storage, storage.DATABASE)
+            self.assertEqual(bytes(image.data), f"data{image.name[-1]}".encode())
+        self.assertEqual(list(self.image_root.iterdir()), [])
+
+    def test_served_after_move(self):
+        url = reverse("image_raw", args=("image0", "png"))
+        self.client.get(url)
+        cache_key = storage.get_info_cache_key("image0")
+        cached_info = cache.get(cache_key)
+        for target in [storage.FILESYSTEM, storage.DATABASE]:
+            call_command("moveimages", "--to", target, stdout=StringIO())
+            self.assertIsNone(cache.get(cache_key))
+
+            # another process still has the info of before the move cached
+            cache.set(cache_key, cached_info)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response), b"data0")
+            self.assertIsNone(cache.get(cache_key))
+            cached_info = {**cached_info, "storage": target}
+
+    def test_command_up_to_date(self):
+        output = StringIO()
+        call_command("moveimages", "--to", "database", stdout=output)
+        self.assertIn("Moved 0 images.", output.getvalue())
@@ -0,0 +1,137 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from main import models
+from main.middleware import get_host_cache_key, host_middleware
+
+
+class HostCacheTestCase(TestCase):
+    """Test blog host resolution is cached and invalidated on user changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create(username="alice")
+        self.middleware = host_middleware(lambda request: HttpResponse())
+
+    def get(self, host):
+        request = RequestFactory().get("/", HTTP_HOST=host)
+        request.user = AnonymousUser()
+        self.middleware(request)
+        return request
+
+    def test_subdomain_cached(self):
+        host = f"alice.{settings.CANONICAL_HOST}"
+        with self.assertNumQueries(1):
+            request = self.get(host)
+        with self.assertNumQueries(0):
+            request = self.get(host)
+        self.assertEqual(request.blog_user, self.user)
+
+    def test_custom_domain_cached(self):
+        self.user.custom_domain = "example.com"
+        self.user.save()
+        with self.assertNumQueries(1):
+            request = self.get("example.com")
+        with self.assertNumQueries(0):
+            request = self.get("example.com")
+        self.assertEqual(request.blog_user, self.user)
+        self.assertEqual(request.subdomain, "alice")
+
+    def test_miss_cached(self):
+        host = f"bob.{settings.CANONICAL_HOST}"
+        with self.assertNumQueries(1), self.assertRaises(Http404):
+            self.get(host)
+        with self.assertNumQueries(0), self.assertRaises(Http404):
+            self.get(host)
+
+    def test_miss_invalidated_on_create(self):
+        host = f"bob.{settings.CANONICAL_HOST}"
+        with self.assertRaises(Http404):
+            self.get(host)
+        bob = models.User.objects.create(username="bob")
+        self.assertEqual(self.get(host).blog_user, bob)
+
+    def test_invalidated_on_username_change(self):
+        self.get(f"alice.{settings.CANONICAL_HOST}")
+        self.user.username = "alicia"
+        self.user.save()
+        with self.assertRaises(Http404):
+            self.get(f"alice.{settings.CANONICAL_HOST}")
+        self.assertEqual(
+            self.get(f"alicia.{settings.CANONICAL_HOST}").blog_user, self.user
+        )
+
+    def test_invalidated_on_custom_domain_change(self):
+        self.user.custom_domain = "example.com"
+        self.user.save()
+        self.get("example.com")
+        self.user.custom_domain = "example.org"
+        self.user.save()
+        request = RequestFactory().get("/", HTTP_HOST="example.com")
+        request.user = AnonymousUser()
+        self.assertEqual(self.middleware(request).status_code, 400)
+        self.assertEqual(self.get("example.org").blog_user, self.user)
+
+    def test_invalidated_on_redirect_domain_change(self):
+        self.get(f"alice.{settings.CANONICAL_HOST}")
+        self.user.redirect_domain = "example.com"
+        self.user.save()
+        request = RequestFactory().get(
+            "/", HTTP_HOST=f"alice.{settings.CANONICAL_HOST}"
+        )
+        request.user = AnonymousUser()
+        response = self.middleware(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, "//example.com")
+
+    def test_invalidated_on_delete(self):
+        self.get(f"alice.{settings.CANONICAL_HOST}")
+        self.user.delete()
+        with self.assertRaises(Http404):
+            self.get(f"alice.{settings.CANONICAL_HOST}")
+
+    def test_user_read_fresh(self):
+        # another worker saves the user: its signals do not reach this cache
+        host = f"alice.{settings.CANONICAL_HOST}"
+        self.get(host)
+        models.User.objects.filter(id=self.user.id).update(blog_title="New title")
+        request = self.get(host)
+        with self.assertNumQueries(1):
+            self.assertEqual(request.blog_user.blog_title, "New title")
+
+    def test_user_deleted_elsewhere(self):
+        # another worker deletes the user, this one still has its host cached
+        host = f"alice.{settings.CANONICAL_HOST}"
+        self.get(host)
+        cache_key = get_host_cache_key("username", "alice")
+        blog_host = cache.get(cache_key)
+        self.user.delete()
+        cache.set(cache_key, blog_host)
+        request = self.get(host)
+        with self.assertRaises(Http404):
+            self.assertIsNone(request.blog_user.username)
+
+
+class HostCacheOtherWorkerTestCase(TestCase):
+    """Test blog pages show user changes made by another worker."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create(username="alice", blog_title="Old title")
+        self.host = f"alice.{settings.CANONICAL_HOST}"
+
+    def test_page_fresh(self):
+        response = self.client.get("/", HTTP_HOST=self.host)
+        self.assertContains(response, "Old title")
+
+        # as saved in another worker, with its own cache
+        models.User.objects.filter(id=self.user.id).update(
+            blog_title="New title", blog_modified_at=timezone.now()
+        )
+        response = self.client.get("/", HTTP_HOST=self.host)
+        self.assertContains(response, "New title")
+        self.assertNotContains(response, "Old title")
@@ -0,0 +1,252 @@
+from datetime import date, datetime, timedelta
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from main import analytics, feeds, models, util
+
+
+class PageCacheTestCase(TestCase):
+    """Test anonymous blog responses are cached and invalidated on changes."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Welcome post",
+            slug="welcome-post",
+            body="Content sentence.",
+            published_at=date(2020, 1, 1),
+        )
+        self.page = models.Page.objects.create(
+            owner=self.user, title="About", slug="about", body="About this blog."
+        )
+        self.host = self.user.username + "." + settings.CANONICAL_HOST
+
+    def get(self, url):
+        return self.client.get(url, HTTP_HOST=self.host)
+
+    def test_cached(self):
+        self.assertContains(self.get(reverse("index")), "Welcome post")
+        # update() skips signals, so the blog is not marked as modified
+        models.Post.objects.filter(id=self.post.id).update(title="Edited post")
+        self.assertContains(self.get(reverse("index")), "Welcome post")
+        self.assertContains(self.get(reverse("rss_feed")), "Edited post")
+        models.Post.objects.filter(id=self.post.id).update(title="Edited again")
+        self.assertContains(self.get(reverse("rss_feed")), "Edited post")
+
+    def test_cached_analytics_counted(self):
+        for _ in range(2):
+            self.get(reverse("index"))
+            self.get(reverse("post_detail", args=(self.post.slug,)))
+            self.get(reverse("page_detail", args=(self.page.slug,)))
+            self.get(reverse("rss_feed"))
+        analytics.flush()
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="index").count(), 2
+        )
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="about").count(), 2
+        )
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="rss").count(), 2
+        )
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    def test_invalidated_on_post_save(self):
+        self.get(reverse("post_detail", args=(self.post.slug,)))
+        self.post.body = "Edited sentence."
+        self.post.save()
+        response = self.get(reverse("post_detail", args=(self.post.slug,)))
+        self.assertContains(response, "Edited sentence.")
+
+    def test_invalidated_on_post_delete(self):
+        self.get(reverse("index"))
+        self.post.delete()
+        self.assertNotContains(self.get(reverse("index")), "Welcome post")
+
+    def test_invalidated_on_page_save(self):
+        self.get(reverse("index"))
+        self.page.title = "Colophon"
+        self.page.save()
+        self.assertContains(self.get(reverse("index")), "Colophon")
+
+    def test_invalidated_on_user_save(self):
+        self.get(reverse("index"))
+        self.user.blog_title = "Alice writes"
+        self.user.save()
+        self.assertContains(self.get(reverse("index")), "Alice writes")
+
+    def test_scheduled_post_appears(self):
+        models.Post.objects.create(
+            owner=self.user,
+            title="Scheduled post",
+            slug="scheduled-post",
+            published_at=timezone.now().date() + timedelta(days=1),
+        )
+        self.assertNotContains(self.get(reverse("index")), "Scheduled post")
+        tomorrow = timezone.now() + timedelta(days=1)
+        with patch.object(timezone, "now", return_value=tomorrow):
+            self.assertContains(self.get(reverse("index")), "Scheduled post")
+
+    def test_owner_not_cached(self):
+        self.get(reverse("index"))
+        draft = models.Post.objects.create(
+            owner=self.user, title="Draft post", slug="draft-post", published_at=None
+        )
+        models.Post.objects.filter(id=draft.id).update(title="Edited draft")
+        self.client.force_login(self.user)
+        self.assertContains(self.get(reverse("index")), "Edited draft")
+
+    def test_messages_not_cached(self):
+        self.client.cookies["messages"] = "pending"
+        self.get(reverse("index"))
+        models.Post.objects.filter(id=self.post.id).update(title="Edited post")
+        self.assertContains(self.get(reverse("index")), "Edited post")
+
+    @override_settings(PAGE_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        self.get(reverse("index"))
+        models.Post.objects.filter(id=self.post.id).update(title="Edited post")
+        self.assertContains(self.get(reverse("index")), "Edited post")
+
+    def test_last_login_does_not_invalidate(self):
+        self.user.refresh_from_db()
+        blog_modified_at = self.user.blog_modified_at
+        with patch.object(timezone, "now", return_value=datetime(2030, 1, 1)):
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=["last_login"])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.blog_modified_at, blog_modified_at)
+
+
+class ConditionalGetTestCase(TestCase):
+    """Test anonymous blog responses carry validators and honour them."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Welcome post",
+            slug="welcome-post",
+            body="Content sentence.",
+            published_at=date(2020, 1, 1),
+        )
+        self.host = self.user.username + "." + settings.CANONICAL_HOST
+
+    def get(self, url, **headers):
+        return self.client.get(url, HTTP_HOST=self.host, headers=headers)
+
+    def test_validators(self):
+        for url in [
+            reverse("rss_feed"),
+            reverse("atom_feed"),
+            reverse("sitemap"),
+            reverse("post_detail", args=(self.post.slug,)),
+        ]:
+            response = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("ETag", response.headers)
+            self.assertIn("Last-Modified", response.headers)
+            self.assertEqual(
+                self.get(url, if_none_match=response.headers["ETag"]).status_code, 304
+            )
+            self.assertEqual(
+                self.get(
+                    url, if_modified_since=response.headers["Last-Modified"]
+                ).status_code,
+                304,
+            )
+
+    def test_not_modified_skips_view(self):
+        etag = self.get(reverse("rss_feed")).headers["ETag"]
+        with patch.object(feeds.RSSBlogFeed, "items") as items:
+            response = self.get(reverse("rss_feed"), if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+        items.assert_not_called()
+
+    def test_not_modified_analytics_counted(self):
+        etag = self.get(reverse("rss_feed")).headers["ETag"]
+        self.get(reverse("rss_feed"), if_none_match=etag)
+        analytics.flush()
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="rss").count(), 2
+        )
+
+    def test_not_modified_analytics_counted_uncached(self):
+        # a worker that did not cache the response gets the conditional GET
+        etag = self.get(reverse("rss_feed")).headers["ETag"]
+        cache.clear()
+        response = self.get(reverse("rss_feed"), if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        with patch.object(feeds.RSSBlogFeed, "items") as items:
+            response = self.get(reverse("rss_feed"), if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        items.assert_not_called()
+        analytics.flush()
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="rss").count(), 3
+        )
+
+    @override_settings(PAGE_CACHE_TIMEOUT=0)
+    def test_not_modified_not_rendered(self):
+        etag = self.get(reverse("rss_feed")).headers["ETag"]
+        with (
+            patch.object(models.Post, "render_body") as render_body,
+            patch.object(util, "md_to_html") as md_to_html,
+        ):
+            response = self.get(reverse("rss_feed"), if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        render_body.assert_not_called()
+        md_to_html.assert_not_called()
+
+    def test_not_modified_post_counted(self):
+        url = reverse("post_detail", args=(self.post.slug,))
+        etag = self.get(url).headers["ETag"]
+        cache.clear()
+        self.assertEqual(self.get(url, if_none_match=etag).status_code, 304)
+        analytics.flush()
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    def test_modified_on_post_save(self):
+        etag = self.get(reverse("rss_feed")).headers["ETag"]
+        self.post.title = "Edited post"
+        self.post.save()
+        response = self.get(reverse("rss_feed"), if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Edited post")
+
+    def test_modified_on_user_save(self):
+        etag = self.get(reverse("rss_feed")).headers["ETag"]
+        self.user.blog_title = "Alice writes"
+        self.user.save()
+        response = self.get(reverse("rss_feed"), if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Alice writes")
+
+    def test_modified_on_scheduled_post_day(self):
+        models.Post.objects.create(
+            owner=self.user,
+            title="Scheduled post",
+            slug="scheduled-post",
+            published_at=timezone.now().date() + timedelta(days=1),
+        )
+        response = self.get(reverse("rss_feed"))
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+        tomorrow = timezone.now() + timedelta(days=1)
+        with patch.object(timezone, "now", return_value=tomorrow):
+            response = self.get(reverse("rss_feed"), if_none_match=etag)
+            self.assertContains(response, "Scheduled post")
+            response = self.get(reverse("rss_feed"), if_modified_since=last_modified)
+            self.assertContains(response, "Scheduled post")
+
+    def test_owner_no_validators(self):
+        self.client.force_login(self.user)
+        response = self.get(reverse("rss_feed"))
+        self.assertNotIn("ETag", response.headers)
@@ -75,6 +75,30 @@ class PageDetailTestCase(TestCase):
         self.assertContains(response, self.data["body"])
 
 
+class PageRenderedBodyTestCase(TestCase):
+    """Test rendered HTML of page body is stored alongside it."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.page = models.Page.objects.create(
+            owner=self.user, title="New page", slug="new-page", body="Some *content*."
+        )
+
+    def test_rendered_on_save(self):
+        page = models.Page.objects.get(id=self.page.id)
+        self.assertEqual(page.body_html, "<p>Some <em>content</em>.</p>\n")
+
+        page.body = "Other **content**."
+        page.save()
+        page = models.Page.objects.get(id=self.page.id)
+        self.assertEqual(page.body_html, "<p>Other <strong>content</strong>.</p>\n")
+
+    def test_stale_not_served(self):
+        models.Page.objects.filter(id=self.page.id).update(body="Bulk *body*.")
+        page = models.Page.objects.get(id=self.page.id)
+        self.assertEqual(page.body_as_html, "<p>Bulk <em>body</em>.</p>\n")
+
+
 class PageNonHiddenTestCase(TestCase):
     def setUp(self):
         self.user = models.User.objects.create(username="alice")
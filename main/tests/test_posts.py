@@ -1,8 +1,10 @@
+from unittest.mock import patch
+
 from django.conf import settings
 from django.test import TestCase
 from django.urls import reverse
 
-from main import models
+from main import models, util
 
 
 class PostCreateTestCase(TestCase):
@@ -165,6 +167,49 @@ class PostSanitizeHTMLTestCase(TestCase):
         self.assertFalse("<script>" in post.body_as_html)
 
 
+class PostRenderedBodyTestCase(TestCase):
+    """Test rendered HTML and text of post body are stored alongside it."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="New post", slug="new-post", body="Some *content*."
+        )
+
+    def test_rendered_on_create(self):
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_html, "<p>Some <em>content</em>.</p>\n")
+        self.assertEqual(post.body_text, "Some content.\n")
+        self.assertEqual(post.body_render_key, util.get_render_key(post.body))
+
+    def test_rendered_on_update(self):
+        self.post.body = "Other **content**."
+        self.post.save()
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_html, "<p>Other <strong>content</strong>.</p>\n")
+        self.assertEqual(post.body_text, "Other content.\n")
+
+    def test_rendered_on_update_fields(self):
+        self.post.body = "Other **content**."
+        self.post.save(update_fields=["body"])
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_html, "<p>Other <strong>content</strong>.</p>\n")
+
+    def test_stale_not_served(self):
+        # bulk updates skip save(), stale renders must not be served
+        models.Post.objects.filter(id=self.post.id).update(body="Bulk *body*.")
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_as_html, "<p>Bulk <em>body</em>.</p>\n")
+        self.assertEqual(post.body_as_text, "Bulk body.\n")
+
+    def test_not_rerendered(self):
+        post = models.Post.objects.get(id=self.post.id)
+        with patch.object(util, "render_markdown") as render_markdown:
+            self.assertEqual(post.body_as_html, "<p>Some <em>content</em>.</p>\n")
+            self.assertEqual(post.body_as_text, "Some content.\n")
+        render_markdown.assert_not_called()
+
+
 class PostUpdateTestCase(TestCase):
     def setUp(self):
         self.user = models.User.objects.create(username="alice")
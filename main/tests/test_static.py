@@ -1,5 +1,12 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
+
+from main import models
 
 
 class StaticTestCase(TestCase):
@@ -20,3 +27,58 @@ class StaticTestCase(TestCase):
         """Test export index page as an anon user."""
         response = self.client.get(reverse("export_index"))
         self.assertEqual(response.status_code, 200)
+
+
+class TransparencyStatsTestCase(TestCase):
+    def setUp(self):
+        old = timezone.now() - timedelta(days=60)
+        self.alice = models.User.objects.create(
+            username="alice", is_premium=True, date_joined=old
+        )
+        self.bob = models.User.objects.create(username="bob")
+        models.User.objects.create(username="carol")
+        for i in range(2):
+            models.Post.objects.create(owner=self.alice, title=f"A{i}", slug=f"a{i}")
+        models.Post.objects.create(
+            owner=self.bob, title="B", slug="b", published_at=None
+        )
+        models.Page.objects.create(owner=self.bob, title="About", slug="about")
+
+    def test_take(self):
+        stats = models.InstanceStats.objects.take()
+        self.assertEqual(stats.users, 3)
+        self.assertEqual(stats.premium_users, 1)
+        self.assertEqual(stats.posts, 3)
+        self.assertEqual(stats.published_posts, 2)
+        self.assertEqual(stats.pages, 1)
+        self.assertEqual(
+            (stats.zero_users, stats.one_users, stats.twoplus_users), (1, 1, 1)
+        )
+        self.assertEqual(stats.active_users, 2)
+        self.assertEqual(stats.active_nonnew_users, 1)
+        today = timezone.now().date()
+        self.assertEqual(
+            stats.new_users_per_day,
+            [
+                {"date": today.isoformat(), "count": 2},
+                {"date": (today - timedelta(days=60)).isoformat(), "count": 1},
+            ],
+        )
+
+    def test_page(self):
+        call_command("updateinstancestats", stdout=StringIO())
+        call_command("updateinstancestats", stdout=StringIO())
+        self.assertEqual(models.InstanceStats.objects.count(), 1)
+
+        # counts are not recomputed per request
+        models.User.objects.create(username="dave")
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("transparency"))
+        self.assertContains(response, "<div>3</div>")
+        self.assertContains(response, "<div>1 (33%)</div>")
+        self.assertContains(response, "2 new users signed up")
+
+    def test_page_without_stats(self):
+        response = self.client.get(reverse("transparency"))
+        self.assertContains(response, "<div>3</div>")
+        self.assertEqual(models.InstanceStats.objects.count(), 1)
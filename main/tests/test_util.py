@@ -0,0 +1,80 @@
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from main import util
+
+
+class MarkdownCacheTestCase(TestCase):
+    """Test md_to_html caches rendered markdown in a bounded LRU cache."""
+
+    def setUp(self):
+        util.md_cache.clear()
+
+    def test_cache_hit(self):
+        self.assertEqual(util.md_to_html("*byline*"), "<p><em>byline</em></p>\n")
+        with patch.object(util, "render_markdown") as render_markdown:
+            self.assertEqual(util.md_to_html("*byline*"), "<p><em>byline</em></p>\n")
+        render_markdown.assert_not_called()
+
+        info = util.md_cache.info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.currsize, 1)
+
+    def test_cache_key_strip_tags(self):
+        self.assertEqual(util.md_to_html("*byline*"), "<p><em>byline</em></p>\n")
+        self.assertEqual(
+            util.md_to_html("*byline*", strip_tags=True), "<em>byline</em>\n"
+        )
+        self.assertEqual(util.md_cache.info().misses, 2)
+
+    @override_settings(MARKDOWN_CACHE_SIZE=2)
+    def test_cache_eviction(self):
+        util.md_to_html("one")
+        util.md_to_html("two")
+        util.md_to_html("one")  # one is now most recently used
+        util.md_to_html("three")  # evicts two
+
+        info = util.md_cache.info()
+        self.assertEqual(info.evictions, 1)
+        self.assertEqual(info.currsize, 2)
+        self.assertEqual(info.maxsize, 2)
+
+        util.md_to_html("one")
+        util.md_to_html("two")
+        self.assertEqual(util.md_cache.info().hits, 2)
+        self.assertEqual(util.md_cache.info().misses, 4)
+
+    @override_settings(MARKDOWN_CACHE_SIZE=0)
+    def test_cache_disabled(self):
+        util.md_to_html("one")
+        util.md_to_html("one")
+        self.assertEqual(util.md_cache.info().misses, 2)
+        self.assertEqual(util.md_cache.info().currsize, 0)
+
+    def test_empty(self):
+        self.assertEqual(util.md_to_html(""), "")
+        self.assertEqual(util.md_to_html(None), "")
+        self.assertEqual(util.md_cache.info().misses, 0)
+
+
+class ParseByteRangeTestCase(TestCase):
+    def test_ranges(self):
+        self.assertEqual(util.parse_byte_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(util.parse_byte_range("bytes=90-200", 100), (90, 99))
+        self.assertEqual(util.parse_byte_range("bytes=10-", 100), (10, 99))
+        self.assertEqual(util.parse_byte_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(util.parse_byte_range("bytes=-200", 100), (0, 99))
+
+    def test_ignored(self):
+        self.assertIsNone(util.parse_byte_range("bytes=0-9,20-29", 100))
+        self.assertIsNone(util.parse_byte_range("bytes=9-0", 100))
+        self.assertIsNone(util.parse_byte_range("bytes=-", 100))
+        self.assertIsNone(util.parse_byte_range("lines=0-9", 100))
+
+    def test_not_satisfiable(self):
+        with self.assertRaises(ValueError):
+            util.parse_byte_range("bytes=100-", 100)
+        with self.assertRaises(ValueError):
+            util.parse_byte_range("bytes=-0", 100)
@@ -156,6 +156,8 @@ urlpatterns += [
     path("api/docs/", api.api_docs, name="api_docs"),
     path("api/reset/", api.APIKeyReset.as_view(), name="api_reset"),
     path("api/posts/", api.api_posts, name="api_posts"),
+    path("api/changes/", api.api_changes, name="api_changes"),
+    path("api/batch/", api.api_batch, name="api_batch"),
     path("api/posts/<slug:slug>/", api.api_post, name="api_post"),
 ]
 
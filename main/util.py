@@ -1,17 +1,42 @@
-import io
+import hashlib
 import re
+import threading
 import uuid
 import zipfile
+from collections import OrderedDict, namedtuple
 
 import bleach
+import marko
 from bleach.css_sanitizer import CSSSanitizer
 from django.conf import settings
+from django.db import transaction
 from django.utils.text import slugify
 from marko import Markdown
 
 from main import denylist, models
 
-md = Markdown(extensions=["gfm", "codehilite", "footnote"])
+MARKDOWN_EXTENSIONS = ["gfm", "codehilite", "footnote"]
+
+md = Markdown(extensions=MARKDOWN_EXTENSIONS)
+
+# Bump when rendering changes in a way the fingerprint below does not capture,
+# so that all stored body renders are considered stale.
+RENDER_VERSION = 1
+
+# Identifies the renderer and sanitizer config that stored renders came from.
+RENDER_FINGERPRINT = hashlib.sha256(
+    repr(
+        (
+            RENDER_VERSION,
+            marko.__version__,
+            bleach.__version__,
+            MARKDOWN_EXTENSIONS,
+            denylist.ALLOWED_HTML_ELEMENTS,
+            denylist.ALLOWED_HTML_ATTRS,
+            denylist.ALLOWED_CSS_STYLES,
+        )
+    ).encode()
+).hexdigest()
 
 
 def is_disallowed(username):
@@ -31,17 +56,34 @@ def get_approx_number(number):
     return number
 
 
-def create_post_slug(post_title, owner, post=None):
-    """
-    Generate slug given post title. Optional post arg for post that already
-    exists.
-    """
+def get_slug(post_title):
+    """Slugify post title, or generate a random slug if nothing is left of it."""
     slug = slugify(post_title)
 
     # in case of post_title such as این متن است
     if not slug:
         generated_uuid = str(uuid.uuid4())[:8]
         slug = f"{generated_uuid[:3]}-{generated_uuid[3:5]}-{generated_uuid[5:]}"
+    return slug
+
+
+def get_unique_slug(slug, taken_slugs):
+    """
+    Return slug, with a suffix if it is in taken_slugs, and add it to them. For
+    allocating the slugs of many posts with one query for those taken.
+    """
+    if slug in taken_slugs:
+        slug += "-" + str(uuid.uuid4())[:8]
+    taken_slugs.add(slug)
+    return slug
+
+
+def create_post_slug(post_title, owner, post=None):
+    """
+    Generate slug given post title. Optional post arg for post that already
+    exists.
+    """
+    slug = get_slug(post_title)
 
     # if post is not None, then this is an update op
     if post is not None:
@@ -80,8 +122,69 @@ def clean_html(dirty_html, strip_tags=False):
     )
 
 
-def md_to_html(markdown_string, strip_tags=False):
-    """Return HTML formatted string, given a markdown one."""
+CacheInfo = namedtuple(
+    "CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"]
+)
+
+
+class RenderCache:
+    """
+    Bounded, least-recently-used cache of rendered markdown. It lives in
+    process memory, so each worker keeps its own.
+
+    Size is read from settings.MARKDOWN_CACHE_SIZE on every insert; 0 disables.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        maxsize = settings.MARKDOWN_CACHE_SIZE
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                maxsize=settings.MARKDOWN_CACHE_SIZE,
+                currsize=len(self._entries),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+md_cache = RenderCache()
+
+
+def render_markdown(markdown_string, strip_tags=False):
+    """Return HTML formatted string, given a markdown one. Does not use cache."""
     if not markdown_string:
         return ""
 
@@ -89,6 +192,80 @@ def md_to_html(markdown_string, strip_tags=False):
     return clean_html(dirty_html, strip_tags)
 
 
+def md_to_html(markdown_string, strip_tags=False):
+    """
+    Return HTML formatted string, given a markdown one. Meant for short, often
+    repeated markdown such as bylines and footers, so results are kept in an
+    in-process LRU cache keyed by the markdown digest.
+    """
+    if not markdown_string:
+        return ""
+
+    key = (hashlib.sha256(markdown_string.encode()).digest(), strip_tags)
+    html = md_cache.get(key)
+    if html is None:
+        html = render_markdown(markdown_string, strip_tags)
+        md_cache.set(key, html)
+    return html
+
+
+def html_to_text(html):
+    """Return plain text of given HTML, with all tags stripped."""
+    return bleach.clean(html, strip=True, tags=[])
+
+
+def get_render_key(markdown_string):
+    """
+    Return key that changes whenever the rendered output of the given markdown
+    would change, ie. when either the markdown or the renderer config changes.
+    """
+    render_key = hashlib.sha256(RENDER_FINGERPRINT.encode())
+    render_key.update((markdown_string or "").encode())
+    return render_key.hexdigest()
+
+
+# raw image URL, or variant URL with ?w=, see image_raw
+IMAGE_URL_RE = re.compile(r"/images/([\w-]+)\.(\w+)(\?w=\d+)?")
+
+
+def get_image_refs(markdown_string):
+    """
+    Return the slug and extension of each raw image URL in given markdown. The
+    extension of variant URLs is None: a variant can be of another format than
+    its image, eg. WebP, see main.variants.
+    """
+    return {
+        (slug, None if variant else extension)
+        for slug, extension, variant in IMAGE_URL_RE.findall(markdown_string or "")
+    }
+
+
+def set_image_refs(model, objs):
+    """
+    Record which images the bodies of objs, posts or pages, link to, with
+    one query for the images and one for the references of all of them.
+    Returns the number of references.
+    """
+    through = model.images.through
+    field_name = model.images.field.m2m_field_name()
+    refs = {obj.id: get_image_refs(obj.body) for obj in objs}
+    images = models.Image.objects.referenced_by(set().union(*refs.values()))
+    image_ids = {}
+    for image_id, slug, extension in images.values_list("id", "slug", "extension"):
+        image_ids[(slug, extension)] = image_id
+        image_ids[(slug, None)] = image_id
+    rows = [
+        through(**{field_name + "_id": obj_id, "image_id": image_ids[ref]})
+        for obj_id, obj_refs in refs.items()
+        for ref in obj_refs
+        if ref in image_ids
+    ]
+    with transaction.atomic():
+        through.objects.filter(**{field_name + "_id__in": refs}).delete()
+        through.objects.bulk_create(rows)
+    return len(rows)
+
+
 def remove_control_chars(text):
     """Remove control characters from a string.
 
@@ -108,36 +285,69 @@ def get_protocol():
         return "https:"
 
 
-def generate_markdown_export(user_id):
-    """
-    Generates a markdown export ZIP file in /tmp/.
-    Returns (export name, export filepath).
-    """
-    # compile all posts into dictionary
-    user = models.User.objects.get(id=user_id)
-    user_posts = models.Post.objects.filter(owner=user)
-    export_posts = []
-    for p in user_posts:
-        pub_date = p.published_at or p.created_at
-        title = p.slug + ".md"
-        body = f"# {p.title}\n\n"
-        body += f"> Published on {pub_date.strftime('%b %-d, %Y')}\n\n"
-        body += f"{p.body}\n"
-        export_posts.append((title, io.BytesIO(body.encode())))
-
-    # write zip archive in /tmp/
-    export_name = "export-markdown-" + str(uuid.uuid4())[:8]
-    container_dir = f"{user.username}-mataroa-blog"
-    zip_outfile = f"/tmp/{export_name}.zip"
-    with zipfile.ZipFile(
-        zip_outfile, "a", zipfile.ZIP_DEFLATED, False
-    ) as export_archive:
-        for file_name, data in export_posts:
-            export_archive.writestr(
-                export_name + f"/{container_dir}/" + file_name, data.getvalue()
-            )
+class ZipStream:
+    """
+    Write-only file object for zipfile which hands out the bytes written to it
+    as they come. ZipFile sees it is unseekable and writes data descriptors
+    after each file instead of seeking back to fill in local headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
 
-    return (export_name, zip_outfile)
+    def flush(self):
+        pass
+
+    def take(self):
+        """Return and forget everything written so far."""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files):
+    """
+    Yield the bytes of a zip archive of (name, content) pairs, chunk by chunk as
+    each file is added, so that only one file is held in memory at a time.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+            if data := stream.take():
+                yield data
+    if data := stream.take():
+        yield data
+
+
+def parse_byte_range(range_header, size):
+    """
+    Return the first and last byte positions that a Range header asks for out
+    of size bytes, or None if it is malformed or asks for several ranges, in
+    which case the whole content is served. Raise ValueError if the range is
+    not satisfiable.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+
+    # bytes=-n: the last n bytes
+    if not first:
+        if int(last) == 0:
+            raise ValueError("Empty suffix range.")
+        return max(size - int(last), 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("Range starts past the end.")
+    return first, min(int(last), size - 1) if last else size - 1
 
 
 def escape_quotes(input_string):
@@ -0,0 +1,117 @@
+"""
+Smaller versions of uploaded images, to serve in place of the originals.
+
+The makeimagevariants command, run every few minutes by a systemd timer,
+resizes images uploaded since its last run to each of IMAGE_VARIANT_WIDTHS
+with Pillow, and also converts them to WebP if IMAGE_VARIANT_WEBP is set.
+Uploads never wait for it.
+
+Variants are files named IMAGE_ROOT/variants/<width>/<slug>.<extension>, and
+are served for /images/<slug>.<extension>?w=<width> by Caddy if they exist and
+by image_raw otherwise. The WebP variant of a JPEG image is requested as
+/images/<slug>.webp?w=<width>. Until a variant exists, or if it would not be
+smaller than the original, image_raw serves the original in its place, with a
+short lived Cache-Control so that browsers pick up the variant later.
+"""
+
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from main import storage
+
+SOURCE_EXTENSIONS = ["jpeg", "png", "webp"]
+WEBP = "webp"
+
+# Pillow format and save options of each variant extension
+FORMATS = {
+    "jpeg": ("JPEG", {"quality": 80, "optimize": True, "progressive": True}),
+    "png": ("PNG", {"optimize": True}),
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+}
+
+# errors of images Pillow cannot read or resize, eg. corrupt or too large
+RESIZE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+def get_width(value):
+    """Return the variant width a ?w= value asks for, or None."""
+    try:
+        width = int(value)
+    except (TypeError, ValueError):
+        return None
+    if width not in settings.IMAGE_VARIANT_WIDTHS:
+        return None
+    return width
+
+
+def get_extensions(extension):
+    """Return the extensions of the variants of an image of given extension."""
+    if extension not in SOURCE_EXTENSIONS:
+        return []
+    if settings.IMAGE_VARIANT_WEBP and extension != WEBP:
+        return [extension, WEBP]
+    return [extension]
+
+
+def get_path(slug, width, extension):
+    return Path(settings.IMAGE_ROOT) / "variants" / str(width) / f"{slug}.{extension}"
+
+
+def resize(source_path, width, output_path):
+    """
+    Write a copy of an image file at most width pixels wide, never wider,
+    in the format of output_path's extension and without metadata.
+    """
+    image_format, options = FORMATS[Path(output_path).suffix[1:]]
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        # palette and other modes only resize well in RGB
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        image.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(output_path, image_format, **options)
+
+
+def make(image):
+    """Write all variants of an image. Return how many are smaller than it."""
+    count_made = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if image.storage == storage.FILESYSTEM:
+            source_path = storage.get_path(image)
+        else:
+            source_path = Path(tmp_dir) / image.filename
+            source_path.write_bytes(storage.read(image))
+        source_size = source_path.stat().st_size
+
+        for width in settings.IMAGE_VARIANT_WIDTHS:
+            for extension in get_extensions(image.extension):
+                output_path = Path(tmp_dir) / f"variant-{width}.{extension}"
+                resize(source_path, width, output_path)
+                path = get_path(image.slug, width, extension)
+                if output_path.stat().st_size < source_size:
+                    storage.write_file(path, output_path.read_bytes())
+                    count_made += 1
+                else:
+                    path.unlink(missing_ok=True)
+    return count_made
+
+
+def delete(image):
+    """Delete the variants of an image once its deletion is committed."""
+    paths = [
+        get_path(image.slug, width, extension)
+        for width in settings.IMAGE_VARIANT_WIDTHS
+        for extension in get_extensions(image.extension)
+    ]
+
+    def delete_files():
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    transaction.on_commit(delete_files)
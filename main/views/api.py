@@ -1,16 +1,31 @@
+import hashlib
+import itertools
 import json
+from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.messages.views import SuccessMessageMixin
-from django.http import HttpResponseRedirect, JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse_lazy
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.generic.edit import FormView
 
-from main import forms, models, util
+from main import forms, models, signals, util
+
+# posts encoded into each chunk of the streamed post list
+POST_LIST_CHUNK_SIZE = 100
+
+# most operations a batch request can have, and posts saved per query
+BATCH_MAX_OPERATIONS = 500
+BATCH_CHUNK_SIZE = 100
 
 
 def api_docs(request):
@@ -20,6 +35,8 @@ def api_docs(request):
         {
             "host": settings.CANONICAL_HOST,
             "protocol": util.get_protocol(),
+            "sync_window": settings.API_SYNC_WINDOW,
+            "tombstone_retention_days": settings.POST_TOMBSTONE_RETENTION_DAYS,
         },
     )
 
@@ -57,6 +74,79 @@ def _authenticate_token(request):
     return users_from_token.first()
 
 
+def get_post_url_format(user):
+    """Return the URL of user's posts with {} for the slug, to reverse it once."""
+    placeholder = "post-slug"
+    url = (
+        util.get_protocol()
+        + models.Post(owner=user, slug=placeholder).get_absolute_url()
+    )
+    prefix, suffix = url.rsplit(placeholder, 1)
+    return prefix + "{}" + suffix
+
+
+def get_post_values(posts, fields):
+    """Select only the columns given fields of posts need, see encode_posts."""
+    columns = {"url": "slug"}
+    return posts.values("id", *{columns.get(field, field) for field in fields})
+
+
+def encode_posts(posts, fields, url_format, limit=None):
+    """
+    Yield the JSON array items of posts, as values rows from get_post_values,
+    in chunks. With a limit, stop after that many posts and return the id of
+    the last one if there are more.
+    """
+    count = 0
+    last_id = None
+    separator = ""
+    batches = itertools.batched(
+        posts.iterator(chunk_size=POST_LIST_CHUNK_SIZE), POST_LIST_CHUNK_SIZE
+    )
+    for batch in batches:
+        items = []
+        more = False
+        for post in batch:
+            # the one post past the limit, only there if there are more
+            if count == limit:
+                more = True
+                break
+            if "url" in fields:
+                post["url"] = url_format.format(post["slug"])
+            items.append({field: post[field] for field in fields})
+            last_id = post["id"]
+            count += 1
+        if items:
+            yield separator + json.dumps(items, cls=DjangoJSONEncoder)[1:-1]
+            separator = ", "
+        if more:
+            return last_id
+    return None
+
+
+def stream_post_list(user, limit, cursor, fields):
+    """
+    Yield the JSON of user's posts in chunks, only with given fields. With a
+    limit, stop after that many posts and give the cursor to continue from in
+    next_cursor. Pages are in the order posts were created, all posts at once
+    newest first.
+    """
+    posts = models.Post.objects.filter(owner=user)
+    if limit or cursor is not None:
+        posts = posts.order_by("id")
+    posts = get_post_values(posts, fields)
+    if cursor is not None:
+        posts = posts.filter(id__gt=cursor)
+    if limit:
+        posts = posts[: limit + 1]
+
+    yield '{"ok": true, "post_list": ['
+    next_cursor = yield from encode_posts(
+        posts, fields, get_post_url_format(user), limit
+    )
+    yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+
 @require_http_methods(["POST", "GET"])
 @csrf_exempt
 def api_posts(request):
@@ -66,22 +156,14 @@ def api_posts(request):
 
     # handle GET case
     if request.method == "GET":
-        post_list = models.Post.objects.filter(owner=user)
-        post_list = [
-            {
-                "title": p.title,
-                "slug": p.slug,
-                "body": p.body,
-                "published_at": p.published_at,
-                "url": util.get_protocol() + p.get_absolute_url(),
-            }
-            for p in post_list
-        ]
-        return JsonResponse(
-            {
-                "ok": True,
-                "post_list": post_list,
-            }
+        form = forms.APIPostList(request.GET)
+        if not form.is_valid():
+            return JsonResponse(
+                {"ok": False, "message": "Input data invalid."}, status=400
+            )
+        return StreamingHttpResponse(
+            stream_post_list(user, **form.cleaned_data),
+            content_type="application/json",
         )
 
     # POST case - validate input data
@@ -185,3 +267,257 @@ def api_post(request, slug):
                 "url": util.get_protocol() + post.get_absolute_url(),
             }
         )
+
+
+def stream_post_changes(user, since, fields, sync_token):
+    """
+    Yield the JSON of user's posts changed after since, and the slugs of posts
+    deleted or renamed after it, in chunks. All posts if since is None.
+    """
+    posts = models.Post.objects.filter(owner=user).order_by("updated_at", "id")
+    tombstones = models.PostTombstone.objects.filter(owner=user)
+    if since is not None:
+        posts = posts.filter(updated_at__gt=since)
+        tombstones = tombstones.filter(deleted_at__gt=since)
+    else:
+        tombstones = tombstones.none()
+
+    yield '{"ok": true, "post_list": ['
+    yield from encode_posts(
+        get_post_values(posts, fields), fields, get_post_url_format(user)
+    )
+    deleted = list(tombstones.values_list("slug", flat=True))
+    yield (
+        f'], "deleted": {json.dumps(deleted)}, "sync_token": {json.dumps(sync_token)}}}'
+    )
+
+
+@require_http_methods(["GET"])
+def api_changes(request):
+    user = _authenticate_token(request)
+    if not user:
+        return JsonResponse({"ok": False, "error": "Not authorized."}, status=403)
+
+    form = forms.APIPostChanges(request.GET)
+    if not form.is_valid():
+        return JsonResponse({"ok": False, "message": "Input data invalid."}, status=400)
+    since = form.cleaned_data["since"]
+    fields = form.cleaned_data["fields"]
+
+    # tombstones older than this may have been pruned
+    now = timezone.now()
+    if since is not None and since < now - timedelta(
+        days=settings.POST_TOMBSTONE_RETENTION_DAYS
+    ):
+        return JsonResponse(
+            {"ok": False, "error": "Sync token expired, list all posts again."},
+            status=410,
+        )
+
+    # the time of the latest change, to be given as since on the next call, but
+    # no later than API_SYNC_WINDOW ago: a save still in its transaction has an
+    # earlier time than changes already seen, and is listed again until then
+    last_updated_at = models.Post.objects.filter(owner=user).aggregate(
+        Max("updated_at")
+    )["updated_at__max"]
+    last_deleted_at = models.PostTombstone.objects.filter(owner=user).aggregate(
+        Max("deleted_at")
+    )["deleted_at__max"]
+    last_changed_at = max(
+        [t for t in [last_updated_at, last_deleted_at] if t is not None],
+        default=None,
+    )
+    if last_changed_at is not None:
+        settled_at = now - timedelta(seconds=settings.API_SYNC_WINDOW)
+        last_changed_at = min(last_changed_at, settled_at)
+    last_changed_at = max(
+        [t for t in [since, last_changed_at] if t is not None], default=None
+    )
+    sync_token = last_changed_at.isoformat() if last_changed_at else None
+
+    # the same until anything changes
+    etag_key = f"{user.id}:{since}:{','.join(fields)}:{sync_token}"
+    etag = f'"{hashlib.sha256(etag_key.encode()).hexdigest()}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = StreamingHttpResponse(
+            stream_post_changes(user, since, fields, sync_token),
+            content_type="application/json",
+        )
+    response["ETag"] = etag
+    return response
+
+
+class Batch:
+    """
+    Create, update and delete posts of a batch request in memory, then save
+    them all with bulk queries in one transaction. Bulk queries skip Post.save
+    and its signals, so save does their work once for all posts.
+    """
+
+    # Post columns an update can change
+    UPDATE_FIELDS = [
+        "title",
+        "slug",
+        "body",
+        "body_html",
+        "body_text",
+        "body_render_key",
+        "published_at",
+        "updated_at",
+    ]
+
+    def __init__(self, user, operations):
+        self.user = user
+        self.url_format = get_post_url_format(user)
+
+        # posts operations are on, and existing posts new slugs could take
+        slugs = {op["slug"] for op in operations if op["op"] != "create"}
+        self.posts = {
+            post.slug: post
+            for post in models.Post.objects.filter(owner=user, slug__in=slugs)
+        }
+        new_slugs = {
+            util.get_slug(op["title"] if op["op"] == "create" else op["new_slug"])
+            for op in operations
+            if op["op"] == "create" or op["new_slug"]
+        }
+        self.taken_slugs = set(self.posts) | set(
+            models.Post.objects.filter(owner=user, slug__in=new_slugs).values_list(
+                "slug", flat=True
+            )
+        )
+
+        self.created = []
+        self.updated = {}
+        # stored slug of each existing post deleted, by id
+        self.deleted = {}
+        # slug each existing post renamed had, by id
+        self.renamed_from = {}
+
+    def create(self, op):
+        slug = util.get_unique_slug(util.get_slug(op["title"]), self.taken_slugs)
+        post = models.Post(
+            owner=self.user,
+            title=op["title"],
+            slug=slug,
+            body=util.remove_control_chars(op.get("body") or ""),
+            published_at=op.get("published_at"),
+        )
+        self.created.append(post)
+        self.posts[slug] = post
+        return {"ok": True, "slug": slug, "url": self.url_format.format(slug)}
+
+    def update(self, op):
+        post = self.posts.get(op["slug"])
+        if post is None:
+            return {"ok": False, "error": "Not found."}
+        if "title" in op:
+            post.title = op["title"]
+        if "body" in op:
+            post.body = util.remove_control_chars(op["body"])
+        if "published_at" in op:
+            post.published_at = op["published_at"]
+        if op.get("new_slug"):
+            slug = util.get_slug(op["new_slug"])
+            if slug != post.slug:
+                # the old slug stays taken: posts are renamed in one query,
+                # and another taking it there would break their uniqueness
+                del self.posts[post.slug]
+                if post.pk:
+                    self.renamed_from.setdefault(post.pk, post.slug)
+                post.slug = util.get_unique_slug(slug, self.taken_slugs)
+                self.posts[post.slug] = post
+        if post.pk:
+            self.updated[post.pk] = post
+        return {"ok": True, "slug": post.slug, "url": self.url_format.format(post.slug)}
+
+    def delete(self, op):
+        post = self.posts.pop(op["slug"], None)
+        if post is None:
+            return {"ok": False, "error": "Not found."}
+        self.taken_slugs.discard(post.slug)
+        if post.pk:
+            # a deleted post is buried under the slug it had before the batch
+            self.updated.pop(post.pk, None)
+            self.deleted[post.pk] = self.renamed_from.pop(post.pk, post.slug)
+        else:
+            self.created.remove(post)
+        return {"ok": True}
+
+    def save(self):
+        if not (self.created or self.updated or self.deleted):
+            return
+        now = timezone.now()
+        updated = list(self.updated.values())
+        for post in [*self.created, *updated]:
+            post.render_body()
+        for post in updated:
+            post.updated_at = now
+
+        with transaction.atomic():
+            # the slugs of deleted posts can be taken by the others, so first
+            if self.deleted:
+                with signals.bulk_post_deletion():
+                    models.Post.objects.filter(id__in=list(self.deleted)).delete()
+            models.Post.objects.bulk_update(
+                updated, self.UPDATE_FIELDS, batch_size=BATCH_CHUNK_SIZE
+            )
+            models.Post.objects.bulk_create(self.created, batch_size=BATCH_CHUNK_SIZE)
+            models.PostTombstone.objects.bulk_create(
+                [
+                    models.PostTombstone(owner=self.user, slug=slug)
+                    for slug in [*self.renamed_from.values(), *self.deleted.values()]
+                ]
+            )
+            util.set_image_refs(models.Post, [*self.created, *updated])
+            signals.touch_blog(self.user.id)
+            models.LatestPost.objects.refresh([self.user.id])
+
+
+@require_http_methods(["POST"])
+@csrf_exempt
+def api_batch(request):
+    user = _authenticate_token(request)
+    if not user:
+        return JsonResponse({"ok": False, "error": "Not authorized."}, status=403)
+
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"ok": False, "message": "Input data invalid."}, status=400)
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return JsonResponse({"ok": False, "message": "Input data invalid."}, status=400)
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return JsonResponse(
+            {
+                "ok": False,
+                "message": f"At most {BATCH_MAX_OPERATIONS} operations per batch.",
+            },
+            status=400,
+        )
+
+    # invalid operations fail on their own, the others are all carried out
+    results = [None] * len(operations)
+    valid_operations = []
+    for i, operation in enumerate(operations):
+        form = forms.APIBatchOperation(operation if isinstance(operation, dict) else {})
+        if not form.is_valid():
+            errors = form.non_field_errors()
+            message = errors[0] if errors else "Input data invalid."
+            results[i] = {"ok": False, "message": message}
+            continue
+        op = {
+            key: value
+            for key, value in form.cleaned_data.items()
+            if key in operation or key == "new_slug"
+        }
+        valid_operations.append((i, op))
+
+    batch = Batch(user, [op for _, op in valid_operations])
+    for i, op in valid_operations:
+        results[i] = getattr(batch, op["op"])(op)
+    batch.save()
+
+    return JsonResponse({"ok": True, "results": results})
@@ -1,38 +1,27 @@
-import io
+import itertools
 import uuid
-import zipfile
 
-import frontmatter
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render
+from django.template.loader import get_template, render_to_string
 
-from main import models, util
+from main import exports, forms, models, util
 
+# posts in a page of the print export, when it is asked for one
+EXPORT_PRINT_PAGE_SIZE = 100
 
-def post_with_frontmatter(post: models.Post):
-    exported = frontmatter.Post(post.body)
-    title = util.escape_quotes(post.title)
-    pub_date = post.published_at or post.created_at.date()
+# posts rendered into each chunk of the print export
+EXPORT_PRINT_BATCH_SIZE = 50
 
-    exported["title"] = title
-    exported["slug"] = post.slug
-    exported["date"] = pub_date
-    exported["draft"] = post.is_draft
 
-    return frontmatter.dumps(exported)
-
-
-def export_posts(user: models.User):
-    # get all user posts and add them into export_posts encoded
-    posts = models.Post.objects.filter(owner=user)
-    exported = []
-    for p in posts:
-        title = p.slug + ".md"
-        body = post_with_frontmatter(p)
-        exported.append((title, io.BytesIO(body.encode())))
-
-    return exported
+def zip_response(export_name, files):
+    """Stream a zip archive of (name, content) pairs as a download."""
+    response = StreamingHttpResponse(
+        util.stream_zip(files), content_type="application/zip"
+    )
+    response["Content-Disposition"] = f"attachment; filename={export_name}.zip"
+    return response
 
 
 def export_index(request):
@@ -42,95 +31,17 @@ def export_index(request):
 @login_required
 def export_markdown(request):
     if request.method == "POST":
-        exported_posts = export_posts(request.user)
-
-        # create zip archive in memory
-        export_name = "export-markdown-" + str(uuid.uuid4())[:8]
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(
-            zip_buffer, "a", zipfile.ZIP_DEFLATED, False
-        ) as export_archive:
-            for file_name, data in exported_posts:
-                export_archive.writestr(
-                    export_name + "/blog/" + file_name, data.getvalue()
-                )
-
-        response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
-        response["Content-Disposition"] = f"attachment; filename={export_name}.zip"
-        return response
+        export_name = exports.get_export_name(exports.MARKDOWN)
+        files = exports.get_files(request.user, exports.MARKDOWN, export_name)
+        return zip_response(export_name, files)
 
 
 @login_required
 def export_hugo(request):
     if request.method == "POST":
-        # load hugo templates
-        with open("./export_base_hugo/config.toml") as hugo_config_file:
-            blog_title = request.user.blog_title or f"{request.user.username} blog"
-            blog_byline = request.user.blog_byline or ""
-            hugo_config = (
-                hugo_config_file.read()
-                .replace("example.com", f"{request.user.username}.capivaras.dev")
-                .replace("Example blog title", blog_title)
-                .replace(
-                    "Example blog description", "\\n".join(blog_byline.splitlines())
-                )
-            )
-        with open("./export_base_hugo/theme.toml") as hugo_theme_file:
-            hugo_theme = hugo_theme_file.read()
-        with open("./main/templates/assets/style.css") as hugo_styles_file:
-            hugo_styles = hugo_styles_file.read()
-        with open("./export_base_hugo/single.html") as hugo_single_file:
-            hugo_single = hugo_single_file.read()
-        with open("./export_base_hugo/list.html") as hugo_list_file:
-            hugo_list = hugo_list_file.read()
-        with open("./export_base_hugo/index.html") as hugo_index_file:
-            hugo_index = hugo_index_file.read()
-        with open("./export_base_hugo/baseof.html") as hugo_baseof_file:
-            hugo_baseof = hugo_baseof_file.read()
-        with open("./export_base_hugo/404.html") as hugo_404_file:
-            hugo_404 = hugo_404_file.read()
-
-        # get all user posts and add them into export_posts encoded
-        exported_posts = export_posts(request.user)
-
-        # create zip archive in memory
-        export_name = "export-hugo-" + str(uuid.uuid4())[:8]
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(
-            zip_buffer, "a", zipfile.ZIP_DEFLATED, False
-        ) as export_archive:
-            export_archive.writestr(export_name + "/config.toml", hugo_config)
-            export_archive.writestr(
-                export_name + "/themes/mataroa/theme.toml", hugo_theme
-            )
-            export_archive.writestr(
-                export_name + "/themes/mataroa/static/style.css", hugo_styles
-            )
-            export_archive.writestr(
-                export_name + "/themes/mataroa/layouts/index.html", hugo_index
-            )
-            export_archive.writestr(
-                export_name + "/themes/mataroa/layouts/404.html", hugo_404
-            )
-            export_archive.writestr(
-                export_name + "/themes/mataroa/layouts/_default/single.html",
-                hugo_single,
-            )
-            export_archive.writestr(
-                export_name + "/themes/mataroa/layouts/_default/list.html", hugo_list
-            )
-            export_archive.writestr(
-                export_name + "/themes/mataroa/layouts/_default/baseof.html",
-                hugo_baseof,
-            )
-            for file_name, data in exported_posts:
-                export_archive.writestr(
-                    export_name + "/content/blog/" + file_name, data.getvalue()
-                )
-
-        response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
-        response["Content-Disposition"] = f"attachment; filename={export_name}.zip"
-        return response
+        export_name = exports.get_export_name(exports.HUGO)
+        files = exports.get_files(request.user, exports.HUGO, export_name)
+        return zip_response(export_name, files)
 
 
 def export_unsubscribe_key(request, unsubscribe_key):
@@ -159,14 +70,57 @@ def export_unsubscribe_key(request, unsubscribe_key):
         )
 
 
+def stream_print(request, posts, context):
+    """
+    Yield the print page in chunks: the page around its posts, rendered once
+    with a placeholder where they go, and the posts in batches in between.
+    """
+    placeholder = f"posts-{uuid.uuid4().hex}"
+    page = render_to_string(
+        "main/export_print.html",
+        {**context, "posts_placeholder": placeholder},
+        request,
+    )
+    head, tail = page.split(placeholder)
+    yield head
+
+    template = get_template("partials/export_print_posts.html")
+    batches = itertools.batched(
+        posts.iterator(chunk_size=EXPORT_PRINT_BATCH_SIZE), EXPORT_PRINT_BATCH_SIZE
+    )
+    for batch in batches:
+        yield template.render({"posts": batch}, request)
+    yield tail
+
+
 @login_required
 def export_print(request):
-    return render(
-        request,
-        "main/export_print.html",
-        {
-            "posts": models.Post.objects.filter(owner=request.user).order_by(
-                "-published_at"
-            ),
-        },
+    form = forms.ExportPrintForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest("Invalid page or dates.")
+
+    # bodies as stored rendered HTML, see Post.render_body
+    posts = (
+        models.Post.objects.filter(owner=request.user)
+        .defer("body_text")
+        .order_by("-published_at", "-id")
+    )
+    if since := form.cleaned_data["since"]:
+        posts = posts.filter(published_at__gte=since)
+    if until := form.cleaned_data["until"]:
+        posts = posts.filter(published_at__lte=until)
+
+    next_page = None
+    if page := form.cleaned_data["page"]:
+        start = (page - 1) * EXPORT_PRINT_PAGE_SIZE
+        end = start + EXPORT_PRINT_PAGE_SIZE
+        if posts[end : end + 1].exists():
+            query = request.GET.copy()
+            query["page"] = page + 1
+            next_page = query.urlencode()
+        posts = posts[start:end]
+
+    return StreamingHttpResponse(
+        stream_print(request, posts, {"next_page": next_page}),
+        content_type="text/html; charset=utf-8",
     )
@@ -1,4 +1,7 @@
+import calendar
+import hashlib
 import logging
+import os
 import uuid
 from collections import defaultdict
 from datetime import datetime, timedelta
@@ -11,10 +14,12 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LogoutView as DjLogoutView
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.sitemaps.views import sitemap as DjSitemapView
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.db.models import Count, F, Max, Window
-from django.db.models.functions import TruncDay
+from django.core.paginator import Paginator
+from django.db.models import Sum
 from django.http import (
+    FileResponse,
     Http404,
     HttpResponse,
     HttpResponseBadRequest,
@@ -23,6 +28,9 @@ from django.http import (
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views.generic import (
     CreateView,
     DeleteView,
@@ -33,7 +41,8 @@ from django.views.generic import (
     UpdateView,
 )
 
-from main import denylist, forms, models, util
+from main import analytics, denylist, forms, models, storage, util, variants
+from main.pagecache import cache_blog_page, record_page_hit, record_post_hit
 from main.sitemaps import PageSitemap, PostSitemap, StaticSitemap
 
 logger = logging.getLogger(__name__)
@@ -42,7 +51,7 @@ logger = logging.getLogger(__name__)
 @login_required
 def blog_index(request):
     return redirect(
-        f'//{request.user.username}.{settings.CANONICAL_HOST}{reverse("index")}'
+        f"//{request.user.username}.{settings.CANONICAL_HOST}{reverse('index')}"
     )
 
 
@@ -57,6 +66,11 @@ def dashboard(request):
     )
 
 
+# authors listed per page of the landing page, by their latest post
+LANDING_PAGE_SIZE = 100
+
+
+@cache_blog_page(record_hit=record_page_hit)
 def index(request):
     if hasattr(request, "subdomain"):
         if models.User.objects.filter(username=request.subdomain).exists():
@@ -70,7 +84,7 @@ def index(request):
                     published_at__isnull=True,
                 ).defer("body")
             else:
-                models.AnalyticPage.objects.create(user=request.blog_user, path="index")
+                analytics.record_page(request.blog_user, "index")
                 posts = models.Post.objects.filter(
                     owner=request.blog_user,
                     published_at__isnull=False,
@@ -93,16 +107,8 @@ def index(request):
         else:
             return redirect("//" + settings.CANONICAL_HOST + reverse("index"))
 
-    last_posts = (
-        models.Post.objects.filter(
-            published_at__isnull=False,
-            published_at__lte=timezone.now().date(),
-        )
-        .annotate(
-            my_max=Window(expression=Max("published_at"), partition_by=F("owner"))
-        )
-        .filter(my_max=F("published_at"))
-    )
+    latest_posts = models.LatestPost.objects.select_related("post__owner")
+    page = Paginator(latest_posts, LANDING_PAGE_SIZE).get_page(request.GET.get("page"))
 
     return render(
         request,
@@ -110,7 +116,8 @@ def index(request):
         {
             "instance_name": settings.INSTANCE_NAME,
             "instance_description": settings.INSTANCE_DESCRIPTION,
-            "posts": last_posts,
+            "posts": [latest_post.post for latest_post in page],
+            "page_obj": page,
         },
     )
 
@@ -224,6 +231,7 @@ def post_detail_redir(request, slug):
     return redirect("post_detail", slug=slug, permanent=True)
 
 
+@method_decorator(cache_blog_page(record_hit=record_post_hit), name="dispatch")
 class PostDetail(DetailView):
     model = models.Post
 
@@ -244,7 +252,7 @@ class PostDetail(DetailView):
             and self.request.user == self.object.owner
         ):
             return context
-        models.AnalyticPost.objects.create(post=self.object)
+        analytics.record_post(self.object)
 
         return context
 
@@ -444,11 +452,152 @@ class BlogImport(LoginRequiredMixin, FormView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# for the original served in place of a variant that is not made yet
+IMAGE_PENDING_CACHE_CONTROL = "public, max-age=600"
+
+
+async def get_image_info(slug):
+    """Return what image_raw needs of an image besides its data, or None."""
+    cache_key = storage.get_info_cache_key(slug)
+    info = await cache.aget(cache_key)
+    if info is not None:
+        return info
+
+    info = (
+        await models.Image.objects.filter(slug=slug)
+        .values("id", "slug", "extension", "storage", "data_hash", "uploaded_at")
+        .afirst()
+    )
+    if info is None:
+        return None
+    if info["data_hash"] is None:
+        # images uploaded before hashes were stored get theirs on first fetch
+        image = await models.Image.objects.with_data().aget(id=info["id"])
+        try:
+            data = storage.read(image)
+        except FileNotFoundError:
+            return None
+        info["data_hash"] = hashlib.sha256(data).hexdigest()
+        await models.Image.objects.filter(id=info["id"]).aupdate(
+            data_hash=info["data_hash"]
+        )
+    await cache.aset(cache_key, info, settings.IMAGE_CACHE_TIMEOUT)
+    return info
+
+
+async def open_image(image):
+    """
+    Return an open file of an image's data on the filesystem, or the data in the
+    database, whichever image.storage says, as (file, data). Both are None if
+    the data is not there.
+    """
+    if image.storage == storage.FILESYSTEM:
+        try:
+            return storage.open_file(image), None
+        except FileNotFoundError:
+            return None, None
+    data = (
+        await models.Image.objects.filter(id=image.id)
+        .values_list("data", flat=True)
+        .afirst()
+    )
+    return None, (None if data is None else bytes(data))
+
+
+async def serve_image(request, info, etag, variant_path=None):
+    """Return a 200 response with the whole image, or a 206 with a byte range."""
+    image = models.Image(
+        id=info["id"],
+        slug=info["slug"],
+        extension=info["extension"],
+        storage=info["storage"],
+    )
+    if variant_path:
+        try:
+            image_file = open(variant_path, "rb")  # noqa: SIM115
+        except FileNotFoundError:
+            raise Http404() from None
+        data = None
+    else:
+        image_file, data = await open_image(image)
+        if image_file is None and data is None:
+            # moved to the other storage since its info was cached, eg. by
+            # moveimages, which cannot clear the cache of other processes
+            image.storage = (
+                storage.DATABASE
+                if image.storage == storage.FILESYSTEM
+                else storage.FILESYSTEM
+            )
+            image_file, data = await open_image(image)
+            if image_file is None and data is None:
+                raise Http404()
+            await cache.adelete(storage.get_info_cache_key(image.slug))
+    size = os.fstat(image_file.fileno()).st_size if image_file else len(data)
+
+    byte_range = None
+    if "Range" in request.headers and request.headers.get("If-Range", etag) == etag:
+        try:
+            byte_range = util.parse_byte_range(request.headers["Range"], size)
+        except ValueError:
+            if image_file:
+                image_file.close()
+            response = HttpResponse(status=416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+
+    extension = variant_path.suffix[1:] if variant_path else image.extension
+    content_type = "image/" + extension
+    if byte_range is None:
+        if image_file:
+            response = FileResponse(image_file, content_type=content_type)
+        else:
+            response = HttpResponse(data, content_type=content_type)
+    else:
+        first, last = byte_range
+        if image_file:
+            with image_file:
+                image_file.seek(first)
+                data = image_file.read(last - first + 1)
+        else:
+            data = data[first : last + 1]
+        response = HttpResponse(data, status=206, content_type=content_type)
+        response.headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+
 async def image_raw(request, slug, extension):
-    image = await models.Image.objects.filter(slug=slug).afirst()
-    if not image or extension != image.extension:
+    info = await get_image_info(slug)
+    if not info:
         raise Http404()
-    return HttpResponse(image.data, content_type="image/" + image.extension)
+
+    # ?w=<width> asks for a variant, see main.variants
+    width = variants.get_width(request.GET.get("w"))
+    variant_path = None
+    if width and extension in variants.get_extensions(info["extension"]):
+        variant_path = variants.get_path(slug, width, extension)
+        if not variant_path.exists():
+            variant_path = None
+    else:
+        width = None
+    if extension != info["extension"] and width is None:
+        raise Http404()
+
+    if variant_path:
+        etag = f'"{info["data_hash"]}-{width}.{extension}"'
+        cache_control = IMAGE_CACHE_CONTROL
+    else:
+        etag = f'"{info["data_hash"]}"'
+        cache_control = IMAGE_PENDING_CACHE_CONTROL if width else IMAGE_CACHE_CONTROL
+    last_modified = calendar.timegm(info["uploaded_at"].utctimetuple())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = await serve_image(request, info, etag, variant_path)
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+    response.headers["Cache-Control"] = cache_control
+    return response
 
 
 class ImageList(LoginRequiredMixin, FormView):
@@ -459,11 +608,7 @@ class ImageList(LoginRequiredMixin, FormView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["images"] = models.Image.objects.filter(owner=self.request.user)
-
-        context["total_quota"] = 0
-        for image in models.Image.objects.filter(owner=self.request.user):
-            context["total_quota"] += image.data_size
-        context["total_quota"] = round(context["total_quota"], 2)
+        context["total_quota"] = round(self.request.user.image_bytes / 1024**2, 2)
         return context
 
     def post(self, request, *args, **kwargs):
@@ -490,13 +635,14 @@ class ImageList(LoginRequiredMixin, FormView):
                     return self.form_invalid(form)
 
                 self.slug = str(uuid.uuid4())[:8]
-                models.Image.objects.create(
+                image = models.Image(
                     name=name,
-                    data=data,
                     extension=self.extension,
                     owner=request.user,
                     slug=self.slug,
                 )
+                storage.store(image, data)
+                image.save()
             return self.form_valid(form)
         else:
             return self.form_invalid(form)
@@ -528,11 +674,9 @@ class ImageDetail(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        # find posts that use this image
-        context["used_by_posts"] = []
-        for post in models.Post.objects.filter(owner=self.request.user):
-            if "/images/" + self.object.filename in post.body:
-                context["used_by_posts"].append(post)
+        context["used_by_posts"] = self.object.post_set.filter(
+            owner=self.request.user
+        ).only("slug", "title")
 
         return context
 
@@ -595,6 +739,7 @@ class PageCreate(LoginRequiredMixin, SuccessMessageMixin, CreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+@method_decorator(cache_blog_page(record_hit=record_page_hit), name="dispatch")
 class PageDetail(DetailView):
     model = models.Page
 
@@ -616,9 +761,7 @@ class PageDetail(DetailView):
             and self.request.user == self.object.owner
         ):
             return context
-        models.AnalyticPage.objects.create(
-            user=self.request.blog_user, path=self.request.path.strip("/")
-        )
+        analytics.record_page(self.request.blog_user, self.request.path.strip("/"))
 
         return context
 
@@ -701,12 +844,12 @@ class AnalyticList(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        top_posts = (models.Post.objects
-            .filter(owner=self.request.user)
-            .annotate(num_views=Count("analyticpost"))
+        top_posts = (
+            models.Post.objects.filter(owner=self.request.user)
+            .annotate(num_views=Sum("analyticpostdaily__count"))
             .filter(num_views__gt=0)
-            .order_by("-num_views")
-            [:10])
+            .order_by("-num_views")[:10]
+        )
 
         context["top_posts"] = top_posts
         context["post_list"] = models.Post.objects.filter(owner=self.request.user)
@@ -723,11 +866,11 @@ def populate_analytics_context(context, date_25d_ago, current_date, day_counts):
     count_per_day = defaultdict(int)
     highest_day_count = 1
     for item in day_counts:
-        count_per_day[item["created_at"].date()] += item["id__count"]
+        count_per_day[item["date"]] += item["count"]
 
         # find day with the most analytics counts (i.e. visits)
-        if highest_day_count < count_per_day[item["created_at"].date()]:
-            highest_day_count = count_per_day[item["created_at"].date()]
+        if highest_day_count < count_per_day[item["date"]]:
+            highest_day_count = count_per_day[item["date"]]
 
     # calculate analytics count and percentages for each day
     while date_25d_ago <= current_date:
@@ -767,14 +910,10 @@ class AnalyticPostDetail(LoginRequiredMixin, DetailView):
         current_date = timezone.now().date()
         date_25d_ago = timezone.now().date() - timedelta(days=24)
 
-        # get all counts for the last 25 days
-        day_counts = (
-            models.AnalyticPost.objects.filter(
-                post=self.object, created_at__gt=date_25d_ago
-            )
-            .values("created_at")
-            .annotate(Count("id"))
-        )
+        # get daily counts for the last 25 days
+        day_counts = models.AnalyticPostDaily.objects.filter(
+            post=self.object, date__gte=date_25d_ago
+        ).values("date", "count")
 
         return populate_analytics_context(
             context=context,
@@ -788,17 +927,13 @@ class AnalyticPageDetail(LoginRequiredMixin, DetailView):
     template_name = "main/analytic_detail.html"
 
     def get_object(self):
-        # our object is annotated with counts for the last 25 days
+        # our object is the daily counts for the last 25 days
         date_25d_ago = timezone.now().date() - timedelta(days=24)
-        return (
-            models.AnalyticPage.objects.filter(
-                user=self.request.user,
-                path=self.kwargs["page_path"],
-                created_at__gt=date_25d_ago,
-            )
-            .values("created_at")
-            .annotate(Count("id"))
-        )
+        return models.AnalyticPageDaily.objects.filter(
+            user=self.request.user,
+            path=self.kwargs["page_path"],
+            date__gte=date_25d_ago,
+        ).values("date", "count")
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -966,70 +1101,40 @@ def privacy_redir(request):
 
 
 def transparency(request):
-    monthly_revenue = models.User.objects.filter(is_premium=True).count() * 9 / 12
-    published_posts = models.Post.objects.filter(published_at__isnull=False).count()
-
-    zero_users = (
-        models.User.objects.annotate(Count("post")).filter(post__count=0).count()
-    )
-    one_users = (
-        models.User.objects.annotate(Count("post")).filter(post__count=1).count()
-    )
-    twoplus_users = (
-        models.User.objects.annotate(Count("post")).filter(post__count__gt=1).count()
-    )
+    try:
+        stats = models.InstanceStats.objects.latest()
+    except models.InstanceStats.DoesNotExist:
+        # before the first run of updateinstancestats
+        stats = models.InstanceStats.objects.take()
 
     zero_users_percentage = 0
     one_users_percentage = 0
     twoplus_users_percentage = 0
-    if models.User.objects.all().count() > 0:
-        one_users_percentage = round(
-            one_users * 100 / models.User.objects.all().count()
-        )
-        zero_users_percentage = round(
-            zero_users * 100 / models.User.objects.all().count()
-        )
-        twoplus_users_percentage = round(
-            twoplus_users * 100 / models.User.objects.all().count()
-        )
-
-    updated_posts = models.Post.objects.filter(
-        updated_at__gt=datetime.now() - timedelta(days=30)
-    ).select_related("owner")
-    active_users = len({post.owner.id for post in updated_posts})
+    if stats.users > 0:
+        one_users_percentage = round(stats.one_users * 100 / stats.users)
+        zero_users_percentage = round(stats.zero_users * 100 / stats.users)
+        twoplus_users_percentage = round(stats.twoplus_users * 100 / stats.users)
 
-    one_month_ago = timezone.now() - timedelta(days=30)
-    active_nonnew_users = len(
-        {
-            post.owner.id
-            for post in updated_posts
-            if post.owner.date_joined < one_month_ago
-        }
-    )
+    monthly_revenue = stats.monthly_revenue
     revenue_co2 = monthly_revenue * 0.05
 
-    # calc new users and chart data
-    new_users_per_day_qs = (
-        models.User.objects.annotate(date=TruncDay("date_joined"))
-        .values("date")
-        .annotate(user_count=Count("id"))
-        .order_by("-date")[:25]
-    )
+    # chart data
     new_users_per_day = {}
     current_x_offset = 0
     # find day with the most counts (so that we can normalise the rest)
     highest_day_count = 1
-    for nu in new_users_per_day_qs:
-        if highest_day_count < nu["user_count"]:
-            highest_day_count = nu["user_count"]
-    for nu in new_users_per_day_qs:
+    for nu in stats.new_users_per_day:
+        if highest_day_count < nu["count"]:
+            highest_day_count = nu["count"]
+    for nu in stats.new_users_per_day:
         # normalize day count to percentage for svg drawing
         count_percent = 1  # keep lowest value to 1 (1px) so that it's visible
-        if highest_day_count != 0 and nu["user_count"] != 0:
-            count_percent = nu["user_count"] * 100 / highest_day_count
+        if highest_day_count != 0 and nu["count"] != 0:
+            count_percent = nu["count"] * 100 / highest_day_count
 
-        new_users_per_day[nu["date"]] = {
-            "count": nu["user_count"],
+        day = datetime.fromisoformat(nu["date"])
+        new_users_per_day[day] = {
+            "count": nu["count"],
             "x_offset": current_x_offset,
             "count_percent": count_percent,
             "negative_count_percent": 100 - count_percent,
@@ -1040,26 +1145,28 @@ def transparency(request):
         request,
         "main/transparency.html",
         {
-            "users": models.User.objects.all().count(),
-            "premium_users": models.User.objects.filter(is_premium=True).count(),
-            "posts": models.Post.objects.all().count(),
-            "pages": models.Page.objects.all().count(),
-            "zero_users": zero_users,
-            "one_users": one_users,
-            "twoplus_users": twoplus_users,
+            "users": stats.users,
+            "premium_users": stats.premium_users,
+            "posts": stats.posts,
+            "pages": stats.pages,
+            "zero_users": stats.zero_users,
+            "one_users": stats.one_users,
+            "twoplus_users": stats.twoplus_users,
             "zero_users_percentage": zero_users_percentage,
             "one_users_percentage": one_users_percentage,
             "twoplus_users_percentage": twoplus_users_percentage,
-            "active_users": active_users,
-            "active_nonnew_users": active_nonnew_users,
-            "published_posts": published_posts,
+            "active_users": stats.active_users,
+            "active_nonnew_users": stats.active_nonnew_users,
+            "published_posts": stats.published_posts,
             "monthly_revenue": monthly_revenue,
             "revenue_co2": revenue_co2,
             "new_users_per_day": new_users_per_day,
+            "updated_at": stats.created_at,
         },
     )
 
 
+@cache_blog_page
 def sitemap(request):
     if not hasattr(request, "subdomain"):
         raise Http404()
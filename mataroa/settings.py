@@ -211,6 +211,85 @@ if not DEBUG and not LOCALDEV:
     SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# In process memory, so every gunicorn worker keeps its own. Entries dropped in
+# one worker (eg. on save) can live on in the others until their timeout.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+
+# Seconds a blog host (subdomain or custom domain) lookup is cached for.
+HOST_CACHE_TIMEOUT = int(os.getenv("HOST_CACHE_TIMEOUT", "60"))
+
+# Seconds an anonymous blog response is cached for, 0 to disable. Edits are
+# seen immediately regardless, see main/pagecache.py.
+PAGE_CACHE_TIMEOUT = int(os.getenv("PAGE_CACHE_TIMEOUT", "3600"))
+
+
+# Analytics
+# Hits are buffered in each worker and written in bulk once there are
+# ANALYTICS_FLUSH_SIZE of them or the oldest is ANALYTICS_FLUSH_INTERVAL
+# seconds old. A worker killed uncleanly loses at most ANALYTICS_FLUSH_SIZE hits.
+
+ANALYTICS_FLUSH_SIZE = int(os.getenv("ANALYTICS_FLUSH_SIZE", "50"))
+ANALYTICS_FLUSH_INTERVAL = int(os.getenv("ANALYTICS_FLUSH_INTERVAL", "10"))
+
+# Most hits of pages, and as many of posts, each worker keeps while flushes
+# fail, eg. while the database is down. Older ones are dropped past it.
+ANALYTICS_BUFFER_MAX = int(os.getenv("ANALYTICS_BUFFER_MAX", "10000"))
+
+# Dashboards read per-day counts. Raw hits older than this many days are
+# deleted by the rollupanalytics command.
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))
+
+
+# API
+# The sync_token of /api/changes/ lags the latest change by API_SYNC_WINDOW
+# seconds, so that posts saved in transactions still open when it was read are
+# listed again by the next call instead of missed. Keep it above the longest
+# transaction that saves posts.
+
+API_SYNC_WINDOW = int(os.getenv("API_SYNC_WINDOW", "60"))
+
+# Slugs of deleted posts are kept this many days, then deleted by the
+# prunetombstones command. Older sync tokens are refused.
+
+POST_TOMBSTONE_RETENTION_DAYS = int(os.getenv("POST_TOMBSTONE_RETENTION_DAYS", "90"))
+
+
+# Images
+# Where uploaded image data is stored: "database" (Image.data) or
+# "filesystem" (files in IMAGE_ROOT). See main/storage.py.
+
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "database")
+IMAGE_ROOT = os.getenv("IMAGE_ROOT", str(BASE_DIR / "images"))
+
+# Seconds what serving an image needs besides its data is cached for, so that
+# conditional requests are answered without querying the database.
+IMAGE_CACHE_TIMEOUT = int(os.getenv("IMAGE_CACHE_TIMEOUT", "3600"))
+
+# Smaller versions of images, see main/variants.py: the widths in pixels they
+# are made in, and whether to also make WebP versions.
+IMAGE_VARIANT_WIDTHS = [
+    int(width)
+    for width in os.getenv("IMAGE_VARIANT_WIDTHS", "480,960,1600").split(",")
+    if width
+]
+IMAGE_VARIANT_WEBP = os.getenv("IMAGE_VARIANT_WEBP", "1") == "1"
+
+
+# Markdown
+# Number of rendered short markdown fields (bylines, footers, etc.) each
+# worker keeps in memory.
+
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "2048"))
+
+
 # Translate
 
 TRANSLATE_API_URL = os.getenv(